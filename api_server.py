@@ -0,0 +1,101 @@
+"""
+轻量HTTP推理接口
+POST /generate  {"prompt": "...", "session_id": "...", "max_length": 512, "temperature": 0.7,
+                 "regex": "...", "json_schema": {...}, "adapter": "...", "n": 1, "best_of": 1,
+                 "logprobs": false, "top_logprobs": 0, "stop": ["..."], "stop_token_ids": [[...]]}
+GET  /health
+"""
+import json
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+
+def _parse_options(request):
+    """解析请求体中的生成参数；参数类型或格式不对时抛出 ValueError/TypeError"""
+    if not isinstance(request.get("prompt"), str):
+        raise ValueError("prompt 必须是字符串")
+    if not isinstance(request.get("session_id"), (str, int, type(None))):
+        raise ValueError("session_id 必须是字符串")
+    gen_kwargs = {
+        "max_length": int(request.get("max_length", 512)),
+        "temperature": float(request.get("temperature", 0.7))
+    }
+    # 可选参数：约束解码、LoRA适配器、停止字符串/停止token序列
+    for key in ("regex", "json_schema", "adapter", "stop", "stop_token_ids"):
+        if request.get(key) is not None:
+            gen_kwargs[key] = request[key]
+    # 逐token输出：token ID、对数概率、发出时间（以并列数组返回）
+    if request.get("logprobs") or request.get("top_logprobs"):
+        gen_kwargs["details"] = True
+        gen_kwargs["top_logprobs"] = int(request.get("top_logprobs") or 0)
+    # 多候选：返回按对数概率排序的前n个候选
+    for key in ("n", "best_of"):
+        if request.get(key) is not None:
+            gen_kwargs[key] = int(request[key])
+    if gen_kwargs.get("n", 1) > 1 or gen_kwargs.get("best_of", 1) > 1:
+        unsupported = [key for key in ("regex", "json_schema", "logprobs", "top_logprobs") if request.get(key)]
+        if unsupported:
+            raise ValueError(f"n/best_of 大于1时不支持 {', '.join(unsupported)}")
+    return gen_kwargs
+
+def create_server(backend, host="127.0.0.1", port=8000):
+    """创建HTTP服务；backend需提供 generate(prompt, session_id=None, **kwargs) 和 health()"""
+    
+    class RequestHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json(200, {"workers": backend.health()})
+            else:
+                self._send_json(404, {"error": "not found"})
+        
+        def do_POST(self):
+            if self.path != "/generate":
+                self._send_json(404, {"error": "not found"})
+                return
+            
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(request, dict):
+                    raise ValueError("请求体必须是JSON对象")
+                prompt = request["prompt"]
+                gen_kwargs = _parse_options(request)
+            except (ValueError, TypeError, KeyError) as e:
+                self._send_json(400, {"error": f"无效的请求: {e}"})
+                return
+            
+            try:
+                response = backend.generate(
+                    prompt,
+                    session_id=request.get("session_id"),
+                    **gen_kwargs
+                )
+                if isinstance(response, list):
+                    self._send_json(200, {"response": response[0]["text"], "candidates": response})
+                elif isinstance(response, dict):
+                    if "error" in response:
+                        raise RuntimeError(response["error"])
+                    payload = {"response": response.pop("text")}
+                    payload.update({key: value.tolist() for key, value in response.items()})
+                    self._send_json(200, payload)
+                else:
+                    self._send_json(200, {"response": response})
+            except Exception as e:
+                logger.error(f"请求处理失败: {e}")
+                self._send_json(500, {"error": str(e)})
+        
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+    
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    return server
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+预量化模型产物：把 ./models 下的模型按某种加载方式（nf4/int8/bf16/fp32）转换一次并保存为safetensors，
+之后加载时直接读取，不再在每次启动时重新量化或转换精度
+
+产物目录: ./models/<模型>/quantized/<加载方式>/，其中 manifest.json 记录源权重文件的哈希、
+大小、修改时间以及生成时的 QUANTIZATION_CONFIG；任何一项不一致时产物视为过期，不会被使用
+"""
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import logging
+import argparse
+from config import QUANTIZATION_CONFIG, ARTIFACT_CONFIG
+from model_manager import verify_model_files
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+MODES = ("nf4", "int8", "bf16", "fp32")
+# 需要 bitsandbytes + GPU 的加载方式
+QUANTIZED_MODES = ("nf4", "int8")
+
+def artifact_dir(model_path, mode):
+    return os.path.join(model_path, ARTIFACT_CONFIG["dir"], mode)
+
+def source_shards(model_path):
+    return sorted(glob.glob(os.path.join(model_path, "*.safetensors")))
+
+def _shard_stat(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+def _settings(mode):
+    """影响产物内容的设置；只有量化方式才与 QUANTIZATION_CONFIG 有关"""
+    return dict(QUANTIZATION_CONFIG) if mode in QUANTIZED_MODES else {}
+
+def find_artifact(model_path, mode):
+    """加载模型时使用：返回匹配的产物目录（ARTIFACT_CONFIG 关闭时总是返回None）"""
+    if not ARTIFACT_CONFIG["prefer_artifacts"]:
+        return None
+    return matching_artifact(model_path, mode)
+
+def matching_artifact(model_path, mode):
+    """返回与当前源权重和配置匹配的产物目录，没有或已过期时返回None
+
+    源权重只比较大小和修改时间（加载时不重新计算哈希），哈希用于追溯产物来源
+    """
+    path = artifact_dir(model_path, mode)
+    manifest_file = os.path.join(path, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return None
+    try:
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    shards = {os.path.basename(shard): _shard_stat(shard) for shard in source_shards(model_path)}
+    recorded = {name: {"size": info["size"], "mtime": info["mtime"]} for name, info in manifest["source"].items()}
+    if manifest.get("mode") != mode or manifest.get("settings") != _settings(mode):
+        logger.info(f"预量化产物 {path} 的配置与当前不一致，忽略")
+        return None
+    if shards != recorded:
+        logger.info(f"源权重已变化，预量化产物 {path} 已过期")
+        return None
+    return path
+
+def _load_kwargs(mode):
+    import torch
+    from transformers import BitsAndBytesConfig
+
+    if mode in ("bf16", "fp32"):
+        dtype = torch.bfloat16 if mode == "bf16" else torch.float32
+        return {"torch_dtype": dtype, "device_map": "cpu", "low_cpu_mem_usage": True}
+
+    if not torch.cuda.is_available():
+        raise RuntimeError(f"{mode} 量化需要GPU和bitsandbytes")
+    compute_dtype = getattr(torch, QUANTIZATION_CONFIG["bnb_4bit_compute_dtype"])
+    if mode == "int8":
+        quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+    else:
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=compute_dtype,
+            bnb_4bit_use_double_quant=QUANTIZATION_CONFIG["bnb_4bit_use_double_quant"],
+            bnb_4bit_quant_type=QUANTIZATION_CONFIG["bnb_4bit_quant_type"]
+        )
+    return {
+        "quantization_config": quantization_config,
+        "torch_dtype": compute_dtype,
+        "device_map": {"": 0},
+        "low_cpu_mem_usage": True
+    }
+
+def build_artifact(model_path, mode):
+    """量化/转换一次并保存；先写入临时目录，完成后再替换，避免留下不完整的产物"""
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+
+    if mode not in MODES:
+        raise ValueError(f"不支持的加载方式: {mode}（可选: {', '.join(MODES)}）")
+    shards = source_shards(model_path)
+    if not shards:
+        raise FileNotFoundError(f"未找到safetensors权重文件: {model_path}")
+
+    start = time.perf_counter()
+    logger.info(f"正在校验源权重 ({len(shards)} 个文件)...")
+    # 复用完整性校验清单中的哈希，只重新计算发生变化的文件
+    report = verify_model_files(model_path, full=True)
+    if not report["ok"]:
+        raise RuntimeError(f"源权重校验失败: {'; '.join(report['problems'])}")
+    source = {
+        os.path.basename(shard): {"sha256": report["files"][os.path.basename(shard)]["sha256"], **_shard_stat(shard)}
+        for shard in shards
+    }
+
+    logger.info(f"正在以 {mode} 方式加载并转换模型...")
+    model = AutoModelForCausalLM.from_pretrained(
+        model_path,
+        trust_remote_code=True,
+        local_files_only=True,
+        **_load_kwargs(mode)
+    )
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True, local_files_only=True)
+
+    target = artifact_dir(model_path, mode)
+    staging = target + ".tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    model.save_pretrained(staging, safe_serialization=True, max_shard_size=ARTIFACT_CONFIG["max_shard_size"])
+    tokenizer.save_pretrained(staging)
+
+    import torch
+    import transformers
+    manifest = {
+        "mode": mode,
+        "settings": _settings(mode),
+        "source": source,
+        "created": time.time(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__
+    }
+    with open(os.path.join(staging, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(staging, target)
+    logger.info(f"预量化产物已保存到 {target}，耗时 {time.perf_counter() - start:.1f} 秒")
+    return target
+
+def list_artifacts(model_path):
+    """列出模型的预量化产物及是否与当前源权重匹配"""
+    root = os.path.join(model_path, ARTIFACT_CONFIG["dir"])
+    if not os.path.isdir(root):
+        return []
+    return [
+        {"mode": mode, "path": artifact_dir(model_path, mode), "valid": matching_artifact(model_path, mode) is not None}
+        for mode in MODES if os.path.exists(os.path.join(artifact_dir(model_path, mode), MANIFEST_FILE))
+    ]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="生成预量化模型产物")
+    parser.add_argument("model_path", help="模型目录，例如 ./models/Qwen2-7B-Instruct")
+    parser.add_argument("--mode", choices=MODES, default=None, help="加载方式（默认使用放置计划选择的方式）")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    mode = args.mode
+    if mode is None:
+        from placement import plan_placement
+        mode = plan_placement(args.model_path)["mode"]
+    build_artifact(args.model_path, mode)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+硬件自动调优：在当前机器上按时间预算测试一组候选配置（推理后端、加载方式、注意力实现、线程数、批大小），
+把最优配置按硬件指纹保存到模型目录，LocalLLM.load_model 之后自动应用
+
+用法: python autotune.py <模型键或模型目录> [--budget 600] [--objective latency|throughput]
+模型键为 config.MODEL_CONFIG 中的键（例如 qwen2_7b），对应 ./models/<model_name>
+"""
+import os
+import gc
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import platform
+from datetime import datetime
+from config import MODEL_CONFIG, AUTOTUNE_CONFIG, LORA_CONFIG
+
+logger = logging.getLogger(__name__)
+
+PROFILE_FILE = ".autotune.json"
+
+def available_cpus():
+    """本进程可用的CPU数（考虑NUMA绑定/容器限制）"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def _cpu_model():
+    try:
+        with open("/proc/cpuinfo", 'r') as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+def machine_info():
+    """影响最优配置的硬件和软件信息（与可用内存这类随时变化的量无关）"""
+    import psutil
+    import torch
+
+    info = {
+        "cpu": _cpu_model(),
+        "cpus": available_cpus(),
+        "physical_cores": psutil.cpu_count(logical=False),
+        "ram_gb": round(psutil.virtual_memory().total / 1024**3),
+        "gpu": None,
+        "gpu_gb": None,
+        "machine": platform.machine(),
+        "torch": torch.__version__.split("+")[0]
+    }
+    if torch.cuda.is_available():
+        info["gpu"] = torch.cuda.get_device_name(0)
+        info["gpu_gb"] = round(torch.cuda.get_device_properties(0).total_memory / 1024**3)
+    return info
+
+def machine_fingerprint(info=None):
+    key = json.dumps(info or machine_info(), sort_keys=True)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+def _read_profiles(model_path):
+    path = os.path.join(model_path, PROFILE_FILE)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def load_profile(model_path):
+    """当前硬件上保存的调优配置（dict），没有时返回None"""
+    record = _read_profiles(model_path).get(machine_fingerprint())
+    return dict(record["settings"]) if record else None
+
+def save_profile(model_path, record):
+    profiles = _read_profiles(model_path)
+    profiles[record["fingerprint"]] = record
+    path = os.path.join(model_path, PROFILE_FILE)
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(profiles, f, ensure_ascii=False, indent=2)
+    except OSError as e:
+        logger.warning(f"无法保存调优配置: {e}")
+        return None
+    return path
+
+def resolve_model_path(model, models_dir="./models"):
+    if model in MODEL_CONFIG:
+        return os.path.join(models_dir, MODEL_CONFIG[model]["model_name"])
+    return model
+
+def _installed(module):
+    import importlib.util
+    return importlib.util.find_spec(module) is not None
+
+def load_candidates(info, include_compiled=False):
+    """需要重新加载模型的候选配置（后端 / 加载方式 / 注意力实现），按预计收益排列"""
+    attns = ["sdpa", "eager"]
+    if info["gpu"] is not None:
+        if _installed("flash_attn"):
+            attns.insert(0, "flash_attention_2")
+        modes = ["bf16", "fp16"] + (["int8", "nf4"] if _installed("bitsandbytes") else [])
+        candidates = [{"backend": "eager", "mode": mode, "attn_implementation": attn} for mode in modes for attn in attns]
+        if include_compiled:
+            candidates.insert(1, {"backend": "compiled", "mode": "bf16", "attn_implementation": "sdpa"})
+        return candidates
+
+    candidates = [
+        {"backend": "eager", "mode": "fp32", "attn_implementation": "sdpa"},
+        {"backend": "eager", "mode": "bf16", "attn_implementation": "sdpa"},
+        {"backend": "quantized_cpu", "attn_implementation": "sdpa"},
+        {"backend": "eager", "mode": "fp32", "attn_implementation": "eager"},
+        {"backend": "quantized_cpu", "attn_implementation": "eager"}
+    ]
+    if include_compiled:
+        candidates.insert(1, {"backend": "compiled", "mode": "fp32", "attn_implementation": "sdpa"})
+    return candidates
+
+def thread_candidates(info):
+    cpus = info["cpus"]
+    physical = min(info["physical_cores"] or cpus, cpus)
+    return sorted({cpus, physical, max(physical // 2, 1)}, reverse=True)
+
+def _load(model_path, profile):
+    from local_llm_v2 import LocalLLM
+    llm = LocalLLM(model_path, backend=profile.get("backend"), profile=profile)
+    if not llm.load_model():
+        return None
+    return llm
+
+def _release(llm):
+    import torch
+    if llm is not None:
+        llm.unload_model()
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+def measure(llm, prompt, new_tokens, runs=2):
+    """单请求：预填充耗时（生成1个token）和之后每token的解码耗时，各取多次中的最优"""
+    from benchmark import time_generation
+    prefill = min(time_generation(llm, prompt, 1)[0] for _ in range(runs))
+    total, tokens = min(time_generation(llm, prompt, new_tokens) for _ in range(runs))
+    decode = max(total - prefill, 1e-9) / max(tokens - 1, 1)
+    return {"prefill_ms": prefill * 1000, "decode_ms": decode * 1000, "tokens_per_s": 1 / decode}
+
+def measure_batch(llm, prompt, new_tokens, batch_size):
+    """批量解码的总吞吐（tokens/s）"""
+    start = time.perf_counter()
+    results = llm.generate_batch([prompt] * batch_size, max_length=new_tokens, details=True)
+    elapsed = time.perf_counter() - start
+    return sum(result["tokens"] for result in results) / elapsed
+
+def autotune(model_path, budget=None, objective="latency", include_compiled=False):
+    """按时间预算测试候选配置，返回调优记录（含默认配置和最优配置的测量结果）"""
+    import torch
+    from benchmark import build_prompt
+
+    budget = budget or AUTOTUNE_CONFIG["budget_seconds"]
+    new_tokens = AUTOTUNE_CONFIG["new_tokens"]
+    info = machine_info()
+    start = time.perf_counter()
+    default_threads = torch.get_num_threads()
+    results = []
+
+    def remaining():
+        return budget - (time.perf_counter() - start)
+
+    def run(profile, llm=None):
+        """测量一个配置；llm 为None时按配置加载模型、测量后立即释放（同一时间只保留一份模型，
+        后加载的候选按完整的可用内存规划放置）。返回结果，加载失败时返回None"""
+        began = time.perf_counter()
+        loaded = llm is None
+        if loaded:
+            llm = _load(model_path, profile)
+        if llm is None:
+            results.append({"settings": profile, "error": "加载失败"})
+            return None
+        torch.set_num_threads(profile.get("threads") or default_threads)
+        try:
+            prompt = build_prompt(llm, AUTOTUNE_CONFIG["prompt_tokens"])
+            measure(llm, prompt, 4, runs=1)
+            result = {"settings": profile, **measure(llm, prompt, new_tokens)}
+        except Exception as e:
+            result = {"settings": profile, "error": str(e)}
+        result["seconds"] = time.perf_counter() - began
+        result["effective"] = {
+            "backend": llm.backend.name,
+            "mode": llm.placement.get("mode"),
+            "attn_implementation": getattr(llm.model.config, "_attn_implementation", None)
+        }
+        if loaded:
+            _release(llm)
+        results.append(result)
+        logger.info(f"{_describe(profile)}: {_summary(result)}")
+        return result
+
+    # 默认配置（放置计划 + 配置文件中的后端，不应用已保存的调优结果）
+    baseline = run({})
+    if baseline is None or "error" in baseline:
+        raise RuntimeError(f"默认配置无法运行: {baseline['error'] if baseline else '加载失败'}")
+    best = baseline
+    cost = baseline["seconds"]
+
+    # 第一阶段：需要重新加载的配置（与默认配置实际相同的跳过）
+    for profile in load_candidates(info, include_compiled):
+        if all(baseline["effective"].get(key) == value for key, value in profile.items()):
+            continue
+        if remaining() < cost:
+            logger.info("时间预算用完，跳过剩余的加载配置")
+            break
+        result = run(profile)
+        if result is None:
+            continue
+        cost = max(cost, result["seconds"])
+        if "error" not in result and result["tokens_per_s"] > best["tokens_per_s"]:
+            best = result
+
+    # 重新加载最优配置，用于线程数和批大小两个阶段
+    best_llm = _load(model_path, best["settings"])
+    if best_llm is None:
+        raise RuntimeError(f"最优配置重新加载失败: {_describe(best['settings'])}")
+
+    # 第二阶段：在最优加载配置上调整线程数（不需要重新加载）
+    for threads in thread_candidates(info):
+        if threads == (best["settings"].get("threads") or default_threads) or remaining() < best["seconds"]:
+            continue
+        result = run({**best["settings"], "threads": threads}, best_llm)
+        if "error" not in result and result["tokens_per_s"] > best["tokens_per_s"]:
+            best = result
+    settings = dict(best["settings"])
+    settings.setdefault("threads", default_threads)
+    torch.set_num_threads(settings["threads"])
+
+    # 第三阶段：批大小（吞吐优先时选吞吐最高的，否则选吞吐接近最高时最小的批大小）
+    prompt = build_prompt(best_llm, AUTOTUNE_CONFIG["prompt_tokens"])
+    throughput = {}
+    for batch_size in AUTOTUNE_CONFIG["batch_sizes"]:
+        if remaining() < 0 and throughput:
+            break
+        throughput[batch_size] = measure_batch(best_llm, prompt, new_tokens, batch_size)
+        logger.info(f"批大小 {batch_size}: {throughput[batch_size]:.1f} tokens/s")
+    peak = max(throughput.values())
+    if objective == "throughput":
+        settings["batch_size"] = max(throughput, key=throughput.get)
+    else:
+        settings["batch_size"] = min(size for size, value in throughput.items() if value >= 0.9 * peak)
+    default_batch = LORA_CONFIG["max_batch_size"]
+    if default_batch not in throughput and remaining() > 0:
+        throughput[default_batch] = measure_batch(best_llm, prompt, new_tokens, default_batch)
+    _release(best_llm)
+
+    return {
+        "fingerprint": machine_fingerprint(info),
+        "hardware": info,
+        "objective": objective,
+        "settings": settings,
+        "baseline": _metrics(baseline),
+        "best": _metrics(best),
+        "batch_throughput": {str(size): round(value, 2) for size, value in sorted(throughput.items())},
+        "default_batch_size": default_batch,
+        "candidates": results,
+        "elapsed": round(time.perf_counter() - start, 1),
+        "tuned_at": datetime.now().isoformat(timespec="seconds")
+    }
+
+def _metrics(result):
+    return {key: round(result[key], 3) for key in ("prefill_ms", "decode_ms", "tokens_per_s")}
+
+def _describe(settings):
+    if not settings:
+        return "默认配置"
+    return ", ".join(f"{key}={value}" for key, value in settings.items())
+
+def _summary(result):
+    if "error" in result:
+        return f"失败（{result['error']}）"
+    return f"预填充 {result['prefill_ms']:.1f} ms, 解码 {result['decode_ms']:.2f} ms/token ({result['tokens_per_s']:.1f} tokens/s)"
+
+def print_report(record):
+    print(f"\n硬件指纹 {record['fingerprint']}: {record['hardware']['cpu']}, {record['hardware']['cpus']} CPU"
+          + (f", {record['hardware']['gpu']}" if record['hardware']['gpu'] else ""))
+    print("-" * 60)
+    for result in record["candidates"]:
+        print(f"{_describe(result['settings']):<60} {_summary(result)}")
+    baseline, best = record["baseline"], record["best"]
+    print("-" * 60)
+    print(f"最优配置: {_describe(record['settings'])}")
+    print(f"单请求解码: {baseline['tokens_per_s']:.1f} -> {best['tokens_per_s']:.1f} tokens/s "
+          f"({best['tokens_per_s'] / baseline['tokens_per_s']:.2f}x), "
+          f"预填充 {baseline['prefill_ms']:.1f} -> {best['prefill_ms']:.1f} ms")
+    throughput = record["batch_throughput"]
+    default = throughput.get(str(record["default_batch_size"]))
+    chosen = throughput[str(record["settings"]["batch_size"])]
+    print("批量吞吐: " + ", ".join(f"批大小{size} {value:.1f}" for size, value in throughput.items()) + " tokens/s")
+    if default:
+        print(f"批大小 {record['default_batch_size']}（默认） -> {record['settings']['batch_size']}: "
+              f"{default:.1f} -> {chosen:.1f} tokens/s")
+    print(f"调优耗时 {record['elapsed']:.0f} 秒")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="在当前硬件上自动调优推理配置")
+    parser.add_argument("model", help="config.MODEL_CONFIG 中的模型键，或模型目录")
+    parser.add_argument("--budget", type=float, default=None, help="时间预算（秒，默认 AUTOTUNE_CONFIG）")
+    parser.add_argument("--objective", choices=["latency", "throughput"], default="latency",
+                        help="批大小的选择目标：latency 选吞吐接近最高时最小的批大小，throughput 选吞吐最高的")
+    parser.add_argument("--include-compiled", action="store_true", help="同时测试编译后端（编译耗时较长）")
+    parser.add_argument("--dry-run", action="store_true", help="只输出结果，不保存")
+    args = parser.parse_args(argv)
+
+    model_path = resolve_model_path(args.model)
+    if not os.path.exists(model_path):
+        print(f"模型路径不存在: {model_path}")
+        return 1
+
+    try:
+        record = autotune(model_path, args.budget, args.objective, args.include_compiled)
+    except RuntimeError as e:
+        print(f"自动调优失败: {e}")
+        return 1
+    print_report(record)
+    if not args.dry_run:
+        path = save_profile(model_path, record)
+        if path:
+            print(f"已保存到 {path}，加载模型时自动应用（config.AUTOTUNE_CONFIG）")
+    return 0
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""
+推理后端：决定模型如何加载以及加载后的处理方式
+LocalLLM 的请求/响应和流式接口对所有后端相同，由 config.ENGINE_CONFIG["backend"] 选择
+"""
+import logging
+from config import ENGINE_CONFIG, COMPILE_CONFIG, STREAMING_CONFIG
+from placement import plan_placement, model_kwargs_from_plan, MODE_BYTES
+from artifacts import find_artifact
+
+logger = logging.getLogger(__name__)
+
+def _prefer_artifact(llm, placement, kwargs, mode):
+    """有匹配的预量化产物时从产物目录加载（量化参数已写在产物的config.json中）
+
+    只用于整模型放在同一设备上的情况；分层放置仍从源权重加载
+    """
+    if "" not in placement["device_map"]:
+        return placement, kwargs
+    artifact = find_artifact(llm.model_path, mode)
+    if artifact is None:
+        return placement, kwargs
+    logger.info(f"使用预量化产物: {artifact}")
+    kwargs = {key: value for key, value in kwargs.items() if key != "quantization_config"}
+    return {**placement, "artifact": artifact}, kwargs
+
+class EagerBackend:
+    """按放置计划选择精度/量化方式和逐层放置，eager模式解码"""
+
+    name = "eager"
+
+    def plan(self, llm):
+        """返回 (放置计划, from_pretrained 参数)；放置计划中的 "artifact" 为预量化产物目录"""
+        placement = plan_placement(llm.model_path)
+        # 自动调优选出的加载方式：只在整模型同一设备且占用不超过放置计划时替换
+        mode = (llm.profile or {}).get("mode")
+        if (mode in MODE_BYTES and mode != placement["mode"] and "" in placement["device_map"]
+                and MODE_BYTES[mode] <= MODE_BYTES.get(placement["mode"], 0)):
+            logger.info(f"按自动调优结果使用加载方式 {mode}（放置计划为 {placement['mode']}）")
+            placement = {**placement, "mode": mode}
+        if "disk" in placement["device_map"].values():
+            logger.info("部分权重需要放到磁盘，内存受限时可改用 streaming 后端（ENGINE_CONFIG）")
+        return _prefer_artifact(llm, placement, model_kwargs_from_plan(placement), placement["mode"])
+
+    def load(self, llm, model_kwargs):
+        """加载模型"""
+        from transformers import AutoModelForCausalLM
+        return AutoModelForCausalLM.from_pretrained(
+            llm.placement.get("artifact", llm.model_path),
+            **model_kwargs
+        )
+
+    def prepare(self, llm):
+        """模型加载完成后调用"""
+
+class CompiledBackend(EagerBackend):
+    """在eager后端的基础上启用静态KV缓存 + torch.compile"""
+
+    name = "compiled"
+
+    def prepare(self, llm):
+        llm.enable_compile()
+
+class QuantizedCPUBackend(EagerBackend):
+    """CPU上fp32加载后对线性层做int8动态量化（不依赖bitsandbytes，也不需要GPU）"""
+
+    name = "quantized_cpu"
+
+    def plan(self, llm):
+        import torch
+        placement = {"mode": "int8-dynamic", "device_map": {"": "cpu"}}
+        kwargs = {
+            "torch_dtype": torch.float32,
+            "device_map": "cpu",
+            "low_cpu_mem_usage": True
+        }
+        # fp32产物可以直接内存映射，省去每次启动时的精度转换
+        return _prefer_artifact(llm, placement, kwargs, "fp32")
+
+    def prepare(self, llm):
+        import torch
+        from torch.ao.quantization import quantize_dynamic
+        llm.model = quantize_dynamic(llm.model, {torch.nn.Linear}, dtype=torch.qint8)
+        logger.info("已对线性层进行int8动态量化")
+
+class StreamingBackend(EagerBackend):
+    """逐层流式推理：解码层权重留在内存映射的分片中，执行前读入、执行后释放（内存放不下整个模型时使用）"""
+
+    name = "streaming"
+
+    def plan(self, llm):
+        return {"mode": STREAMING_CONFIG["dtype"], "device_map": {"": "cpu"}, "streaming": True}, {}
+
+    def load(self, llm, model_kwargs):
+        from layer_streaming import load_streaming_model
+        return load_streaming_model(llm.model_path)
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (EagerBackend, CompiledBackend, QuantizedCPUBackend, StreamingBackend)
+}
+
+def get_backend(name=None):
+    """按名称创建后端；"auto" 在启用编译配置时使用编译后端，否则使用eager后端"""
+    name = name or ENGINE_CONFIG["backend"]
+    if name == "auto":
+        name = "compiled" if COMPILE_CONFIG["enabled"] else "eager"
+    if name not in BACKENDS:
+        raise ValueError(f"未知的推理后端: {name}（可选: {', '.join(BACKENDS)}）")
+    return BACKENDS[name]()
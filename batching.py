@@ -0,0 +1,503 @@
+"""
+请求调度与连续批处理：按优先级类别和用户公平份额挑选请求，以单个解码步为调度单位
+- 每个调度步先按token预算预填充新请求（长输入分块，每步一块），再为所有正在解码的请求各解码一个token
+- 预填充完成的请求把KV缓存并入正在解码的批次，结束的请求随时移出，新请求不必等整批结束
+- 同一批次中的请求可以使用不同的LoRA适配器和温度；交互请求在没有空位时抢占正在解码的批量请求
+编译模式（静态KV缓存）仍按整批调用 generate_batch
+启用语义缓存时，请求首次调度前先查缓存，命中的不占用批次直接完成
+"""
+import time
+import threading
+import logging
+from collections import deque, OrderedDict
+from concurrent.futures import Future
+from config import LORA_CONFIG, SCHEDULER_CONFIG
+from perf_monitor import get_monitor
+
+logger = logging.getLogger(__name__)
+
+# 优先级类别（按先后顺序调度）
+INTERACTIVE = "interactive"
+BATCH = "batch"
+CLASSES = (INTERACTIVE, BATCH)
+
+class _Job:
+    """一个排队中的请求；被抢占后保留已生成的部分回复，继续排队"""
+
+    def __init__(self, prompt, adapter, max_length, temperature, user, priority, prompt_tokens):
+        self.prompt = prompt
+        self.adapter = adapter
+        self.max_length = max_length
+        self.temperature = temperature
+        self.user = user
+        self.priority = priority
+        self.prompt_tokens = prompt_tokens
+        self.future = Future()
+        self.arrival = time.monotonic()
+        self.started = False
+        self.text = ""
+        self.generated = 0
+        self.prefill = None
+        self.tokens = []
+        self.first_token = None
+        self.last_token = None
+        self.decode_seconds = 0.0
+        # 语义缓存的键，完成后用于写回回答
+        self.cache_key = None
+
+    @property
+    def remaining(self):
+        return self.max_length - self.generated
+
+    @property
+    def cost(self):
+        """占用的token预算：输入 + 剩余最大输出"""
+        return self.prompt_tokens + self.generated + self.remaining
+
+    def key(self):
+        """整批解码时生成参数相同的请求才能合并到同一批次"""
+        return self.remaining, self.temperature
+
+def _percentile(values, q):
+    """已排序样本的分位数（毫秒）"""
+    return values[int(q * (len(values) - 1))] * 1000 if values else 0.0
+
+class MicroBatcher:
+    """在 LocalLLM 之前排队、调度并连续批处理并发请求
+
+    - 交互类请求总是先于批量类请求调度，没有空位时抢占解码了足够步数的批量请求
+    - 同一类别内按用户已使用的token数选择最少的用户（公平份额）
+    - 正在处理的请求 输入+最大输出 token总数不超过 max_tokens_in_flight
+    - 每个调度步最多处理 prefill_chunk_tokens 个token：每个解码中的请求1个，其余给预填充块（0 表示不限，
+      新请求的整个输入在一步内预填充）
+    """
+
+    def __init__(self, llm, max_batch_size=None, window_ms=None, max_tokens_in_flight=None, prefill_chunk_tokens=None):
+        self.llm = llm
+        # 自动调优（autotune.py）测得的最优批大小优先于配置默认值
+        profile = getattr(llm, "profile", None) or {}
+        self.max_batch_size = max_batch_size or profile.get("batch_size") or LORA_CONFIG["max_batch_size"]
+        self.window = (window_ms if window_ms is not None else LORA_CONFIG["batch_window_ms"]) / 1000
+        self.max_tokens_in_flight = max_tokens_in_flight or SCHEDULER_CONFIG["max_tokens_in_flight"]
+        self.preempt_min_tokens = SCHEDULER_CONFIG["preempt_min_tokens"]
+        self.prefill_chunk_tokens = (prefill_chunk_tokens if prefill_chunk_tokens is not None
+                                     else SCHEDULER_CONFIG["prefill_chunk_tokens"])
+
+        self._cond = threading.Condition()
+        self._queues = {cls: OrderedDict() for cls in CLASSES}
+        self._served = {}
+        self._pending = 0
+        self._running = 0
+        self._closed = False
+        # 连续批处理的状态，只在调度线程中修改
+        self._prefilling = deque()
+        self._decoding = []
+        self._batch = None
+        window = SCHEDULER_CONFIG["latency_window"]
+        self._latency = {cls: deque(maxlen=window) for cls in CLASSES}
+        self._first_token = {cls: deque(maxlen=window) for cls in CLASSES}
+        self._inter_token = {cls: deque(maxlen=window) for cls in CLASSES}
+        self.preemptions = 0
+        self.monitor = get_monitor()
+        if self.monitor is not None:
+            self.monitor.set_queue_source(self.stats)
+
+        self._thread = threading.Thread(target=self._loop, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def classify(max_length, priority=None):
+        """确定请求类别；超过交互长度上限的请求即使指定为交互也按批量处理"""
+        if priority == BATCH or int(max_length) > SCHEDULER_CONFIG["interactive_max_tokens"]:
+            return BATCH
+        return INTERACTIVE
+
+    def submit(self, prompt, adapter=None, max_length=512, temperature=0.7, user=None, priority=None):
+        """提交请求，返回Future；user 用于公平调度，priority 为 "interactive" 或 "batch" """
+        try:
+            prompt_tokens = self.llm.count_tokens(prompt)
+        except Exception:
+            prompt_tokens = len(prompt)
+        job = _Job(prompt, adapter, int(max_length), float(temperature), user,
+                   self.classify(max_length, priority), prompt_tokens)
+        # 从提交到完成都算作活动请求：排队和分块预填充的间隙中模型也不会被空闲卸载；
+        # 不在提交线程（通常是事件循环）中重新加载，模型已卸载时由调度线程开始预填充时加载
+        self.llm._begin_request(load=False)
+        with self._cond:
+            self._enqueue(job)
+            self._pending += 1
+            self._cond.notify()
+        return job.future
+
+    def stats(self):
+        """返回 (推理中, 排队中) 请求数"""
+        with self._cond:
+            return self._running, self._pending
+
+    def latency_report(self):
+        """各类别的延迟（毫秒）：排队延迟（提交到首次开始处理）p50/p95，
+        首token延迟（提交到第一个token）与token间隔的 p50/p99
+        """
+        with self._cond:
+            queued = {cls: sorted(values) for cls, values in self._latency.items()}
+            first = {cls: sorted(values) for cls, values in self._first_token.items()}
+            gaps = {cls: sorted(values) for cls, values in self._inter_token.items()}
+        return {
+            cls: {
+                "count": len(queued[cls]),
+                "p50": _percentile(queued[cls], 0.5),
+                "p95": _percentile(queued[cls], 0.95),
+                "ttft_p50": _percentile(first[cls], 0.5),
+                "ttft_p99": _percentile(first[cls], 0.99),
+                "itl_p50": _percentile(gaps[cls], 0.5),
+                "itl_p99": _percentile(gaps[cls], 0.99)
+            }
+            for cls in CLASSES
+        }
+
+    def close(self):
+        """处理完已提交的请求后停止"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _waiting(self, cls):
+        return any(self._queues[cls].values())
+
+    def _enqueue(self, job, front=False):
+        # 新变为活跃的用户从当前最小的已服务量开始计，不能用空闲期间攒下的额度抢占其他用户
+        if not any(job.user in queues and queues[job.user] for queues in self._queues.values()):
+            active = [self._served.get(user, 0) for queues in self._queues.values()
+                      for user, jobs in queues.items() if jobs]
+            floor = min(active) if active else 0
+            self._served[job.user] = max(self._served.get(job.user, 0), floor)
+        jobs = self._queues[job.priority].setdefault(job.user, deque())
+        if front:
+            jobs.appendleft(job)
+        else:
+            jobs.append(job)
+
+    def _users(self, cls):
+        """该类别中有请求在排队的用户，按已服务量从少到多"""
+        queues = self._queues[cls]
+        return sorted((user for user, jobs in queues.items() if jobs), key=lambda user: self._served.get(user, 0))
+
+    def _start(self, jobs):
+        """请求开始处理：记录排队延迟（调用方持有锁）"""
+        now = time.monotonic()
+        self._pending -= len(jobs)
+        self._running += len(jobs)
+        for job in jobs:
+            if not job.started:
+                job.started = True
+                self._latency[job.priority].append(now - job.arrival)
+                # 公平份额按实际使用的token计：首次调度计入输入长度
+                self._served[job.user] = self._served.get(job.user, 0) + job.prompt_tokens
+
+    def _finish(self, job):
+        """请求完成（调用方持有锁）"""
+        self._running -= 1
+        self.llm._end_request()
+        job.future.set_result(job.text.strip())
+        if self.monitor is not None:
+            self.monitor.record_request(job.priority, job.prompt_tokens, job.generated,
+                                        job.first_token or 0.0, job.decode_seconds)
+
+    def _record_token(self, job, now):
+        """记录一个token的时间（调用方持有锁）"""
+        if job.first_token is None:
+            job.first_token = now - job.arrival
+            self._first_token[job.priority].append(job.first_token)
+        elif job.last_token is not None:
+            gap = now - job.last_token
+            job.decode_seconds += gap
+            self._inter_token[job.priority].append(gap)
+        job.last_token = now
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._running and not self._closed:
+                    self._cond.wait()
+                if not self._pending and not self._running:
+                    break
+                idle = not self._running
+
+            # 空闲时等待一个时间窗口，合并同时到达的请求
+            if idle and self.window:
+                time.sleep(self.window)
+
+            if idle and self.llm.compiled:
+                self._run_batch()
+            else:
+                self._step()
+
+    # ---- 连续批处理（eager等动态KV缓存后端） ----
+
+    def _step(self):
+        """一个调度步：接纳新请求，在token预算内预填充，再为所有解码中的请求各解码一个token"""
+        self._admit()
+        budget = self.prefill_chunk_tokens
+        if budget:
+            # 解码的请求每个占1个token；预填充至少分到一半预算，保证长输入持续推进
+            budget = max(budget - len(self._decoding), budget // 2)
+        # 交互请求和剩余输入短的请求先预填充，短输入不必排在长输入的块后面；
+        # 尚未开始且能一次预填充完的输入合并为一次前向（填充浪费不超过1/4）
+        order = sorted(self._prefilling, key=lambda job: (CLASSES.index(job.priority), job.prefill.remaining))
+        group, chunks = [], []
+        for job in order:
+            if self.prefill_chunk_tokens and budget <= 0:
+                break
+            remaining = job.prefill.remaining
+            fits = not self.prefill_chunk_tokens or remaining <= budget
+            if fits and job.prefill.position == 0:
+                longest = max([remaining] + [other.prefill.remaining for other in group])
+                total = remaining + sum(other.prefill.remaining for other in group)
+                if (len(group) + 1) * longest <= 1.25 * total:
+                    group.append(job)
+                else:
+                    chunks.append((job, None))
+            else:
+                chunks.append((job, min(budget, remaining) if self.prefill_chunk_tokens else None))
+            if self.prefill_chunk_tokens:
+                budget -= min(budget, remaining)
+        steps = [(group, None)] if group else []
+        steps += [([job], chunk) for job, chunk in chunks]
+        for jobs, chunk in steps:
+            try:
+                if len(jobs) > 1:
+                    done = self.llm.prefill_batch([job.prefill for job in jobs])
+                else:
+                    done = self.llm.prefill_chunk(jobs[0].prefill, chunk)
+            except Exception as e:
+                logger.error(f"预填充失败: {e}")
+                for job in jobs:
+                    self._prefilling.remove(job)
+                self._fail(jobs, e)
+                continue
+            if done:
+                for job in jobs:
+                    self._prefilling.remove(job)
+                    self._join(job)
+        if self._decoding:
+            self._decode_step()
+
+    def _admit(self):
+        """有空位时按优先级和公平份额接纳排队的请求；交互请求在没有空位时抢占批量请求"""
+        admitted = []
+        with self._cond:
+            in_flight = sum(job.cost for job in self._decoding) + sum(job.cost for job in self._prefilling)
+            while len(self._decoding) + len(self._prefilling) + len(admitted) < self.max_batch_size:
+                cls = next((cls for cls in CLASSES if self._waiting(cls)), None)
+                if cls is None:
+                    break
+                queue = self._queues[cls][self._users(cls)[0]]
+                job = queue[0]
+                if in_flight and in_flight + job.cost > self.max_tokens_in_flight:
+                    break
+                queue.popleft()
+                admitted.append(job)
+                in_flight += job.cost
+            for cls in CLASSES:
+                for user in [user for user, jobs in self._queues[cls].items() if not jobs]:
+                    del self._queues[cls][user]
+            self._start(admitted)
+            if self._waiting(INTERACTIVE):
+                self._preempt()
+
+        for job in self._serve_cached(admitted):
+            try:
+                job.prefill = self.llm.begin_prefill(job.prompt, prefix=job.text, adapter=job.adapter)
+            except Exception as e:
+                logger.error(f"预填充失败: {e}")
+                self._fail([job], e)
+                continue
+            self._prefilling.append(job)
+
+    def _preempt(self):
+        """空位已满而交互请求在等待：让出解码了足够步数的批量请求（调用方持有锁）"""
+        if len(self._decoding) + len(self._prefilling) < self.max_batch_size:
+            return
+        rows = [row for row, job in enumerate(self._decoding)
+                if job.priority == BATCH and len(job.tokens) >= self.preempt_min_tokens]
+        if not rows:
+            return
+        row = max(rows, key=lambda row: self._served.get(self._decoding[row].user, 0))
+        job = self._decoding.pop(row)
+        self._batch.remove([row])
+        self._take_text(job)
+        job.last_token = None
+        # 保留已生成部分，排回该用户队列的最前面，重新调度时连同已生成部分一起预填充
+        self._enqueue(job, front=True)
+        self._running -= 1
+        self._pending += 1
+        self.preemptions += 1
+        logger.info("1 个批量请求被交互请求抢占，已生成部分保留后重新排队")
+
+    def _join(self, job):
+        """预填充完成的请求加入解码批次"""
+        if self._batch is None:
+            self._batch = self.llm.new_decode_batch()
+        self._batch.add(job.prefill, job.temperature, job.adapter)
+        job.prefill = None
+        self._decoding.append(job)
+
+    def _decode_step(self):
+        try:
+            tokens = self.llm.decode_step(self._batch)
+        except Exception as e:
+            logger.error(f"批量解码失败: {e}")
+            jobs, self._decoding, self._batch = self._decoding, [], None
+            self._fail(jobs, e)
+            return
+
+        eos_ids = self.llm._eos_ids()
+        now = time.monotonic()
+        finished = []
+        with self._cond:
+            for row, (job, token) in enumerate(zip(self._decoding, tokens)):
+                self._record_token(job, now)
+                if token not in eos_ids:
+                    job.tokens.append(token)
+                    job.generated += 1
+                    self._served[job.user] = self._served.get(job.user, 0) + 1
+                if token in eos_ids or job.remaining <= 0:
+                    finished.append(row)
+            done = [self._decoding[row] for row in finished]
+            self._decoding = [job for row, job in enumerate(self._decoding) if row not in finished]
+            for job in done:
+                self._take_text(job)
+                self._finish(job)
+        if finished:
+            self._batch.remove(finished)
+        self._remember(done)
+
+    def _take_text(self, job):
+        """把本次解码出的token转换为文本，接在已生成部分之后"""
+        if job.tokens:
+            job.text += self.llm.tokenizer.decode(job.tokens, skip_special_tokens=True)
+            job.tokens = []
+
+    def _serve_cached(self, jobs):
+        """首次调度的请求先查语义缓存，命中的直接完成；返回需要生成的请求"""
+        remaining = []
+        for job in jobs:
+            if job.text:
+                # 被抢占后重新调度，已经查过缓存
+                remaining.append(job)
+                continue
+            try:
+                cached, job.cache_key = self.llm.semantic_lookup(job.prompt, job.adapter, job.max_length, job.temperature)
+            except Exception as e:
+                logger.error(f"语义缓存查询失败: {e}")
+                self._fail([job], e)
+                continue
+            if cached is None:
+                remaining.append(job)
+                continue
+            with self._cond:
+                self._record_token(job, time.monotonic())
+                job.text = cached
+                job.cache_key = None
+                self._finish(job)
+        return remaining
+
+    def _remember(self, jobs):
+        """完成的请求写入语义缓存（在锁外进行，写满一批时会落盘）"""
+        for job in jobs:
+            self.llm.semantic_insert(job.cache_key, job.prompt, job.text.strip())
+
+    def _fail(self, jobs, error):
+        with self._cond:
+            self._running -= len(jobs)
+        for job in jobs:
+            self.llm._end_request()
+            job.prefill = None
+            job.future.set_exception(error)
+
+    # ---- 整批解码（编译模式） ----
+
+    def _take_batch(self):
+        """选出下一批：最高优先级类别中，按用户已服务量从少到多轮流取生成参数相同的请求"""
+        cls = next((cls for cls in CLASSES if self._waiting(cls)), None)
+        if cls is None:
+            return []
+        queues = self._queues[cls]
+
+        first = queues[self._users(cls)[0]].popleft()
+        batch, total = [first], first.cost
+        while len(batch) < self.max_batch_size:
+            added = False
+            for user in self._users(cls):
+                job = next((job for job in queues[user]
+                            if job.key() == first.key() and total + job.cost <= self.max_tokens_in_flight), None)
+                if job is None:
+                    continue
+                queues[user].remove(job)
+                batch.append(job)
+                total += job.cost
+                added = True
+                if len(batch) >= self.max_batch_size:
+                    break
+            if not added:
+                break
+
+        for user in [user for user, jobs in queues.items() if not jobs]:
+            del queues[user]
+        return batch
+
+    def _step_hook(self, cls, step_times):
+        """每个解码步之后调用：记录时间；批量请求解码足够步数后，若有交互请求在等待则让出"""
+        def should_stop():
+            step_times.append(time.monotonic())
+            return cls == BATCH and len(step_times) >= self.preempt_min_tokens and self._waiting(INTERACTIVE)
+        return should_stop
+
+    def _run_batch(self):
+        with self._cond:
+            batch = self._take_batch()
+            self._start(batch)
+        batch = self._serve_cached(batch)
+        if not batch:
+            return
+
+        first = batch[0]
+        step_times = []
+        try:
+            results = self.llm.generate_batch(
+                [job.prompt for job in batch],
+                adapters=[job.adapter for job in batch],
+                max_length=first.remaining,
+                temperature=first.temperature,
+                prefixes=[job.text for job in batch],
+                should_stop=self._step_hook(first.priority, step_times),
+                details=True
+            )
+        except Exception as e:
+            logger.error(f"批量生成失败: {e}")
+            self._fail(batch, e)
+            return
+
+        preempted = 0
+        done = []
+        with self._cond:
+            for job, result in zip(batch, results):
+                for now in step_times[:result["tokens"]]:
+                    self._record_token(job, now)
+                job.last_token = None
+                self._served[job.user] = self._served.get(job.user, 0) + result["tokens"]
+                job.text += result["text"]
+                job.generated += result["tokens"]
+                if result["finished"] or job.remaining <= 0:
+                    self._finish(job)
+                    done.append(job)
+                else:
+                    # 被抢占：保留已生成部分，排回该用户队列的最前面
+                    self._enqueue(job, front=True)
+                    self._running -= 1
+                    self._pending += 1
+                    preempted += 1
+        self._remember(done)
+        if preempted:
+            self.preemptions += 1
+            logger.info(f"{preempted} 个批量请求被交互请求抢占，已生成部分保留后重新排队")
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+本地大语言模型推理性能测试工具
+"""
+import sys
+import json
+import time
+import argparse
+import threading
+from pathlib import Path
+import numpy as np
+from local_llm_v2 import LocalLLM
+
+def build_prompt(llm, length):
+    """构造指定token长度的测试输入"""
+    unit = "请介绍一下人工智能的发展历史。"
+    text = unit
+    while len(llm.tokenizer(text).input_ids) < length:
+        text += unit
+    return text
+
+def time_generation(llm, prompt, new_tokens, **gen_kwargs):
+    """执行一次固定长度的生成，返回 (耗时秒数, 生成token数)"""
+    text = llm.tokenizer.apply_chat_template(
+        [{"role": "user", "content": prompt}],
+        tokenize=False,
+        add_generation_prompt=True
+    )
+    model_inputs = llm._encode(text)
+    gen_kwargs.setdefault("min_new_tokens", new_tokens)
+    start = time.perf_counter()
+    output = llm._generate(
+        model_inputs,
+        max_new_tokens=new_tokens,
+        do_sample=False,
+        pad_token_id=llm.tokenizer.eos_token_id,
+        **gen_kwargs
+    )
+    elapsed = time.perf_counter() - start
+    return elapsed, output.shape[1] - model_inputs.input_ids.shape[1]
+
+def run_suite(llm, prompts, new_tokens, runs):
+    """对每个输入长度重复测试，返回每token平均毫秒数"""
+    results = {}
+    for length, prompt in prompts.items():
+        per_token = []
+        for _ in range(runs):
+            elapsed, n_tokens = time_generation(llm, prompt, new_tokens)
+            per_token.append(elapsed / max(n_tokens, 1) * 1000)
+        results[length] = min(per_token)
+    return results
+
+def run_constrained(llm, prompt, new_tokens, regex=None, json_schema=None):
+    """测试约束解码：编译耗时、掩码开销与单步解码耗时的对比"""
+    from transformers import LogitsProcessorList
+    
+    start = time.perf_counter()
+    llm.constraint_processor(regex=regex, json_schema=json_schema)
+    build_time = time.perf_counter() - start
+    
+    processor = llm.constraint_processor(regex=regex, json_schema=json_schema)
+    text = llm.tokenizer.apply_chat_template(
+        [{"role": "user", "content": prompt}],
+        tokenize=False,
+        add_generation_prompt=True
+    )
+    model_inputs = llm._encode(text)
+    start = time.perf_counter()
+    llm._generate(
+        model_inputs,
+        max_new_tokens=new_tokens,
+        do_sample=False,
+        pad_token_id=llm.tokenizer.eos_token_id,
+        logits_processor=LogitsProcessorList([processor])
+    )
+    elapsed = time.perf_counter() - start
+    step_ms = elapsed / max(processor.steps, 1) * 1000
+    
+    print("\n约束解码")
+    print("-" * 40)
+    print(f"自动机编译: {build_time:.2f} 秒（之后命中缓存）")
+    print(f"生成步数:   {processor.steps}")
+    print(f"单步耗时:   {step_ms:8.2f} ms/token")
+    print(f"掩码开销:   {processor.mask_ms_per_token:8.3f} ms/token ({processor.mask_ms_per_token / step_ms * 100:.1f}%)")
+
+def run_best_of(llm, prompt, new_tokens, n):
+    """对比 n 次独立生成与共享前缀的 n 候选并行采样"""
+    start = time.perf_counter()
+    for _ in range(n):
+        llm.generate_response(prompt, max_length=new_tokens)
+    sequential = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    candidates = llm.generate_candidates(prompt, n=n, max_length=new_tokens)
+    forked = time.perf_counter() - start
+    
+    print(f"\n多候选采样 (n={n})")
+    print("-" * 40)
+    print(f"逐个生成:     {sequential:8.2f} 秒")
+    print(f"共享前缀并行: {forked:8.2f} 秒 (加速比 {sequential / forked:.2f}x)")
+    for i, candidate in enumerate(candidates, 1):
+        print(f"候选 {i}: 平均对数概率 {candidate['logprob']:.3f}, {candidate['tokens']} tokens")
+
+def run_trace(llm, prompt, new_tokens, top_k=5):
+    """逐token输出：对数概率和发出时间，找出最慢的token"""
+    result = llm.generate_response(prompt, max_length=new_tokens, details=True, top_logprobs=top_k)
+    if "error" in result:
+        print(f"\n逐token记录失败: {result['error']}")
+        return
+    times = result["times_ms"]
+    gaps = np.diff(times, prepend=0.0)
+    size = sum(value.nbytes for key, value in result.items() if key != "text")
+    
+    print("\n逐token记录")
+    print("-" * 40)
+    print(f"生成token数:  {len(times)}, 首token {times[0]:.1f} ms")
+    if len(gaps) > 1:
+        print(f"token间隔:    p50 {np.percentile(gaps[1:], 50):.2f} ms, p99 {np.percentile(gaps[1:], 99):.2f} ms, 最大 {gaps[1:].max():.2f} ms")
+    print(f"平均对数概率: {result['logprobs'].mean():.3f}")
+    print(f"记录大小:     {size} 字节 (top-{top_k})")
+    print("最慢的token:")
+    for index in np.argsort(gaps)[::-1][:5]:
+        token = llm.tokenizer.decode([int(result["token_ids"][index])])
+        print(f"  第 {index:4d} 个 {gaps[index]:8.2f} ms  logprob {result['logprobs'][index]:7.3f}  {token!r}")
+
+def run_chunked_prefill(llm, long_tokens, chunk_sizes, new_tokens, users=4):
+    """几个用户持续进行短对话时提交一个长输入，比较不同每步token预算下短对话的排队延迟、首token延迟和token间隔
+
+    长输入按批量类提交，延迟统计中的交互类只包含与它竞争的短对话；不分块时整段预填充的停顿
+    出现在当时正在解码的短对话的token间隔，以及当时排队的短对话的排队延迟和首token延迟中
+    """
+    from batching import MicroBatcher, INTERACTIVE, BATCH
+    
+    long_prompt = build_prompt(llm, long_tokens)
+    print(f"\n分块预填充 (长输入 {long_tokens} tokens, {users} 个短对话用户)")
+    print("-" * 40)
+    for chunk in chunk_sizes:
+        batcher = MicroBatcher(llm, prefill_chunk_tokens=chunk)
+        stop = threading.Event()
+        
+        def chat(user):
+            while not stop.is_set():
+                batcher.submit("你好", max_length=new_tokens, user=user).result()
+        
+        threads = [threading.Thread(target=chat, args=(f"short-{i}",), daemon=True) for i in range(users)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.5)
+        start = time.perf_counter()
+        batcher.submit(long_prompt, max_length=8, user="long", priority=BATCH).result()
+        elapsed = time.perf_counter() - start
+        time.sleep(0.2)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        batcher.close()
+        
+        report = batcher.latency_report()[INTERACTIVE]
+        label = f"每步 {chunk:>5}" if chunk else "不分块    "
+        print(f"{label}: 排队 p95 {report['p95']:7.1f} ms, 首token p50 {report['ttft_p50']:7.1f} / p99 {report['ttft_p99']:7.1f} ms, "
+              f"token间隔 p50 {report['itl_p50']:6.2f} / p99 {report['itl_p99']:7.2f} ms, 长输入完成 {elapsed:.2f} 秒")
+
+STOP_PROMPTS = [
+    "用Python写一个快速排序函数，只输出代码。",
+    "列出三种常见的排序算法，每行一个。",
+    "问：1加1等于几？\n答：",
+    "写一段JSON，包含name和age两个字段。"
+]
+
+def run_stop(llm, stop, new_tokens, prompts=STOP_PROMPTS):
+    """贪心解码下对比有无停止字符串时的生成token数和耗时，统计节省的token和匹配开销"""
+    from transformers import StoppingCriteriaList
+    from stop_sequences import StopSequenceCriteria
+    
+    print(f"\n停止序列 ({', '.join(repr(text) for text in stop)})")
+    print("-" * 40)
+    total_full, total_stopped, time_full, time_stopped, match_ms = 0, 0, 0.0, 0.0, []
+    for prompt in prompts:
+        full_time, full_tokens = time_generation(llm, prompt, new_tokens, min_new_tokens=0)
+        criteria = StopSequenceCriteria(llm.tokenizer, stop=stop)
+        stop_time, stop_tokens = time_generation(
+            llm, prompt, new_tokens, min_new_tokens=0, stopping_criteria=StoppingCriteriaList([criteria])
+        )
+        total_full, total_stopped = total_full + full_tokens, total_stopped + stop_tokens
+        time_full, time_stopped = time_full + full_time, time_stopped + stop_time
+        match_ms.append(criteria.match_ms_per_token)
+        hit = criteria.matches[0]["stop"] if criteria.rows and criteria.matches[0] else "-"
+        label = prompt[:16].replace("\n", " ")
+        print(f"{label:<16} {full_tokens:>5} -> {stop_tokens:>5} tokens  命中 {hit!r}")
+    saved = total_full - total_stopped
+    print(f"合计: {total_full} -> {total_stopped} tokens, 节省 {saved} ({saved / max(total_full, 1) * 100:.1f}%), "
+          f"耗时 {time_full:.2f} -> {time_stopped:.2f} 秒")
+    print(f"匹配开销: 平均 {sum(match_ms) / len(match_ms):.3f} ms/token")
+
+def print_results(title, results):
+    print(f"\n{title}")
+    print("-" * 40)
+    for length, ms in results.items():
+        print(f"输入长度 {length:>5}: {ms:8.2f} ms/token  ({1000 / ms:6.1f} tokens/s)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地大语言模型推理性能测试")
+    parser.add_argument("model_path", help="模型目录，例如 ./models/Qwen2-7B-Instruct")
+    parser.add_argument("--prompt-lengths", type=int, nargs="+", default=[32, 256], help="测试输入的token长度")
+    parser.add_argument("--new-tokens", type=int, default=64, help="每次生成的token数")
+    parser.add_argument("--runs", type=int, default=3, help="每组测试重复次数（取最优）")
+    parser.add_argument("--compile", action="store_true", help="同时测试编译解码模式并与eager对比")
+    parser.add_argument("--regex", default=None, help="测试约束解码使用的正则表达式")
+    parser.add_argument("--json-schema", default=None, help="测试约束解码使用的JSON Schema文件")
+    parser.add_argument("--trace", action="store_true", help="输出逐token的对数概率和发出时间")
+    parser.add_argument("--best-of", type=int, default=0, metavar="N", help="对比N次独立生成与共享前缀的N候选并行采样")
+    parser.add_argument("--long-prompt", type=int, default=0, metavar="TOKENS", help="测试并发短对话期间摄入长输入时短对话的延迟")
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[0, 512, 128], help="每个调度步的token预算（0 表示不分块）")
+    parser.add_argument("--stop", nargs="+", default=None, help="测试停止字符串节省的token数，例如 --stop '```' '\\n\\n'")
+    args = parser.parse_args(argv)
+    
+    if not Path(args.model_path).exists():
+        print(f"模型路径不存在: {args.model_path}")
+        return 1
+    
+    llm = LocalLLM(args.model_path, compile_mode=False)
+    if not llm.load_model():
+        print("模型加载失败")
+        return 1
+    
+    prompts = {length: build_prompt(llm, length) for length in args.prompt_lengths}
+    
+    # 预热一次，避免首次调用的初始化开销计入eager结果
+    time_generation(llm, prompts[args.prompt_lengths[0]], 4)
+    eager = run_suite(llm, prompts, args.new_tokens, args.runs)
+    print_results("Eager模式", eager)
+    
+    if args.regex or args.json_schema:
+        json_schema = None
+        if args.json_schema:
+            with open(args.json_schema, 'r', encoding='utf-8') as f:
+                json_schema = json.load(f)
+        run_constrained(
+            llm,
+            "请用JSON格式输出一个示例用户信息。",
+            args.new_tokens,
+            regex=args.regex,
+            json_schema=json_schema
+        )
+    
+    if args.trace:
+        run_trace(llm, prompts[max(args.prompt_lengths)], args.new_tokens)
+    
+    if args.best_of > 1:
+        run_best_of(llm, prompts[max(args.prompt_lengths)], args.new_tokens, args.best_of)
+    
+    if args.long_prompt:
+        run_chunked_prefill(llm, args.long_prompt, args.chunk_sizes, args.new_tokens)
+    
+    if args.stop:
+        # 命令行里的 \n 转义成换行
+        run_stop(llm, [text.replace("\\n", "\n").replace("\\t", "\t") for text in args.stop], args.new_tokens)
+    
+    if args.compile:
+        if not llm.enable_compile():
+            print("\n编译模式不可用，跳过对比")
+            return 0
+        
+        # 每个分桶的首次调用包含编译时间
+        compile_times = {}
+        for length, prompt in prompts.items():
+            elapsed, _ = time_generation(llm, prompt, args.new_tokens)
+            compile_times[length] = elapsed
+        
+        if not llm.compiled:
+            print("\n编译模式运行失败，已回退到eager模式")
+            return 0
+        
+        compiled = run_suite(llm, prompts, args.new_tokens, args.runs)
+        print_results("编译模式", compiled)
+        
+        print("\n编译时间与加速比")
+        print("-" * 40)
+        for length in prompts:
+            speedup = eager[length] / compiled[length]
+            print(f"输入长度 {length:>5}: 首次调用 {compile_times[length]:7.1f} 秒, 加速比 {speedup:.2f}x")
+    
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+"""
+Web对话的服务端会话：对话历史按会话ID保存在服务端，对话事件只接收新消息；
+聊天框由每个页面一个长期运行的事件在历史变化时推送（Gradio对同一事件的连续更新只发送差异，
+所以每轮只传输新增的一轮和回复，而不是在浏览器和服务端之间来回传完整历史）
+"""
+import time
+import asyncio
+import weakref
+import threading
+from collections import OrderedDict
+from config import CHAT_SESSION_CONFIG
+
+class ChatSession:
+    """一个会话的对话历史：[[用户消息, 回复], ...]，与Chatbot组件的值格式一致
+
+    version 在每次变化时加一；wait_changed() 供推送事件在事件循环中等待变化，
+    touch() 可以在任意线程调用（不在该事件循环线程时通过 call_soon_threadsafe 通知）
+    """
+    __slots__ = ("turns", "last_active", "version", "_changed", "_loop", "__weakref__")
+
+    def __init__(self):
+        self.turns = []
+        self.last_active = time.time()
+        self.version = 0
+        self._changed = None
+        self._loop = None
+
+    def append(self, message, response=""):
+        """追加一轮并返回它；并发请求各自通过 reply() 更新自己那一轮，不依赖序号"""
+        turn = [message, response]
+        self.turns.append(turn)
+        self.touch()
+        return turn
+
+    def reply(self, turn, response):
+        turn[1] = response
+        self.touch()
+
+    def clear(self):
+        self.turns.clear()
+        self.touch()
+
+    def trim(self, max_turns):
+        """只保留最近 max_turns 轮"""
+        if len(self.turns) > max_turns:
+            del self.turns[:len(self.turns) - max_turns]
+
+    def touch(self):
+        self.version += 1
+        if self._changed is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._changed.set()
+        elif not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._changed.set)
+
+    async def wait_changed(self, version, timeout):
+        """等待 version 之后的变化，超时返回False"""
+        if self._changed is None:
+            self._loop = asyncio.get_running_loop()
+            self._changed = asyncio.Event()
+        while self.version == version:
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+class ChatSessions:
+    """按会话ID保存 ChatSession；超出数量上限时淘汰最久未活动的会话，空闲超过 ttl 的会话被丢弃"""
+
+    def __init__(self, max_sessions=None, max_turns=None, ttl=None):
+        self.max_sessions = max_sessions or CHAT_SESSION_CONFIG["max_sessions"]
+        self.max_turns = max_turns or CHAT_SESSION_CONFIG["max_turns"]
+        self.ttl = ttl or CHAT_SESSION_CONFIG["ttl"]
+        self._sessions = OrderedDict()
+        # 推送事件先于第一次对话等待的会话：不占数量上限，第一次 get() 时启用；推送事件结束后自动释放
+        self._waiting = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, session_id):
+        """返回会话（不存在时创建），并刷新其活动时间"""
+        now = time.time()
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is None or now - session.last_active > self.ttl:
+                session = self._waiting.pop(session_id, None) or ChatSession()
+            session.last_active = now
+            self._sessions[session_id] = session
+            self._evict(now)
+            return session
+
+    def peek(self, session_id):
+        """返回会话但不刷新其活动时间，供推送事件等待变化（等待本身不算活动，空闲会话照常过期和淘汰）
+
+        会话不存在或已过期时返回一个尚未启用的空会话，下一次 get() 启用的就是它，等待它的推送事件随即被唤醒
+        """
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None and now - session.last_active > self.ttl:
+                del self._sessions[session_id]
+                session = None
+            if session is None:
+                session = self._waiting.get(session_id)
+                if session is None:
+                    session = self._waiting[session_id] = ChatSession()
+            return session
+
+    def append(self, session_id, message, response=""):
+        """向会话追加一轮，返回 (会话, 该轮)；超出 max_turns 时移除最早的轮"""
+        session = self.get(session_id)
+        with self._lock:
+            turn = session.append(message, response)
+            session.trim(self.max_turns)
+        return session, turn
+
+    def clear(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is not None:
+            session.clear()
+
+    def _evict(self, now):
+        # OrderedDict 按活动时间排列，最久未活动的在最前
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and now - session.last_active <= self.ttl:
+                break
+            del self._sessions[session_id]
@@ -1,7 +1,11 @@
 import os
 import sys
+import time
 from pathlib import Path
-from local_llm_v2 import LocalLLM
+from request_recorder import get_recorder
+from config import GENERATION_CONFIG, STREAMING_CONTEXT_CONFIG
+from model_manager import verify_model_files
+from perf_monitor import get_monitor
 
 def get_available_models():
     """获取已下载的模型列表"""
@@ -64,6 +68,14 @@ def check_model_files(model_path):
         print(f"警告：模型文件不完整，缺少: {missing_files}")
         print("建议重新下载模型")
         return False
+    
+    report = verify_model_files(model_path, full=False)
+    if not report["ok"]:
+        print("警告：模型文件已损坏:")
+        for problem in report["problems"]:
+            print(f"  - {problem}")
+        print("建议重新下载模型")
+        return False
     return True
 
 def main():
@@ -84,8 +96,9 @@ def main():
         if response.lower() not in ['y', 'yes']:
             return
     
-    # 初始化模型
+    # 初始化模型（torch/transformers 在选定模型后才导入，菜单可以立即显示）
     print(f"\n正在初始化模型: {Path(model_path).name}")
+    from local_llm_v2 import LocalLLM
     llm = LocalLLM(model_path)
     
     if not llm.load_model():
@@ -104,8 +117,12 @@ def main():
     print("\n模型准备就绪！开始对话...")
     print("-" * 50)
     
+    # 流式上下文：跨轮次保留KV缓存（只保留sink token和最近的窗口），适合长时间不关闭的对话
+    session = llm.start_session() if STREAMING_CONTEXT_CONFIG["enabled"] else None
+    
     # 对话循环
     conversation_history = []
+    monitor = get_monitor()
     
     while True:
         try:
@@ -127,6 +144,28 @@ def main():
                 print("clear - 清屏")
                 print("help - 显示此帮助")
                 print("history - 显示对话历史")
+                print("stats - 显示性能统计")
+                if session is not None:
+                    print("context - 显示上下文状态")
+                    print("reset - 开始新对话")
+                continue
+            
+            if user_input.lower() == 'stats':
+                print("\n" + (monitor.report() if monitor is not None else "性能监控未启用（config.MONITOR_CONFIG）"))
+                if llm.semantic_cache is not None:
+                    print(llm.semantic_cache.report())
+                continue
+            
+            if session is not None and user_input.lower() == 'context':
+                stats = session.stats()
+                print(f"\n上下文: {stats['turns']} 轮, 共 {stats['tokens_seen']} tokens, "
+                      f"缓存 {stats['cached_tokens']} tokens ({stats['cache_mb']:.1f} MB), 已丢弃 {stats['evicted_tokens']} tokens")
+                continue
+            
+            if session is not None and user_input.lower() == 'reset':
+                session.reset()
+                conversation_history.clear()
+                print("已开始新对话")
                 continue
             
             if user_input.lower() == 'history':
@@ -139,10 +178,41 @@ def main():
             if not user_input:
                 continue
             
-            # 生成回复
+            # 流式生成回复，边生成边输出
             print("助手: ", end="", flush=True)
-            response = llm.generate_response(user_input)
-            print(response)
+            arrival, start = time.time(), time.perf_counter()
+            chunks = []
+            first_chunk = None
+            stream = session.stream(user_input) if session is not None else llm.stream_response(user_input)
+            for chunk in stream:
+                if first_chunk is None:
+                    first_chunk = time.perf_counter()
+                chunks.append(chunk)
+                print(chunk, end="", flush=True)
+            end = time.perf_counter()
+            print()
+            response = "".join(chunks).strip()
+            
+            if monitor is not None and first_chunk is not None:
+                monitor.record_request(
+                    "terminal",
+                    llm.count_tokens(user_input),
+                    llm.count_tokens(response),
+                    first_chunk - start,
+                    end - first_chunk
+                )
+            
+            recorder = get_recorder()
+            if recorder is not None:
+                recorder.record(
+                    "terminal",
+                    arrival,
+                    user_input,
+                    llm.count_tokens(user_input),
+                    {"max_length": GENERATION_CONFIG["max_new_tokens"], "temperature": GENERATION_CONFIG["temperature"]},
+                    time.perf_counter() - start,
+                    output_tokens=llm.count_tokens(response)
+                )
             
             # 保存对话历史
             conversation_history.append((user_input, response))
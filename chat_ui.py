@@ -1,11 +1,35 @@
 import os
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import gradio as gr
-from download_model import LocalLLM
+from batching import MicroBatcher
+from config import SERVER_CONFIG, PRELOAD_CONFIG, GENERATION_CONFIG, MONITOR_CONFIG, CHAT_SESSION_CONFIG
+from model_preloader import ModelPreloader
+from request_recorder import get_recorder
+from perf_monitor import get_monitor
+from chat_sessions import ChatSessions
 
 class ChatUI:
-    def __init__(self):
+    def __init__(self, preloader=None):
         self.llm = None
         self.model_loaded = False
+        self.preloader = preloader
+        
+        # 推理在微批处理线程中排队执行，不占用Gradio的工作线程；
+        # 按请求类别和用户公平调度，并发请求会被合并为一个批次（可使用不同的LoRA适配器）
+        self.batcher = None
+        # 模型加载单独使用一个线程，加载期间已加载的模型仍可继续对话
+        self.load_executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="model-load"
+        )
+        self._loading = None
+        # 后台采样内存/显存/队列深度，性能面板只在页面打开时读取
+        self.monitor = get_monitor()
+        # 对话历史按会话保存在服务端，浏览器不必每次上传完整历史
+        self.sessions = ChatSessions()
         
     def get_available_models(self):
         """获取已下载的模型列表"""
@@ -16,59 +40,203 @@ class ChatUI:
         models = []
         for item in os.listdir(models_dir):
             model_path = os.path.join(models_dir, item)
-            if os.path.isdir(model_path):
+            # 跳过 .compile_cache 等缓存目录
+            if os.path.isdir(model_path) and not item.startswith("."):
                 models.append(os.path.basename(model_path))
         return models
     
-    def load_model(self, model_name, progress=gr.Progress()):
-        """加载选定的模型"""
+    def _set_llm(self, llm):
+        """切换到新模型；旧模型的批处理线程处理完已提交的请求后退出"""
+        old_batcher = self.batcher
+        self.llm = llm
+        self.batcher = MicroBatcher(llm)
+        self.model_loaded = True
+        if old_batcher is not None:
+            old_batcher.close()
+    
+    def adapter_choices(self):
+        """当前模型可用的LoRA适配器"""
+        choices = ["无（基础模型）"]
+        if self.llm is not None:
+            choices += self.llm.adapters.available()
+        return gr.Dropdown(choices=choices, value=choices[0])
+    
+    def _adopt_preloaded(self):
+        """预加载完成后接管模型（用户手动加载过则不覆盖）"""
+        if self.preloader is None or self.llm is not None:
+            return
+        if self.preloader.state == ModelPreloader.READY:
+            self._set_llm(self.preloader.llm)
+    
+    async def watch_preload(self):
+        """页面打开时持续显示预加载进度，直到就绪或失败"""
+        if self.preloader is None:
+            yield "请选择并加载模型"
+            return
+        
+        while not self.preloader.done:
+            yield self.preloader.status()
+            await asyncio.sleep(SERVER_CONFIG["status_poll_interval"])
+        self._adopt_preloaded()
+        yield self.preloader.status()
+    
+    def queue_status(self):
+        """获取当前推理队列状态"""
+        running, pending = self.batcher.stats() if self.batcher else (0, 0)
+        status = f"推理中: {running} | 排队中: {pending}"
+        if self.batcher is not None:
+            latency = self.batcher.latency_report()
+            status += f" | 排队p95 交互: {latency['interactive']['p95']:.0f}ms 批量: {latency['batch']['p95']:.0f}ms"
+        if self._loading:
+            status += f" | 正在加载: {self._loading}"
+        elif self.llm is not None and self.llm.unloaded:
+            status += " | 模型空闲已卸载，下次请求时自动加载"
+        return status
+    
+    def perf_report(self):
+        """性能面板内容"""
+        report = self.monitor.report() if self.monitor is not None else "性能监控未启用（config.MONITOR_CONFIG）"
+        if self.llm is not None and self.llm.semantic_cache is not None:
+            report += "\n" + self.llm.semantic_cache.report()
+        return report
+    
+    def _load_model_sync(self, model_path):
+        """在加载线程中创建并加载模型"""
+        # torch/transformers 在首次加载模型时才导入，界面可以更快显示
+        from local_llm_v2 import LocalLLM
+        
+        llm = LocalLLM(model_path)
+        if not llm.load_model():
+            return None
+        return llm
+    
+    async def load_model(self, model_name):
+        """加载选定的模型（在后台线程执行，不阻塞页面和其他对话）"""
         if not model_name:
-            return "请选择一个模型"
+            yield "请选择一个模型"
+            return
         
         model_path = os.path.join("./models", model_name)
         if not os.path.exists(model_path):
-            return f"模型路径不存在: {model_path}"
+            yield f"模型路径不存在: {model_path}"
+            return
+        
+        if self._loading:
+            yield f"模型 {self._loading} 正在加载中，请稍候"
+            return
+        
+        self._loading = model_name
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.load_executor, self._load_model_sync, model_path)
         
-        progress(0.1, desc="初始化模型...")
-        self.llm = LocalLLM(model_path)
+        elapsed = 0.0
+        interval = SERVER_CONFIG["status_poll_interval"]
+        try:
+            while not future.done():
+                yield f"正在加载模型 {model_name}... 已用时 {elapsed:.0f} 秒"
+                await asyncio.sleep(interval)
+                elapsed += interval
+            llm = await future
+        finally:
+            self._loading = None
         
-        progress(0.5, desc="加载模型文件...")
-        success = self.llm.load_model()
+        if llm is None:
+            yield f"模型 {model_name} 加载失败"
+            return
         
-        if success:
-            self.model_loaded = True
-            progress(1.0, desc="加载完成！")
-            return f"模型 {model_name} 加载成功！"
-        else:
-            self.model_loaded = False
-            return f"模型 {model_name} 加载失败"
+        # 加载完成后再替换，加载期间旧模型仍可服务
+        self._set_llm(llm)
+        yield f"模型 {model_name} 加载成功！"
     
-    def chat_response(self, message, history, temperature, max_length):
-        """生成聊天回复"""
+    async def chat_response(self, message, temperature, max_length, adapter=None, request: gr.Request = None):
+        """生成聊天回复（异步，推理在微批处理线程中执行；按会话公平调度）
+        
+        只接收新消息，回复写入服务端会话后由 watch_chat 推送到聊天框；
+        本事件只输出本轮回复（供API客户端使用）和队列状态
+        """
+        self._adopt_preloaded()
+        session_id = request.session_hash if request is not None else None
         if not self.model_loaded or self.llm is None:
-            return history + [("请先加载模型", "")]
+            if self.preloader is not None and not self.preloader.done:
+                _, turn = self.sessions.append(session_id, message, self.preloader.status())
+            else:
+                _, turn = self.sessions.append(session_id, "请先加载模型", "")
+            yield turn[1] or turn[0], self.queue_status()
+            return
         
         if not message.strip():
-            return history + [("", "请输入有效的消息")]
+            self.sessions.append(session_id, "", "请输入有效的消息")
+            yield "请输入有效的消息", self.queue_status()
+            return
         
-        # 生成回复
-        response = self.llm.generate_response(
-            message, 
-            max_length=max_length, 
-            temperature=temperature
-        )
+        # 先显示排队状态，页面立即得到响应
+        session, turn = self.sessions.append(session_id, message, "⏳ 正在排队...")
+        if adapter not in self.llm.adapters.available():
+            adapter = None
+        arrival, start = time.time(), time.perf_counter()
+        llm = self.llm
+        task = asyncio.wrap_future(self.batcher.submit(
+            message,
+            adapter=adapter,
+            max_length=max_length,
+            temperature=temperature,
+            user=session_id
+        ))
+        yield turn[1], self.queue_status()
         
-        # 更新历史记录
-        history.append((message, response))
-        return history
+        while not task.done():
+            await asyncio.sleep(SERVER_CONFIG["status_poll_interval"])
+            if not task.done():
+                yield gr.update(), self.queue_status()
+        
+        error = None
+        try:
+            response = task.result()
+        except Exception as e:
+            error = e
+            response = f"生成回复时出错: {e}"
+        
+        recorder = get_recorder()
+        if recorder is not None:
+            recorder.record(
+                "web",
+                arrival,
+                message,
+                llm.count_tokens(message),
+                {"max_length": int(max_length), "temperature": temperature, "adapter": adapter},
+                time.perf_counter() - start,
+                output_tokens=0 if error else llm.count_tokens(response),
+                error=error
+            )
+        
+        # 更新本轮回复
+        session.reply(turn, response)
+        yield response, self.queue_status()
     
-    def clear_chat(self):
-        """清空聊天记录"""
-        return []
+    async def watch_chat(self, request: gr.Request = None):
+        """每个页面一个长期运行的事件：会话历史变化时推送聊天框
+        
+        Gradio对同一事件的连续更新只发送与上一次的差异，页面打开后每轮只传输新增的一轮和回复；
+        会话因空闲被丢弃后换用新会话（此时推送一次完整值）。等待不刷新会话的活动时间
+        """
+        session_id = request.session_hash if request is not None else None
+        session, version = None, None
+        while True:
+            current = self.sessions.peek(session_id)
+            if current is not session:
+                session, version = current, None
+            if session.version != version:
+                version = session.version
+                yield session.turns
+            await session.wait_changed(version, CHAT_SESSION_CONFIG["watch_interval"])
+    
+    async def clear_chat(self, request: gr.Request = None):
+        """清空聊天记录（由 watch_chat 推送到聊天框）"""
+        self.sessions.clear(request.session_hash if request is not None else None)
 
-def create_interface():
+def create_interface(preloader=None):
     """创建Gradio界面"""
-    chat_ui = ChatUI()
+    chat_ui = ChatUI(preloader)
     
     with gr.Blocks(title="本地大语言模型对话", theme=gr.themes.Soft()) as interface:
         gr.Markdown("# 🤖 本地大语言模型对话系统")
@@ -86,11 +254,22 @@ def create_interface():
                     )
                     refresh_btn = gr.Button("🔄 刷新模型列表", size="sm")
                     load_btn = gr.Button("🚀 加载模型", variant="primary")
+                    adapter_dropdown = gr.Dropdown(
+                        choices=["无（基础模型）"],
+                        value="无（基础模型）",
+                        label="LoRA适配器",
+                        info="加载 ./models/<模型>/adapters 下的任务适配器"
+                    )
                     load_status = gr.Textbox(
                         label="加载状态",
                         interactive=False,
                         placeholder="请选择并加载模型"
                     )
+                    queue_status = gr.Textbox(
+                        label="队列状态",
+                        value=chat_ui.queue_status(),
+                        interactive=False
+                    )
                 
                 # 参数设置
                 with gr.Group():
@@ -98,7 +277,7 @@ def create_interface():
                     temperature = gr.Slider(
                         minimum=0.1, 
                         maximum=2.0, 
-                        value=0.7, 
+                        value=GENERATION_CONFIG["temperature"], 
                         step=0.1,
                         label="Temperature (创造性)",
                         info="值越高回复越有创造性"
@@ -106,12 +285,22 @@ def create_interface():
                     max_length = gr.Slider(
                         minimum=128, 
                         maximum=4096, 
-                        value=2048, 
+                        value=GENERATION_CONFIG["max_new_tokens"], 
                         step=128,
                         label="最大回复长度",
                         info="生成回复的最大token数"
                     )
             
+                # 性能面板：定时刷新，只读取后台采样的环形缓冲区
+                with gr.Accordion("📈 性能监控", open=False):
+                    gr.Textbox(
+                        value=chat_ui.perf_report,
+                        every=MONITOR_CONFIG["interval"],
+                        lines=6,
+                        show_label=False,
+                        interactive=False
+                    )
+            
             with gr.Column(scale=3):
                 # 聊天界面
                 gr.Markdown("### 💬 对话区域")
@@ -130,6 +319,8 @@ def create_interface():
                         container=False
                     )
                     send_btn = gr.Button("📤 发送", variant="primary", scale=1)
+                # 本轮回复：聊天框由 watch_chat 推送，这里只供API客户端（如 loadgen.py）读取
+                reply_output = gr.Textbox(visible=False)
                 
                 with gr.Row():
                     clear_btn = gr.Button("🗑️ 清空对话", variant="secondary")
@@ -158,18 +349,32 @@ def create_interface():
         refresh_btn.click(
             fn=lambda: gr.Dropdown(choices=chat_ui.get_available_models()),
             outputs=model_dropdown
+        ).then(
+            fn=chat_ui.adapter_choices,
+            outputs=adapter_dropdown
         )
         
         load_btn.click(
             fn=chat_ui.load_model,
             inputs=model_dropdown,
-            outputs=load_status
+            outputs=load_status,
+            concurrency_limit=SERVER_CONFIG["load_concurrency_limit"],
+            concurrency_id="load"
+        ).then(
+            fn=chat_ui.adapter_choices,
+            outputs=adapter_dropdown
         )
         
+        # 对话事件共享同一个并发上限，实际推理由推理线程池排队执行；
+        # 聊天框不作为输入或输出，历史保存在服务端会话中（按 session_hash），由 watch_chat 推送
+        # api_name 供 loadgen.py 等客户端调用（发送按钮与回车共用同一个接口名）
         msg_input.submit(
             fn=chat_ui.chat_response,
-            inputs=[msg_input, chatbot, temperature, max_length],
-            outputs=chatbot
+            inputs=[msg_input, temperature, max_length, adapter_dropdown],
+            outputs=[reply_output, queue_status],
+            concurrency_limit=SERVER_CONFIG["chat_concurrency_limit"],
+            concurrency_id="chat",
+            api_name="chat"
         ).then(
             lambda: "",
             outputs=msg_input
@@ -177,24 +382,71 @@ def create_interface():
         
         send_btn.click(
             fn=chat_ui.chat_response,
-            inputs=[msg_input, chatbot, temperature, max_length],
-            outputs=chatbot
+            inputs=[msg_input, temperature, max_length, adapter_dropdown],
+            outputs=[reply_output, queue_status],
+            concurrency_limit=SERVER_CONFIG["chat_concurrency_limit"],
+            concurrency_id="chat",
+            api_name=False
         ).then(
             lambda: "",
             outputs=msg_input
         )
         
-        clear_btn.click(
-            fn=chat_ui.clear_chat,
-            outputs=chatbot
-        )
+        clear_btn.click(fn=chat_ui.clear_chat)
+    
+    # 页面打开时显示默认模型的预加载状态
+    interface.load(
+        fn=chat_ui.watch_preload,
+        outputs=load_status
+    ).then(
+        fn=chat_ui.adapter_choices,
+        outputs=adapter_dropdown
+    )
+    
+    # 每个页面一个推送聊天框的长期事件，不受并发上限限制
+    interface.load(
+        fn=chat_ui.watch_chat,
+        outputs=chatbot,
+        concurrency_limit=None,
+        show_progress="hidden"
+    )
+    
+    # 显式配置队列，超出长度的请求直接拒绝而不是无限堆积
+    interface.queue(max_size=SERVER_CONFIG["queue_max_size"])
     
     return interface
 
-def main():
+def start_preload(model_key=None):
+    """在后台线程启动默认模型的预加载"""
+    try:
+        preloader = ModelPreloader(model_key).start()
+    except ValueError as e:
+        print(f"无法预加载: {e}")
+        return None
+    print(f"已在后台开始预加载模型: {preloader.model_name}")
+    return preloader
+
+def main(argv=None):
     """启动Web界面"""
+    parser = argparse.ArgumentParser(description="本地大语言模型Web界面")
+    parser.add_argument(
+        "--preload",
+        nargs="?",
+        const=PRELOAD_CONFIG["default_model"],
+        default=None,
+        metavar="MODEL_KEY",
+        help="启动时在后台预加载并预热模型（config.MODEL_CONFIG中的键）"
+    )
+    args = parser.parse_args(argv)
+    
+    preloader = None
+    model_key = args.preload or (PRELOAD_CONFIG["default_model"] if PRELOAD_CONFIG["enabled"] else None)
+    if model_key:
+        # 尽早启动预加载，与界面构建并行
+        preloader = start_preload(model_key)
+    
     print("正在启动Web界面...")
-    interface = create_interface()
+    interface = create_interface(preloader)
     
     # 启动服务器
     interface.launch(
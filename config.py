@@ -20,7 +20,8 @@ GENERATION_CONFIG = {
     "top_p": 0.9,
     "max_new_tokens": 2048,
     "do_sample": True,
-    "repetition_penalty": 1.1
+    "repetition_penalty": 1.1,
+    "stop": []  # 默认停止字符串，请求中的 stop 会覆盖它
 }
 
 # 量化配置
@@ -30,3 +31,145 @@ QUANTIZATION_CONFIG = {
     "bnb_4bit_use_double_quant": True,
     "bnb_4bit_quant_type": "nf4"
 }
+
+# Web服务并发配置
+SERVER_CONFIG = {
+    "chat_concurrency_limit": 8,    # 对话事件最大并发数
+    "load_concurrency_limit": 1,    # 加载模型事件最大并发数
+    "queue_max_size": 64,           # Gradio队列最大长度
+    "status_poll_interval": 0.5     # 等待期间刷新状态的间隔（秒）
+}
+
+# 启动预加载配置
+PRELOAD_CONFIG = {
+    "enabled": False,                       # 启动时是否在后台预加载默认模型
+    "default_model": "qwen2_7b",            # MODEL_CONFIG 中的键
+    "warmup_lengths": [16, 128, 512],       # 预热使用的输入长度
+    "warmup_new_tokens": 8                  # 每次预热生成的token数
+}
+
+# 编译解码配置（torch.compile + 静态KV缓存）
+COMPILE_CONFIG = {
+    "enabled": False,                                   # 默认使用eager模式
+    "mode": "reduce-overhead",                          # torch.compile 模式
+    "prompt_buckets": [64, 128, 256, 512, 1024, 2048],  # 输入长度分桶，同一桶复用编译图
+    "cache_dir": "./models/.compile_cache"              # 编译产物磁盘缓存目录
+}
+
+# 多进程服务配置（CPU多路服务器）
+WORKER_POOL_CONFIG = {
+    "num_workers": 2,               # 推理进程数，建议等于NUMA节点数
+    "host": "127.0.0.1",
+    "port": 8000,
+    "heartbeat_interval": 5,        # 工作进程心跳间隔（秒）
+    "heartbeat_timeout": 60,        # 超过该时间无心跳视为失联（秒）
+    "health_check_interval": 5,     # 健康检查间隔（秒）
+    "request_timeout": 600,         # 单个请求最长等待时间（秒）
+    "max_affinity_sessions": 10000  # 会话亲和表最多记录的会话数（超出时淘汰最久未使用的）
+}
+
+# LoRA适配器配置
+LORA_CONFIG = {
+    "adapters_dir": "adapters",     # 适配器目录：./models/<基础模型>/adapters/<适配器名>
+    "max_loaded_adapters": 4,       # 内存中最多保留的适配器数量（LRU淘汰）
+    "max_batch_size": 8,            # 一个解码批次最多合并的请求数
+    "batch_window_ms": 20           # 等待合并请求的时间窗口（毫秒）
+}
+
+# 语义缓存配置（近似重复问题直接返回缓存回答）
+SEMANTIC_CACHE_CONFIG = {
+    "enabled": False,
+    "threshold": 0.95,                          # 余弦相似度阈值
+    "capacity": 10000,                          # 最多缓存条数，超出后淘汰最久未命中的条目
+    "top_k": 5,
+    "path": "./models/.semantic_cache",         # 持久化目录
+    "encoder_path": None,                       # 可选的小型本地编码模型；为空时使用已加载模型的隐藏状态
+    "save_every": 50                            # 每新增多少条写一次磁盘
+}
+
+# 请求记录配置（用于性能回归时回放线上流量）
+RECORDER_CONFIG = {
+    "enabled": False,
+    "path": "./logs/requests.jsonl",    # 追加写入的记录文件
+    "redact": True                      # 只记录输入的哈希和长度，不保存原文
+}
+
+# 性能监控配置（Web界面的性能面板和终端的 stats 命令）
+MONITOR_CONFIG = {
+    "enabled": True,
+    "interval": 2.0,                # 采样间隔（秒）
+    "history": 300                  # 环形缓冲区保留的采样数 / 请求数
+}
+
+# 模型放置规划配置
+PLACEMENT_CONFIG = {
+    "headroom_ratio": 0.1,                  # 可用显存/内存中保留的余量比例
+    "kv_cache_tokens": 4096,                # 为KV缓存预留的上下文长度
+    "offload_folder": "./models/.offload"   # 放不下的层卸载到磁盘的目录
+}
+
+# 空闲资源释放配置
+IDLE_CONFIG = {
+    "enabled": False,
+    "trim_after": 300,          # 空闲多少秒后释放KV缓存和显存分配器缓存
+    "unload_after": 1800,       # 空闲多少秒后卸载模型权重（下次请求时自动重新加载）
+    "check_interval": 30        # 检查间隔（秒）
+}
+
+# 请求调度配置（优先级、用户公平、并发token预算）
+SCHEDULER_CONFIG = {
+    "interactive_max_tokens": 2048, # 回复长度不超过此值的请求默认归为交互类，否则为批量类
+    "max_tokens_in_flight": 16384,  # 同一批次内（输入+最大输出）token总数上限
+    "preempt_min_tokens": 32,       # 批量请求至少解码多少token后才允许被交互请求抢占
+    "prefill_chunk_tokens": 256,    # 每个调度步的token预算：解码中的请求各1个，其余给预填充块（0 表示不分块）；
+                                    # 用 benchmark.py --long-prompt 比较，GPU上通常可以设得更大
+    "latency_window": 1000          # 每类请求保留的排队延迟样本数
+}
+
+# 推理引擎配置
+ENGINE_CONFIG = {
+    "backend": "auto"               # eager / compiled / quantized_cpu / streaming；auto 按 COMPILE_CONFIG 选择
+}
+
+# 预量化产物配置（一次量化，之后直接加载）
+ARTIFACT_CONFIG = {
+    "dir": "quantized",             # 产物目录：./models/<模型>/quantized/<加载方式>/
+    "prefer_artifacts": True,       # 加载模型时优先使用匹配的预量化产物
+    "max_shard_size": "2GB"
+}
+
+# 逐层流式推理配置（内存放不下整个模型时使用 streaming 后端）
+STREAMING_CONFIG = {
+    "dtype": "bfloat16",            # 计算精度；每层权重从内存映射的分片读取后转换为该精度
+    "prefetch_layers": 1            # 当前层计算时在后台线程预读的后续层数
+}
+
+# 流式上下文配置（长时间对话只保留开头的sink token和最近的窗口）
+STREAMING_CONTEXT_CONFIG = {
+    "enabled": False,               # 终端对话是否使用流式上下文（跨轮次保留KV缓存）
+    "sink_tokens": 4,               # 始终保留的开头token数
+    "window_tokens": 4096           # 保留的最近token数
+}
+
+# 模型完整性校验配置
+VERIFY_CONFIG = {
+    "preflight": True,              # 加载模型前先做快速校验（文件头、缺失分片、已变化文件的哈希）
+    "hash_workers": 4               # 并行计算哈希的线程数
+}
+
+# Web对话会话配置（对话历史保存在服务端，按会话ID索引）
+CHAT_SESSION_CONFIG = {
+    "max_sessions": 256,            # 最多保留的会话数，超出时淘汰最久未活动的
+    "max_turns": 200,               # 每个会话保留的最近轮数
+    "ttl": 3600,                    # 会话空闲超过该秒数后丢弃
+    "watch_interval": 30            # 推送聊天框的事件无变化时重新检查会话的间隔（秒）
+}
+
+# 硬件自动调优配置（python autotune.py <模型>）
+AUTOTUNE_CONFIG = {
+    "apply": True,                  # 加载模型时自动应用当前硬件上保存的调优结果
+    "budget_seconds": 600,          # 调优的时间预算
+    "prompt_tokens": 128,           # 测试输入的token长度
+    "new_tokens": 32,               # 每次测试生成的token数
+    "batch_sizes": [1, 2, 4, 8]     # 测试的批大小
+}
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+推理后端一致性检查
+用一个小模型依次加载各个后端，检查请求/响应、批量、流式和约束解码接口的行为是否一致
+
+用法: python conformance.py <模型目录> [--backends eager compiled quantized_cpu]
+"""
+import re
+import sys
+import json
+import time
+import argparse
+import traceback
+from backends import BACKENDS
+
+PROMPT = "你好，请介绍一下你自己。"
+MAX_NEW_TOKENS = 8
+
+def check_generate(llm):
+    response = llm.generate_response(PROMPT, max_length=MAX_NEW_TOKENS)
+    assert isinstance(response, str), "generate_response 应返回字符串"
+    assert not response.startswith("错误"), response
+
+def check_batch(llm):
+    responses = llm.generate_batch([PROMPT, "1+1等于几？"], max_length=MAX_NEW_TOKENS)
+    assert len(responses) == 2 and all(isinstance(r, str) for r in responses), "批量结果数量或类型不对"
+    details = llm.generate_batch([PROMPT], max_length=MAX_NEW_TOKENS, details=True)[0]
+    assert set(details) == {"text", "tokens", "finished"}, f"details 字段不对: {details}"
+    assert 0 < details["tokens"] <= MAX_NEW_TOKENS
+
+def check_preempt(llm):
+    # should_stop 立即返回True时只解码一步
+    result = llm.generate_batch([PROMPT], max_length=MAX_NEW_TOKENS, should_stop=lambda: True, details=True)[0]
+    assert result["tokens"] <= 1, f"should_stop 未生效: {result}"
+
+def check_stream(llm):
+    chunks = list(llm.stream_response(PROMPT, max_length=MAX_NEW_TOKENS))
+    text = "".join(chunks)
+    assert chunks and "错误" not in text, f"流式输出异常: {text!r}"
+
+def check_regex(llm):
+    pattern = r"[0-9]{1,3}"
+    response = llm.generate_response(PROMPT, max_length=6, regex=pattern)
+    assert response, "约束解码输出为空"
+    assert re.fullmatch(pattern, response), f"约束解码输出不符合正则: {response!r}"
+
+def check_json(llm):
+    schema = {"type": "object", "properties": {"ok": {"type": "boolean"}}, "required": ["ok"]}
+    response = llm.generate_response(PROMPT, max_length=32, json_schema=schema)
+    assert response, "约束解码输出为空"
+    try:
+        value = json.loads(response)
+    except ValueError:
+        raise AssertionError(f"约束解码输出不是合法JSON: {response!r}")
+    assert isinstance(value, dict), f"约束解码输出不是JSON对象: {response!r}"
+    missing = [key for key in schema["required"] if key not in value]
+    assert not missing, f"约束解码输出缺少必需属性 {missing}: {response!r}"
+    assert isinstance(value["ok"], bool), f"属性类型不符合schema: {response!r}"
+
+def check_prefill(llm):
+    # 编译模式不使用分块预填充
+    if llm.compiled:
+        return
+    state = llm.begin_prefill(PROMPT * 8)
+    while not llm.prefill_chunk(state, 16):
+        pass
+    result = llm.generate_prefilled(state, max_length=MAX_NEW_TOKENS)
+    assert set(result) == {"text", "tokens", "finished"}, f"details 字段不对: {result}"
+    assert 0 < result["tokens"] <= MAX_NEW_TOKENS
+
+def check_decode_batch(llm):
+    # 连续批处理：分块预填充和合并预填充的请求先后加入解码批次，结束的行随时移除
+    if llm.compiled:
+        return
+    batch = llm.new_decode_batch()
+    state = llm.begin_prefill(PROMPT * 8)
+    while not llm.prefill_chunk(state, 16):
+        pass
+    batch.add(state, 0.7)
+    tokens = llm.decode_step(batch)
+    states = [llm.begin_prefill(PROMPT), llm.begin_prefill("1+1等于几？")]
+    llm.prefill_batch(states)
+    for state in states:
+        batch.add(state, 0.7)
+    tokens = llm.decode_step(batch)
+    assert len(tokens) == 3, f"解码批次行数不对: {tokens}"
+    batch.remove([0])
+    assert len(batch) == 2 and len(llm.decode_step(batch)) == 2, "移除行后解码异常"
+
+def check_reload(llm):
+    assert llm.unload_model(), "卸载失败"
+    check_generate(llm)
+    assert not llm.unloaded, "请求后未重新加载"
+
+CHECKS = [
+    ("generate", check_generate),
+    ("batch", check_batch),
+    ("preempt", check_preempt),
+    ("prefill", check_prefill),
+    ("decode_batch", check_decode_batch),
+    ("stream", check_stream),
+    ("regex", check_regex),
+    ("json_schema", check_json),
+    ("reload", check_reload)
+]
+
+def run_backend(model_path, backend):
+    """返回 [(检查名, 是否通过, 耗时, 错误信息)]"""
+    from local_llm_v2 import LocalLLM
+
+    llm = LocalLLM(model_path, backend=backend)
+    start = time.perf_counter()
+    if not llm.load_model():
+        return [("load", False, time.perf_counter() - start, "模型加载失败")]
+    results = [("load", True, time.perf_counter() - start, "")]
+    for name, check in CHECKS:
+        start = time.perf_counter()
+        try:
+            check(llm)
+            results.append((name, True, time.perf_counter() - start, ""))
+        except Exception as e:
+            traceback.print_exc()
+            results.append((name, False, time.perf_counter() - start, str(e)))
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="推理后端一致性检查")
+    parser.add_argument("model_path", help="用于检查的模型目录（建议使用很小的模型）")
+    parser.add_argument("--backends", nargs="+", choices=list(BACKENDS), default=list(BACKENDS), help="要检查的后端")
+    args = parser.parse_args(argv)
+
+    import torch
+    torch.manual_seed(0)
+
+    failed = 0
+    for backend in args.backends:
+        print(f"\n=== {backend} ===")
+        for name, ok, elapsed, error in run_backend(args.model_path, backend):
+            print(f"{'通过' if ok else '失败'}  {name:12s} {elapsed:6.2f}s  {error}")
+            failed += not ok
+    print(f"\n共 {failed} 项失败" if failed else "\n全部通过")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
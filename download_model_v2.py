@@ -4,6 +4,7 @@ import time
 import logging
 from pathlib import Path
 from huggingface_hub import snapshot_download
+from model_manager import verify_model_files
 
 # 设置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -62,9 +63,14 @@ def check_model_integrity(model_dir):
     if missing_files:
         logger.warning(f"缺少文件: {missing_files}")
         return False
-    else:
-        logger.info("模型文件检查完整")
-        return True
+    
+    # 检查分片是否完整并计算哈希（结果写入清单，之后加载时只需比对文件大小和修改时间）
+    report = verify_model_files(model_dir, full=True)
+    if not report["ok"]:
+        logger.warning(f"模型文件损坏: {report['problems']}")
+        return False
+    logger.info(f"模型文件检查完整（耗时 {report['elapsed']:.1f} 秒）")
+    return True
 
 def main():
     print("=== 稳定模型下载工具 ===")
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Web对话协议的负载评估：在一段多轮对话上比较两种事件处理方式每轮传输的字节数和处理耗时
+- 完整历史：聊天框同时作为输入和输出，每次请求上传完整历史，每次更新返回完整历史（改动前的 chat_response）
+- 服务端会话：只上传新消息，历史保存在 chat_sessions.ChatSessions，对话事件只返回本轮回复，
+  聊天框由每个页面一个长期运行的推送事件更新（现在的 chat_response + watch_chat）
+
+Gradio的流式协议对同一事件的连续更新只发送与上一次更新的差异（见 diff()），两种方式都按此计算下行字节数。
+处理耗时包含请求的JSON解析、处理函数本身和每次更新的JSON序列化（含推送事件的差异计算），不含模型推理
+
+用法: python eval_chat_payload.py [--turns 100] [--polls 4] [--reply-chars 300]
+"""
+import sys
+import json
+import time
+import random
+import argparse
+from chat_sessions import ChatSessions
+
+QUEUED = "⏳ 正在排队..."
+UPDATE = {"__type__": "update"}
+
+def diff(old, new, path=None):
+    """与Gradio流式更新相同的差异格式：[(操作, 路径, 值)]，字符串延长时只发送新增部分"""
+    path = path or []
+    if old == new:
+        return []
+    if type(old) is not type(new):
+        return [("replace", path, new)]
+    if isinstance(old, str) and new.startswith(old):
+        return [("append", path, new[len(old):])]
+    if isinstance(old, list):
+        edits = []
+        for index in range(min(len(old), len(new))):
+            edits.extend(diff(old[index], new[index], path + [index]))
+        edits.extend(("delete", path + [index], None) for index in range(len(new), len(old)))
+        edits.extend(("add", path + [index], new[index]) for index in range(len(old), len(new)))
+        return edits
+    return [("replace", path, new)]
+
+def encode(payload):
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+def legacy_handler(message, history, reply, polls):
+    """改动前的处理函数：输入完整历史，每次更新都返回完整历史"""
+    history = history + [(message, QUEUED)]
+    yield history
+    for _ in range(polls):
+        yield history
+    history[-1] = (message, reply)
+    yield history
+
+class Watcher:
+    """推送事件：会话变化时发送与上一次推送的差异（整个页面生命周期内是同一个事件）"""
+
+    def __init__(self, session):
+        self.session = session
+        self.previous = None
+        self.download = 0
+
+    def push(self):
+        # 与客户端当前值比较时需要独立的副本（会话历史被原地修改）
+        value = json.loads(encode(self.session.turns))
+        payload = value if self.previous is None else diff(self.previous, value)
+        self.previous = value
+        self.download += len(encode(payload))
+
+def session_handler(sessions, session_id, message, reply, polls, watcher):
+    """服务端会话：只输入新消息，只输出本轮回复；会话每次变化时推送事件发送差异"""
+    session, turn = sessions.append(session_id, message, QUEUED)
+    watcher.push()
+    yield turn[1]
+    for _ in range(polls):
+        yield UPDATE
+    session.reply(turn, reply)
+    watcher.push()
+    yield reply
+
+def run_event(outputs, request, watcher=None):
+    """模拟一次事件：解析请求，逐个序列化更新（第一次为完整值，之后为差异），返回 (上行字节, 下行字节, 耗时)"""
+    start = time.perf_counter()
+    pushed = watcher.download if watcher else 0
+    upload = len(request)
+    json.loads(request)
+    download, previous = 0, None
+    for output in outputs():
+        if output is UPDATE:
+            payload = output
+        else:
+            value = json.loads(encode(output))
+            payload = value if previous is None else diff(previous, value)
+            previous = value
+        download += len(encode(payload))
+    if watcher:
+        download += watcher.download - pushed
+    return upload, download, time.perf_counter() - start
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Web对话协议负载评估（完整历史 vs 服务端会话）")
+    parser.add_argument("--turns", type=int, default=100, help="对话轮数")
+    parser.add_argument("--polls", type=int, default=4, help="每轮排队/推理期间的状态刷新次数")
+    parser.add_argument("--message-chars", type=int, default=40, help="每条用户消息的字符数")
+    parser.add_argument("--reply-chars", type=int, default=300, help="每条回复的字符数")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    alphabet = "人工智能的发展历史可以追溯到上世纪五十年代。，"
+    text = lambda length: "".join(rng.choice(alphabet) for _ in range(length))
+    conversation = [(text(args.message_chars), text(args.reply_chars)) for _ in range(args.turns)]
+
+    sessions = ChatSessions(max_turns=args.turns)
+    watcher = Watcher(sessions.get("eval"))
+    watcher.push()
+    history = []
+    legacy, session = [], []
+    for message, reply in conversation:
+        request = encode({"data": [message, history, 0.7, 512, None]})
+        outputs = lambda: legacy_handler(message, history, reply, args.polls)
+        legacy.append(run_event(outputs, request))
+        history = history + [(message, reply)]
+
+        request = encode({"data": [message, 0.7, 512, None]})
+        outputs = lambda: session_handler(sessions, "eval", message, reply, args.polls, watcher)
+        session.append(run_event(outputs, request, watcher))
+
+    print(f"{args.turns} 轮对话, 每轮 {args.polls} 次状态刷新, 消息 {args.message_chars} 字, 回复 {args.reply_chars} 字")
+    print(f"{'轮次':>6} {'完整历史 上行/下行 字节  耗时ms':>34} {'服务端会话 上行/下行 字节  耗时ms':>36}")
+    for index in sorted({0, args.turns // 2 - 1, args.turns - 1}):
+        (lu, ld, lt), (su, sd, st) = legacy[index], session[index]
+        print(f"{index + 1:>6} {lu:>12} {ld:>10} {lt * 1000:>9.3f} {su:>14} {sd:>10} {st * 1000:>9.3f}")
+    totals = [tuple(sum(column) for column in zip(*results)) for results in (legacy, session)]
+    (lu, ld, lt), (su, sd, st) = totals
+    print(f"{'合计':>6} {lu:>12} {ld:>10} {lt * 1000:>9.1f} {su:>14} {sd:>10} {st * 1000:>9.1f}")
+    print(f"\n总传输: {(lu + ld) / 1024:.1f} KB -> {(su + sd) / 1024:.1f} KB ({(lu + ld) / max(su + sd, 1):.1f}x), "
+          f"处理耗时: {lt * 1000:.1f} ms -> {st * 1000:.1f} ms")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
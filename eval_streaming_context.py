@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+流式上下文评估：在一段很长的合成多轮对话上逐token送入模型（teacher forcing），
+比较完整KV缓存、sink+滑动窗口、不带sink的滑动窗口三种方式在各段上的困惑度、每token耗时和KV缓存大小
+
+用法: python eval_streaming_context.py <模型目录> [--tokens 20000] [--window 1024] [--sink 4]
+"""
+import sys
+import math
+import time
+import random
+import argparse
+import torch
+
+QUESTIONS = [
+    "请介绍一下人工智能的发展历史。",
+    "今天天气怎么样？适合出去散步吗？",
+    "帮我写一首关于秋天的短诗。",
+    "Python中列表和元组有什么区别？",
+    "如何提高睡眠质量？",
+    "解释一下什么是量子计算。",
+    "推荐几本适合入门的经济学书籍。",
+    "我们刚才聊到哪里了？请总结一下。"
+]
+ANSWERS = [
+    "好的，这个问题可以从几个方面来看。首先需要了解基本概念，然后结合具体的例子来理解。",
+    "根据一般经验，建议先做好准备，再根据实际情况灵活调整。",
+    "简单来说，两者的主要区别在于是否可以修改，以及适用的场景不同。",
+    "当然可以。下面是一些建议，希望对你有帮助：保持规律作息，适量运动，注意饮食。",
+    "这是一个很有意思的问题。历史上有很多人研究过它，目前仍在不断发展。"
+]
+
+def build_conversation(tokenizer, tokens, seed=0):
+    """生成至少 tokens 个token的多轮对话"""
+    rng = random.Random(seed)
+    messages = [{"role": "system", "content": "你是一个有用的AI助手。"}]
+    ids = []
+    while len(ids) < tokens:
+        for _ in range(20):
+            messages.append({"role": "user", "content": rng.choice(QUESTIONS)})
+            messages.append({"role": "assistant", "content": " ".join(rng.sample(ANSWERS, 3))})
+        ids = tokenizer.apply_chat_template(messages, tokenize=True, return_dict=True)["input_ids"]
+    return torch.tensor([ids[:tokens]])
+
+def evaluate(llm, input_ids, sink_tokens, window_tokens, segment):
+    """逐token送入，返回每段的 (困惑度, 每token毫秒, 段末KV缓存MB)"""
+    session = llm.start_session(sink_tokens=sink_tokens, window_tokens=window_tokens)
+    input_ids = input_ids.to(llm.model.device)
+    results = []
+    nll, elapsed = 0.0, 0.0
+    for position in range(input_ids.shape[1] - 1):
+        start = time.perf_counter()
+        logits = session.feed(input_ids[:, position:position + 1])[0, -1]
+        elapsed += time.perf_counter() - start
+        nll -= torch.log_softmax(logits.float(), dim=-1)[input_ids[0, position + 1]].item()
+        if (position + 1) % segment == 0:
+            results.append((math.exp(nll / segment), elapsed / segment * 1000, session.stats()["cache_mb"]))
+            nll, elapsed = 0.0, 0.0
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="流式上下文（attention sinks + 滑动窗口）评估")
+    parser.add_argument("model_path", help="模型目录（建议使用很小的模型）")
+    parser.add_argument("--tokens", type=int, default=20000, help="合成对话的token数")
+    parser.add_argument("--window", type=int, default=1024, help="滑动窗口token数")
+    parser.add_argument("--sink", type=int, default=4, help="sink token数")
+    parser.add_argument("--segment", type=int, default=2000, help="每段统计的token数")
+    args = parser.parse_args(argv)
+
+    from local_llm_v2 import LocalLLM
+    llm = LocalLLM(args.model_path, backend="eager")
+    if not llm.load_model():
+        print("模型加载失败")
+        return 1
+
+    input_ids = build_conversation(llm.tokenizer, args.tokens)
+    methods = [
+        ("完整缓存", 0, args.tokens * 2),
+        (f"sink{args.sink}+窗口", args.sink, args.window),
+        ("仅窗口", 0, args.window)
+    ]
+    results = {}
+    for name, sink, window in methods:
+        print(f"正在评估: {name} ...")
+        results[name] = evaluate(llm, input_ids, sink, window, args.segment)
+
+    print(f"\n合成对话 {input_ids.shape[1]} tokens, 窗口 {args.window}, sink {args.sink}")
+    print(f"{'段末位置':>8} " + " ".join(f"{name:>28}" for name, _, _ in methods))
+    print(f"{'':>8} " + " ".join(f"{'困惑度  ms/token  缓存MB':>28}" for _ in methods))
+    for index in range(len(results[methods[0][0]])):
+        row = [results[name][index] for name, _, _ in methods]
+        print(f"{(index + 1) * args.segment:>8} " + " ".join(
+            f"{ppl:10.2f} {ms:9.2f} {mb:8.2f}" for ppl, ms, mb in row))
+
+    # 困惑度漂移：最后一段相对第一段的变化
+    print("\n困惑度漂移（最后一段 / 第一段）:")
+    for name, _, _ in methods:
+        first, last = results[name][0][0], results[name][-1][0]
+        print(f"  {name}: {last / first:.3f}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,550 @@
+"""
+约束解码：把正则表达式或JSON Schema编译为词表上的token级自动机
+生成时每一步用预先计算好的布尔掩码屏蔽非法token
+"""
+import re
+import sys
+import json
+import time
+import threading
+import logging
+from collections import OrderedDict
+import torch
+from transformers import LogitsProcessor
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------------
+# 正则表达式 -> NFA
+# ---------------------------------------------------------------------------
+
+class _CharClass:
+    """字符集合：若干字符区间，可取反"""
+
+    def __init__(self, ranges, negated=False):
+        self.ranges = ranges
+        self.negated = negated
+
+    def matches(self, ch):
+        code = ord(ch)
+        hit = any(lo <= code <= hi for lo, hi in self.ranges)
+        return hit != self.negated
+
+def _literal(ch):
+    return _CharClass([(ord(ch), ord(ch))])
+
+_DIGIT = [(ord("0"), ord("9"))]
+_WORD = [(ord("a"), ord("z")), (ord("A"), ord("Z")), (ord("0"), ord("9")), (ord("_"), ord("_"))]
+_SPACE = [(ord(c), ord(c)) for c in " \t\n\r\f\v"]
+_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v"}
+_SHORTHANDS = {"d": (_DIGIT, False), "D": (_DIGIT, True), "w": (_WORD, False),
+               "W": (_WORD, True), "s": (_SPACE, False), "S": (_SPACE, True)}
+
+class _RegexParser:
+    """递归下降解析器，支持字面量、转义、字符类、分组、| 以及 * + ? {m,n}"""
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.pos = 0
+
+    def parse(self):
+        node = self._alternation()
+        if self.pos != len(self.pattern):
+            raise ValueError(f"正则表达式解析失败，位置 {self.pos}: {self.pattern!r}")
+        return node
+
+    def _peek(self):
+        return self.pattern[self.pos] if self.pos < len(self.pattern) else None
+
+    def _next(self):
+        ch = self._peek()
+        if ch is None:
+            raise ValueError(f"正则表达式意外结束: {self.pattern!r}")
+        self.pos += 1
+        return ch
+
+    def _alternation(self):
+        branches = [self._concat()]
+        while self._peek() == "|":
+            self.pos += 1
+            branches.append(self._concat())
+        return branches[0] if len(branches) == 1 else ("alt", branches)
+
+    def _concat(self):
+        items = []
+        while self._peek() not in (None, "|", ")"):
+            items.append(self._repeat())
+        return ("cat", items)
+
+    def _repeat(self):
+        node = self._atom()
+        while True:
+            ch = self._peek()
+            if ch == "*":
+                self.pos += 1
+                node = ("repeat", node, 0, None)
+            elif ch == "+":
+                self.pos += 1
+                node = ("repeat", node, 1, None)
+            elif ch == "?":
+                self.pos += 1
+                node = ("repeat", node, 0, 1)
+            elif ch == "{" and re.match(r"\{\d+(,\d*)?\}", self.pattern[self.pos:]):
+                match = re.match(r"\{(\d+)(,(\d*))?\}", self.pattern[self.pos:])
+                self.pos += match.end()
+                low = int(match.group(1))
+                if match.group(2) is None:
+                    high = low
+                else:
+                    high = int(match.group(3)) if match.group(3) else None
+                node = ("repeat", node, low, high)
+            else:
+                return node
+
+    def _atom(self):
+        ch = self._next()
+        if ch == "(":
+            if self.pattern.startswith("?:", self.pos):
+                self.pos += 2
+            node = self._alternation()
+            if self._next() != ")":
+                raise ValueError(f"括号不匹配: {self.pattern!r}")
+            return node
+        if ch == "[":
+            return ("char", self._char_class())
+        if ch == ".":
+            return ("char", _CharClass([(ord("\n"), ord("\n"))], negated=True))
+        if ch == "\\":
+            return ("char", self._escape())
+        if ch in "^$":
+            # 整体匹配语义下锚点无意义
+            return ("cat", [])
+        return ("char", _literal(ch))
+
+    def _escape(self):
+        ch = self._next()
+        if ch in _SHORTHANDS:
+            ranges, negated = _SHORTHANDS[ch]
+            return _CharClass(ranges, negated)
+        if ch in "xu":
+            return _CharClass([(self._hex_code(ch),) * 2])
+        return _literal(_ESCAPES.get(ch, ch))
+
+    def _hex_code(self, kind):
+        width = 2 if kind == "x" else 4
+        code = int(self.pattern[self.pos:self.pos + width], 16)
+        self.pos += width
+        return code
+
+    def _class_char(self):
+        ch = self._next()
+        if ch == "\\":
+            esc = self._next()
+            if esc in _SHORTHANDS:
+                return _SHORTHANDS[esc][0]
+            if esc in "xu":
+                return chr(self._hex_code(esc))
+            return _ESCAPES.get(esc, esc)
+        return ch
+
+    def _char_class(self):
+        negated = False
+        if self._peek() == "^":
+            negated = True
+            self.pos += 1
+        ranges = []
+        first = True
+        while first or self._peek() != "]":
+            first = False
+            start = self._class_char()
+            if isinstance(start, list):
+                ranges.extend(start)
+                continue
+            if self._peek() == "-" and self.pattern[self.pos + 1:self.pos + 2] not in ("]", ""):
+                self.pos += 1
+                end = self._class_char()
+                ranges.append((ord(start), ord(end)))
+            else:
+                ranges.append((ord(start), ord(start)))
+        self.pos += 1
+        return _CharClass(ranges, negated)
+
+class _NFA:
+    """Thompson构造的NFA，状态集合按需确定化"""
+
+    def __init__(self, pattern):
+        self.edges = []
+        self.epsilon = []
+        self.start, self.accept = self._build(_RegexParser(pattern).parse())
+        self._closure_cache = {}
+        self._step_cache = {}
+
+    def _new_state(self):
+        self.edges.append([])
+        self.epsilon.append([])
+        return len(self.edges) - 1
+
+    def _build(self, node):
+        kind = node[0]
+        if kind == "char":
+            start, end = self._new_state(), self._new_state()
+            self.edges[start].append((node[1], end))
+            return start, end
+        if kind == "cat":
+            start = end = self._new_state()
+            for item in node[1]:
+                s, e = self._build(item)
+                self.epsilon[end].append(s)
+                end = e
+            return start, end
+        if kind == "alt":
+            start, end = self._new_state(), self._new_state()
+            for branch in node[1]:
+                s, e = self._build(branch)
+                self.epsilon[start].append(s)
+                self.epsilon[e].append(end)
+            return start, end
+
+        # repeat: 展开为 min 个必选副本，加上可选副本或星号循环
+        _, child, low, high = node
+        start = end = self._new_state()
+        for _ in range(low):
+            s, e = self._build(child)
+            self.epsilon[end].append(s)
+            end = e
+        if high is None:
+            s, e = self._build(child)
+            loop_end = self._new_state()
+            self.epsilon[end].extend([s, loop_end])
+            self.epsilon[e].extend([s, loop_end])
+            end = loop_end
+        else:
+            tail = self._new_state()
+            for _ in range(high - low):
+                s, e = self._build(child)
+                self.epsilon[end].extend([s, tail])
+                end = e
+            self.epsilon[end].append(tail)
+            end = tail
+        return start, end
+
+    def closure(self, states):
+        states = frozenset(states)
+        cached = self._closure_cache.get(states)
+        if cached is not None:
+            return cached
+        result = set(states)
+        stack = list(states)
+        while stack:
+            for target in self.epsilon[stack.pop()]:
+                if target not in result:
+                    result.add(target)
+                    stack.append(target)
+        result = frozenset(result)
+        self._closure_cache[states] = result
+        return result
+
+    def alphabet(self):
+        """按所有字符类的区间边界把字符划分为等价类，返回排好序的区间起点：
+        同一区间内的字符在任何状态下的转移都相同"""
+        bounds = {0}
+        for edges in self.edges:
+            for cc, _ in edges:
+                for lo, hi in cc.ranges:
+                    bounds.update((lo, hi + 1))
+        return sorted(bound for bound in bounds if bound <= sys.maxunicode)
+
+    def step(self, states, ch):
+        key = (states, ch)
+        cached = self._step_cache.get(key)
+        if cached is None:
+            targets = [t for s in states for cc, t in self.edges[s] if cc.matches(ch)]
+            cached = self.closure(targets) if targets else frozenset()
+            self._step_cache[key] = cached
+        return cached
+
+# ---------------------------------------------------------------------------
+# JSON Schema -> 正则表达式
+# ---------------------------------------------------------------------------
+
+_WS = r"[ ]?"
+_STRING_CHAR = r'(?:[^"\\\x00-\x1f]|\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4}))'
+_INTEGER = r"-?(?:0|[1-9][0-9]*)"
+_NUMBER = _INTEGER + r"(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?"
+
+def _escape_literal(text):
+    return "".join("\\" + c if c in r"\.^$*+?{}[]()|-/" else c for c in text)
+
+def _repeat_suffix(low, high):
+    if low == 0 and high is None:
+        return "*"
+    return "{%d,%s}" % (low, "" if high is None else high)
+
+def schema_to_regex(schema):
+    """把JSON Schema的常用子集转换为正则表达式（属性按声明顺序输出）"""
+    if "enum" in schema:
+        return "(?:" + "|".join(_escape_literal(json.dumps(v, ensure_ascii=False)) for v in schema["enum"]) + ")"
+    if "const" in schema:
+        return _escape_literal(json.dumps(schema["const"], ensure_ascii=False))
+    for key in ("anyOf", "oneOf"):
+        if key in schema:
+            return "(?:" + "|".join(schema_to_regex(s) for s in schema[key]) + ")"
+
+    schema_type = schema.get("type")
+    if isinstance(schema_type, list):
+        return "(?:" + "|".join(schema_to_regex({**schema, "type": t}) for t in schema_type) + ")"
+
+    if schema_type == "string":
+        if "pattern" in schema:
+            return '"' + schema["pattern"].lstrip("^").rstrip("$") + '"'
+        low, high = schema.get("minLength", 0), schema.get("maxLength")
+        return '"' + _STRING_CHAR + _repeat_suffix(low, high) + '"'
+    if schema_type == "integer":
+        return _INTEGER
+    if schema_type == "number":
+        return _NUMBER
+    if schema_type == "boolean":
+        return "(?:true|false)"
+    if schema_type == "null":
+        return "null"
+    if schema_type == "array":
+        item = schema_to_regex(schema.get("items", {"type": "string"}))
+        low, high = schema.get("minItems", 0), schema.get("maxItems")
+        rest = "(?:," + _WS + item + ")"
+        if low == 0:
+            rest_high = None if high is None else high - 1
+            body = "(?:" + item + rest + _repeat_suffix(0, rest_high) + ")?"
+        else:
+            body = item + rest + _repeat_suffix(low - 1, None if high is None else high - 1)
+        return r"\[" + _WS + body + _WS + r"\]"
+    if schema_type == "object" and "properties" in schema:
+        return _object_regex(schema)
+
+    raise ValueError(f"不支持的JSON Schema片段: {json.dumps(schema, ensure_ascii=False)}")
+
+def _object_regex(schema):
+    required = set(schema.get("required", []))
+    props = [
+        ('"' + _escape_literal(name) + '":' + _WS + schema_to_regex(sub), name in required)
+        for name, sub in schema["properties"].items()
+    ]
+
+    # 可选属性会影响逗号位置：build(i, first) 表示从第i个属性开始、是否还没输出过属性
+    memo = {}
+    def build(i, first):
+        if i == len(props):
+            return ""
+        key = (i, first)
+        if key not in memo:
+            prop, is_required = props[i]
+            prefix = "" if first else "," + _WS
+            present = prefix + prop + build(i + 1, False)
+            if is_required:
+                memo[key] = present
+            else:
+                memo[key] = "(?:" + present + "|" + build(i + 1, first) + ")"
+        return memo[key]
+
+    return r"\{" + _WS + build(0, True) + _WS + r"\}"
+
+# ---------------------------------------------------------------------------
+# 词表上的token级自动机
+# ---------------------------------------------------------------------------
+
+_vocab_cache = {}
+_automaton_cache = OrderedDict()
+_cache_lock = threading.Lock()
+AUTOMATON_CACHE_SIZE = 32
+
+def _vocab_table(tokenizer):
+    """分词器词表的解码字符串，按长度从长到短排列（每个分词器只构建一次）
+
+    返回 (token id, 各位置的字符码)：第 pos 列是长度超过 pos 的token在该位置的字符码，
+    因为按长度排序，这些token正好是前 len(列) 个
+    """
+    key = getattr(tokenizer, "name_or_path", id(tokenizer))
+    if key in _vocab_cache:
+        return _vocab_cache[key]
+
+    special = set(tokenizer.all_special_ids)
+    items = []
+    for token, token_id in tokenizer.get_vocab().items():
+        if token_id in special:
+            continue
+        text = tokenizer.decode([token_id])
+        if token.startswith("▁") and not text.startswith(" "):
+            text = " " + text
+        # 不完整的UTF-8字节片段无法逐字符匹配，直接排除
+        if not text or "�" in text:
+            continue
+        items.append((text, token_id))
+    items.sort(key=lambda item: -len(item[0]))
+
+    token_ids = torch.tensor([token_id for _, token_id in items], dtype=torch.long)
+    lengths = torch.tensor([len(text) for text, _ in items], dtype=torch.long)
+    columns = []
+    if items:
+        text = "".join(text for text, _ in items)
+        codes = torch.frombuffer(bytearray(text.encode("utf-32-le", "surrogatepass")), dtype=torch.int32).long()
+        offsets = torch.cumsum(lengths, 0) - lengths
+        for pos in range(int(lengths[0])):
+            active = int((lengths > pos).sum())
+            columns.append(codes[offsets[:active] + pos])
+
+    _vocab_cache[key] = (token_ids, columns)
+    return _vocab_cache[key]
+
+class TokenAutomaton:
+    """字符级DFA在构造时确定化；每个状态允许的token及转移在第一次到达该状态时计算并缓存
+
+    计算一个状态的token表时，整个词表按字符位置逐列查DFA转移表（向量化），
+    生成只会经过少数状态，不必为所有状态遍历词表
+    """
+
+    def __init__(self, pattern, tokenizer):
+        start = time.perf_counter()
+        self.pattern = pattern
+        self.eos_token_id = tokenizer.eos_token_id
+        self.accepting = []
+        self._masks = {}
+        self._lock = threading.Lock()
+
+        nfa = _NFA(pattern)
+        bounds = nfa.alphabet()
+        state_index = {}
+        rows = []
+
+        def index_of(states):
+            if states not in state_index:
+                state_index[states] = len(rows)
+                rows.append(None)
+                self.accepting.append(nfa.accept in states)
+                pending.append(states)
+            return state_index[states]
+
+        # 字符级DFA：转移表 [状态, 字符类]，最后一行是死状态
+        pending = []
+        index_of(nfa.closure([nfa.start]))
+        while pending:
+            states = pending.pop()
+            row = []
+            for bound in bounds:
+                nxt = nfa.step(states, chr(bound))
+                row.append(index_of(nxt) if nxt else -1)
+            rows[state_index[states]] = row
+        dead = len(rows)
+        self._delta = torch.tensor(rows + [[dead] * len(bounds)], dtype=torch.long)
+        self._delta[self._delta < 0] = dead
+
+        token_ids, columns = _vocab_table(tokenizer)
+        bounds = torch.tensor(bounds, dtype=torch.long)
+        self._token_ids = token_ids
+        self._columns = [torch.searchsorted(bounds, column, right=True) - 1 for column in columns]
+        # 每个状态的 (允许的token id（升序）, 对应的下一状态)
+        self._tables = [None] * dead
+
+        self.build_time = time.perf_counter() - start
+        logger.info(f"约束自动机编译完成: {dead} 个状态, 耗时 {self.build_time:.2f} 秒（token表在首次到达状态时计算）")
+
+    def _table(self, state):
+        table = self._tables[state]
+        if table is None:
+            with self._lock:
+                table = self._tables[state]
+                if table is None:
+                    table = self._tables[state] = self._build_table(state)
+        return table
+
+    def _build_table(self, state):
+        dead = len(self._tables)
+        current = torch.full(self._token_ids.shape, state, dtype=torch.long)
+        for classes in self._columns:
+            # 第 pos 列只涉及长度超过 pos 的token（排在前面）；进入死状态的token之后一直留在死状态
+            active = len(classes)
+            current[:active] = self._delta[current[:active], classes]
+        keep = current != dead
+        token_ids, targets = self._token_ids[keep], current[keep]
+        order = torch.argsort(token_ids)
+        return token_ids[order], targets[order]
+
+    def next_state(self, state, token_id):
+        """返回转移后的状态；非法token返回None"""
+        if state is None:
+            return None
+        token_ids, targets = self._table(state)
+        index = int(torch.searchsorted(token_ids, token_id))
+        if index < len(token_ids) and int(token_ids[index]) == token_id:
+            return int(targets[index])
+        return None
+
+    def mask(self, state, vocab_size, device):
+        """返回该状态下允许token的布尔掩码（按状态和设备缓存）"""
+        key = (state, vocab_size, device)
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = torch.zeros(vocab_size, dtype=torch.bool)
+            if state is not None:
+                token_ids, _ = self._table(state)
+                mask[token_ids[token_ids < vocab_size]] = True
+            if (state is None or self.accepting[state] or not mask.any()) and self.eos_token_id is not None:
+                mask[self.eos_token_id] = True
+            mask = mask.to(device)
+            self._masks[key] = mask
+        return mask
+
+def get_automaton(tokenizer, regex=None, json_schema=None):
+    """获取（必要时编译并缓存）正则或JSON Schema对应的自动机"""
+    if json_schema is not None:
+        if isinstance(json_schema, str):
+            json_schema = json.loads(json_schema)
+        regex = schema_to_regex(json_schema)
+    if regex is None:
+        raise ValueError("需要提供 regex 或 json_schema")
+
+    key = (getattr(tokenizer, "name_or_path", id(tokenizer)), regex)
+    with _cache_lock:
+        if key in _automaton_cache:
+            _automaton_cache.move_to_end(key)
+            return _automaton_cache[key]
+
+    automaton = TokenAutomaton(regex, tokenizer)
+    with _cache_lock:
+        _automaton_cache[key] = automaton
+        while len(_automaton_cache) > AUTOMATON_CACHE_SIZE:
+            _automaton_cache.popitem(last=False)
+    return automaton
+
+class GrammarLogitsProcessor(LogitsProcessor):
+    """每步根据自动机状态屏蔽非法token，并统计掩码开销"""
+
+    def __init__(self, automaton):
+        self.automaton = automaton
+        self.prompt_length = None
+        self.states = None
+        self.mask_time = 0.0
+        self.steps = 0
+
+    def __call__(self, input_ids, scores):
+        start = time.perf_counter()
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1]
+            self.states = [0] * input_ids.shape[0]
+        else:
+            last_tokens = input_ids[:, -1].tolist()
+            self.states = [
+                self.automaton.next_state(state, token)
+                for state, token in zip(self.states, last_tokens)
+            ]
+
+        masks = torch.stack([
+            self.automaton.mask(state, scores.shape[-1], scores.device)
+            for state in self.states
+        ])
+        scores = scores.masked_fill(~masks, float("-inf"))
+        self.mask_time += time.perf_counter() - start
+        self.steps += 1
+        return scores
+
+    @property
+    def mask_ms_per_token(self):
+        return self.mask_time / self.steps * 1000 if self.steps else 0.0
@@ -0,0 +1,95 @@
+"""
+空闲资源管理：长时间无请求时先释放缓存，再卸载模型权重；下次请求时透明地重新加载
+"""
+import gc
+import time
+import ctypes
+import threading
+import logging
+from config import IDLE_CONFIG
+
+logger = logging.getLogger(__name__)
+
+def trim_process_heap():
+    """把已释放的堆内存归还给操作系统（仅glibc）"""
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+class IdleManager:
+    """后台线程按空闲时长依次执行 trim -> unload"""
+    
+    ACTIVE = "active"
+    TRIMMED = "trimmed"
+    UNLOADED = "unloaded"
+    
+    def __init__(self, llm, trim_after=None, unload_after=None, check_interval=None):
+        self.llm = llm
+        self.trim_after = trim_after if trim_after is not None else IDLE_CONFIG["trim_after"]
+        self.unload_after = unload_after if unload_after is not None else IDLE_CONFIG["unload_after"]
+        self.check_interval = check_interval if check_interval is not None else IDLE_CONFIG["check_interval"]
+        self.state = self.ACTIVE
+        self.transitions = []
+        self.counts = {"trim": 0, "unload": 0, "reload": 0}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="idle-manager", daemon=True)
+        self._thread.start()
+    
+    def _record(self, state, duration):
+        self.state = state
+        self.transitions.append({"time": time.time(), "state": state, "duration": round(duration, 3)})
+        # 只保留最近的记录
+        del self.transitions[:-100]
+    
+    def _loop(self):
+        while not self._stop.wait(self.check_interval):
+            idle = self.llm.idle_seconds()
+            if idle is None:
+                continue
+            if self.state != self.UNLOADED and idle >= self.unload_after:
+                self.unload()
+            elif self.state == self.ACTIVE and idle >= self.trim_after:
+                self.trim()
+    
+    def trim(self):
+        """释放KV缓存和分配器缓存，保留权重"""
+        start = time.perf_counter()
+        if not self.llm.release_caches():
+            return
+        self._record(self.TRIMMED, time.perf_counter() - start)
+        self.counts["trim"] += 1
+        logger.info(f"空闲 {self.llm.idle_seconds():.0f} 秒，已释放缓存，耗时 {time.perf_counter() - start:.2f} 秒")
+    
+    def unload(self):
+        """卸载模型权重"""
+        start = time.perf_counter()
+        if not self.llm.unload_model():
+            return
+        # 只归还进程私有的堆内存；权重文件的页缓存留给系统管理（同机其他进程和下次重新加载都能复用）
+        gc.collect()
+        trim_process_heap()
+        self._record(self.UNLOADED, time.perf_counter() - start)
+        self.counts["unload"] += 1
+        logger.info(f"空闲 {self.llm.idle_seconds():.0f} 秒，已卸载模型权重，耗时 {time.perf_counter() - start:.2f} 秒")
+    
+    def on_reload(self, duration):
+        """模型被请求触发重新加载后调用"""
+        self._record(self.ACTIVE, duration)
+        self.counts["reload"] += 1
+        logger.info(f"收到请求，已重新加载模型，耗时 {duration:.2f} 秒")
+    
+    def on_activity(self):
+        if self.state == self.TRIMMED:
+            self._record(self.ACTIVE, 0.0)
+    
+    def stats(self):
+        return {
+            "state": self.state,
+            "idle_seconds": self.llm.idle_seconds(),
+            **self.counts,
+            "transitions": list(self.transitions[-10:])
+        }
+    
+    def stop(self):
+        self._stop.set()
@@ -1,23 +1,28 @@
 #!/usr/bin/env python3
 """
 本地大语言模型启动器
+所有界面在当前进程中运行；torch/transformers/gradio 等重量级模块只在选定功能后才导入
 """
 import os
 import sys
-import subprocess
+import argparse
+import importlib.util
 from pathlib import Path
 
-def check_requirements():
-    """检查必要的依赖"""
-    try:
-        import torch
-        import transformers
-        import gradio
-        return True
-    except ImportError as e:
-        print(f"缺少必要的依赖: {e}")
-        print("请运行: pip install torch transformers gradio")
+# 启动器显示菜单前的导入时间预算（毫秒），--bench-startup 超出时返回非零
+STARTUP_IMPORT_BUDGET_MS = 200
+
+# 显示菜单前不应被导入的重量级模块
+HEAVY_MODULES = ("torch", "transformers", "gradio", "huggingface_hub", "bitsandbytes", "peft")
+
+def check_requirements(modules=("torch", "transformers")):
+    """检查必要的依赖（只查找模块，不导入）"""
+    missing = [name for name in modules if importlib.util.find_spec(name) is None]
+    if missing:
+        print(f"缺少必要的依赖: {', '.join(missing)}")
+        print(f"请运行: pip install {' '.join(missing)}")
         return False
+    return True
 
 def check_model_exists():
     """检查是否有已下载的模型"""
@@ -32,7 +37,155 @@ def check_model_exists():
                 return True
     return False
 
-def main():
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="本地大语言模型启动器")
+    parser.add_argument(
+        "--preload",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="MODEL_KEY",
+        help="Web界面启动后立即在后台预加载并预热默认模型"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        metavar="N",
+        help="多进程服务模式：启动N个绑定到NUMA节点的推理进程，并提供HTTP接口"
+    )
+    parser.add_argument("--model", default=None, help="多进程服务模式使用的模型目录")
+    parser.add_argument("--host", default=None, help="多进程服务模式监听地址")
+    parser.add_argument("--port", type=int, default=None, help="多进程服务模式监听端口")
+    parser.add_argument(
+        "--bench-startup",
+        action="store_true",
+        help="用 -X importtime 测量启动器的导入开销，超过阈值时返回非零"
+    )
+    parser.add_argument(
+        "--threshold-ms",
+        type=float,
+        default=STARTUP_IMPORT_BUDGET_MS,
+        help=f"启动导入时间阈值（毫秒，默认 {STARTUP_IMPORT_BUDGET_MS}）"
+    )
+    return parser.parse_args(argv)
+
+def parse_importtime(stderr):
+    """解析 -X importtime 输出，返回 [(模块名, 缩进层级, 自身微秒, 累计微秒)]"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        # 模块名前的缩进表示嵌套层级（顶层为1个空格，每深一层多2个空格）
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((name.strip(), level, int(self_us), int(cumulative_us)))
+    return entries
+
+def bench_startup(threshold_ms):
+    """测量启动器到显示菜单前的导入开销；超过阈值或导入了重量级模块时返回1"""
+    import subprocess
+    
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import launcher; launcher.parse_args([])"],
+        capture_output=True,
+        text=True,
+        cwd=script_dir
+    )
+    if result.returncode != 0:
+        print(result.stderr)
+        return 1
+    
+    entries = parse_importtime(result.stderr)
+    # 顶层导入的累计时间之和即为总导入时间（同时包含解释器自身启动时的导入）
+    top_level = [entry for entry in entries if entry[1] == 0]
+    total_ms = sum(entry[3] for entry in top_level) / 1000
+    heavy = sorted({entry[0].split(".")[0] for entry in entries} & set(HEAVY_MODULES))
+    
+    print("=== 启动导入开销 ===")
+    print(f"模块数: {len(entries)}, 总导入时间: {total_ms:.1f} ms (阈值 {threshold_ms:.0f} ms)")
+    print("最慢的顶层导入:")
+    for name, _, _, cumulative in sorted(top_level, key=lambda entry: entry[3], reverse=True)[:10]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+    
+    failed = False
+    if heavy:
+        print(f"回归：显示菜单前导入了重量级模块 {', '.join(heavy)}")
+        failed = True
+    if total_ms > threshold_ms:
+        print(f"回归：导入时间 {total_ms:.1f} ms 超过阈值 {threshold_ms:.0f} ms")
+        failed = True
+    if not failed:
+        print("通过")
+    return 1 if failed else 0
+
+def find_default_model():
+    """返回第一个已下载的模型目录"""
+    models_dir = Path("./models")
+    if not models_dir.exists():
+        return None
+    for item in sorted(models_dir.iterdir()):
+        if item.is_dir() and (item / "config.json").exists():
+            return str(item)
+    return None
+
+def run_worker_pool(args):
+    """多进程数据并行服务模式"""
+    from config import WORKER_POOL_CONFIG
+    from worker_pool import WorkerPool
+    from api_server import create_server
+    
+    model_path = args.model or find_default_model()
+    if not model_path:
+        print("未找到可用的模型，请使用 --model 指定模型目录")
+        return
+    
+    host = args.host or WORKER_POOL_CONFIG["host"]
+    port = args.port or WORKER_POOL_CONFIG["port"]
+    
+    pool = WorkerPool(model_path, num_workers=args.workers).start()
+    for worker in pool.health():
+        print(f"工作进程 {worker['worker_id']}: CPU {worker['cpus']}")
+    
+    server = create_server(pool, host, port)
+    print(f"推理服务已启动: http://{host}:{port} (POST /generate, GET /health)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n正在停止服务...")
+    finally:
+        server.server_close()
+        pool.shutdown()
+
+def run_web(preload=None):
+    """在当前进程中启动Web界面"""
+    import chat_ui
+    
+    ui_args = []
+    if preload is not None:
+        ui_args.append("--preload")
+        if preload:
+            ui_args.append(preload)
+    chat_ui.main(ui_args)
+
+def run_terminal():
+    """在当前进程中启动终端界面"""
+    import chat_terminal_v2
+    chat_terminal_v2.main()
+
+def run_download():
+    """在当前进程中运行模型下载"""
+    import download_model_v2
+    download_model_v2.main()
+
+def main(argv=None):
+    args = parse_args(argv)
+    
+    if args.bench_startup:
+        return bench_startup(args.threshold_ms)
+    
     print("=== 本地大语言模型启动器 ===")
     print()
     
@@ -40,6 +193,10 @@ def main():
     if not check_requirements():
         return
     
+    if args.workers:
+        run_worker_pool(args)
+        return
+    
     # 检查模型
     if not check_model_exists():
         print("未发现已下载的模型！")
@@ -51,12 +208,10 @@ def main():
         if choice == "1":
             print("开始下载模型...")
             try:
-                subprocess.run([sys.executable, "download_model_v2.py"], check=True)
-            except subprocess.CalledProcessError:
-                print("模型下载失败，请手动运行: python download_model_v2.py")
-                return
-            except FileNotFoundError:
-                print("找不到下载脚本，请手动运行: python download_model.py")
+                run_download()
+            except Exception as e:
+                print(f"模型下载失败: {e}")
+                print("请手动运行: python download_model_v2.py")
                 return
         else:
             return
@@ -71,22 +226,25 @@ def main():
         choice = input("请选择 (1-3): ").strip()
         
         if choice == "1":
+            if not check_requirements(("gradio",)):
+                print("无法启动Web界面，改为启动终端界面...")
+                run_terminal()
+                break
             print("正在启动Web界面...")
             try:
-                subprocess.run([sys.executable, "chat_ui.py"], check=True)
-            except subprocess.CalledProcessError:
-                print("Web界面启动失败，尝试启动终端界面...")
-                subprocess.run([sys.executable, "chat_terminal.py"])
+                run_web(args.preload)
             except KeyboardInterrupt:
                 print("用户取消启动")
+            except Exception as e:
+                print(f"Web界面启动失败: {e}")
+                print("尝试启动终端界面...")
+                run_terminal()
             break
             
         elif choice == "2":
             print("正在启动终端界面...")
             try:
-                subprocess.run([sys.executable, "chat_terminal.py"], check=True)
-            except subprocess.CalledProcessError:
-                print("终端界面启动失败")
+                run_terminal()
             except KeyboardInterrupt:
                 print("用户取消启动")
             break
@@ -100,7 +258,7 @@ def main():
 
 if __name__ == "__main__":
     try:
-        main()
+        sys.exit(main())
     except KeyboardInterrupt:
         print("\n程序被用户中断")
     except Exception as e:
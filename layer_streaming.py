@@ -0,0 +1,143 @@
+"""
+逐层流式推理：权重保留在内存映射的safetensors分片中，每个解码层在执行前才读入内存、执行后立即释放，
+后台线程预读后面的层，与当前层的计算重叠。常驻内存的只有词嵌入、输出层、最后的归一化层、
+正在计算和预读的少数几层以及KV缓存
+"""
+import os
+import glob
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from safetensors import safe_open
+from config import STREAMING_CONFIG
+
+logger = logging.getLogger(__name__)
+
+def _decoder_layers(model):
+    """返回模型的解码层列表及其在权重文件中的名称前缀"""
+    for name, module in model.named_modules():
+        if isinstance(module, torch.nn.ModuleList) and name.endswith("layers"):
+            return module, name + "."
+    raise ValueError("未找到解码层（model.layers）")
+
+class LayerStreamer:
+    """通过前向钩子按需加载/释放解码层权重"""
+
+    def __init__(self, model_path, model, dtype, prefetch_layers=None):
+        self.dtype = dtype
+        self.prefetch_layers = STREAMING_CONFIG["prefetch_layers"] if prefetch_layers is None else prefetch_layers
+        self.layers, self.prefix = _decoder_layers(model)
+
+        # 张量名 -> 分片文件；分片以内存映射方式打开，读取时才真正访问磁盘/页缓存
+        self._files = {}
+        self._index = {}
+        for shard in sorted(glob.glob(os.path.join(model_path, "*.safetensors"))):
+            handle = safe_open(shard, framework="pt", device="cpu")
+            self._files[shard] = handle
+            for name in handle.keys():
+                self._index[name] = handle
+
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="layer-prefetch")
+        self._pending = {}
+        self._hooks = []
+        for i, layer in enumerate(self.layers):
+            self._hooks.append(layer.register_forward_pre_hook(self._make_pre_hook(i)))
+            self._hooks.append(layer.register_forward_hook(self._release))
+        # 钩子共享 _pending 和各层的权重，整个前向串行执行：并发请求的前向在这里排队
+        self._lock = threading.RLock()
+        self._model = model
+        forward = model.forward
+
+        @functools.wraps(forward)
+        def serialized_forward(*args, **kwargs):
+            with self._lock:
+                # 每次前向从第0层开始，先预读开头几层，与词嵌入等计算重叠
+                for i in range(min(self.prefetch_layers, len(self.layers))):
+                    self._prefetch(i)
+                return forward(*args, **kwargs)
+        model.forward = serialized_forward
+
+    def resident_state(self):
+        """解码层以外的权重（词嵌入、归一化层、输出层），加载后常驻内存"""
+        layer_prefix = self.prefix
+        return {
+            name: handle.get_tensor(name).to(self.dtype)
+            for name, handle in self._index.items()
+            if not name.startswith(layer_prefix)
+        }
+
+    def _read_layer(self, i):
+        prefix = f"{self.prefix}{i}."
+        return {
+            name[len(prefix):]: handle.get_tensor(name).to(self.dtype)
+            for name, handle in self._index.items()
+            if name.startswith(prefix)
+        }
+
+    def _prefetch(self, i):
+        if i not in self._pending:
+            self._pending[i] = self._pool.submit(self._read_layer, i)
+
+    def _make_pre_hook(self, i):
+        def pre_hook(module, args):
+            future = self._pending.pop(i, None)
+            state = future.result() if future is not None else self._read_layer(i)
+            module.load_state_dict(state, assign=True)
+            # 只预读本次前向中后面的层；下一次前向开始时再预读开头几层，
+            # 最后一个前向结束后不会留下读入了却没人用的层
+            for ahead in range(i + 1, min(i + 1 + self.prefetch_layers, len(self.layers))):
+                self._prefetch(ahead)
+        return pre_hook
+
+    def _release(self, module, args, output):
+        module.to("meta")
+        return output
+
+    def layer_bytes(self):
+        """单个解码层按计算精度占用的字节数"""
+        prefix = f"{self.prefix}0."
+        element_size = torch.empty(0, dtype=self.dtype).element_size()
+        total = 0
+        for name, handle in self._index.items():
+            if name.startswith(prefix):
+                numel = 1
+                for dim in handle.get_slice(name).get_shape():
+                    numel *= dim
+                total += numel * element_size
+        return total
+
+    def close(self):
+        for hook in self._hooks:
+            hook.remove()
+        # 去掉实例上的串行化包装，恢复类的 forward
+        self._model.__dict__.pop("forward", None)
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pending.clear()
+        self._files.clear()
+        self._index.clear()
+
+def load_streaming_model(model_path, dtype=None):
+    """创建只有常驻部分带权重的模型，解码层权重在执行时按需读取"""
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig, AutoModelForCausalLM
+
+    dtype = dtype or getattr(torch, STREAMING_CONFIG["dtype"])
+    config = AutoConfig.from_pretrained(model_path, trust_remote_code=True, local_files_only=True)
+    # 参数建在meta设备上不占内存；缓冲区（如旋转位置编码）正常创建
+    with init_empty_weights(include_buffers=False):
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=dtype, trust_remote_code=True)
+
+    streamer = LayerStreamer(model_path, model, dtype)
+    model.load_state_dict(streamer.resident_state(), strict=False, assign=True)
+    if getattr(config, "tie_word_embeddings", False):
+        model.tie_weights()
+    model.eval()
+    model._layer_streamer = streamer
+
+    layer_mb = streamer.layer_bytes() / 1024**2
+    resident_mb = sum(p.numel() * p.element_size() for p in model.parameters() if p.device.type != "meta") / 1024**2
+    logger.info(f"逐层流式加载: {len(streamer.layers)} 层, 每层约 {layer_mb:.0f} MB, "
+                f"常驻权重约 {resident_mb:.0f} MB, 预读 {streamer.prefetch_layers} 层")
+    return model
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+端到端压测工具：从客户端驱动正在运行的前端（chat_ui 的 Gradio 接口，或 api_server 的 HTTP 接口），
+包含界面处理函数、Gradio排队和HTTP序列化的开销；按SLO阈值给出通过/未通过
+
+用法:
+  python loadgen.py --http http://127.0.0.1:8000 --rate 2 --requests 100 --prompt-tokens 16-512
+  python loadgen.py --gradio http://127.0.0.1:7860 --concurrency 8 --duration 60 --slo-p95 10
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from replay import SYNTHETIC_UNIT, percentile
+
+# chat_ui 在排队期间先返回的占位回复
+QUEUED_PLACEHOLDER = "⏳ 正在排队..."
+# chat_ui 以普通回复的形式返回的错误
+GRADIO_ERRORS = ("生成回复时出错", "请先加载模型", "请输入有效的消息")
+
+def parse_length(spec):
+    """长度分布：'64' 固定、'16-512' 均匀、'lognormal:128' 对数正态（中位数128），返回采样函数"""
+    if spec.startswith("lognormal:"):
+        median = float(spec.split(":", 1)[1])
+        return lambda rng: max(1, int(rng.lognormvariate(0, 0.8) * median))
+    if "-" in spec:
+        low, high = (int(value) for value in spec.split("-", 1))
+        return lambda rng: rng.randint(low, high)
+    return lambda rng: int(spec)
+
+def synthetic_prompt(tokens):
+    """客户端无法分词，按平均每个汉字约一个token近似"""
+    repeat = max(1, tokens // len(SYNTHETIC_UNIT) + 1)
+    return (SYNTHETIC_UNIT * repeat)[:max(1, tokens)]
+
+class HTTPTarget:
+    """api_server 的 POST /generate（非流式：首字节即完整回复）
+
+    token_timings=True 时请求逐token发出时间，按 "总延迟 - (最后一个token - 第一个token)" 估计流式返回时的首token延迟
+    """
+
+    def __init__(self, url, token_timings=False):
+        self.url = url.rstrip("/") + "/generate"
+        self.token_timings = token_timings
+
+    def send(self, index, prompt, max_tokens, temperature):
+        """返回 {"ttfb", "ttft", "tokens"}（秒，相对发送时刻），失败时抛出异常"""
+        request = {
+            "prompt": prompt,
+            "session_id": f"loadgen-{index}",
+            "max_length": max_tokens,
+            "temperature": temperature
+        }
+        if self.token_timings:
+            request["logprobs"] = True
+        body = json.dumps(request).encode("utf-8")
+        start = time.perf_counter()
+        http_request = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(http_request) as response:
+                ttfb = time.perf_counter() - start
+                payload = json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            payload = json.loads(e.read() or b"{}")
+            raise RuntimeError(f"HTTP {e.code}: {payload.get('error', '')}")
+        total = time.perf_counter() - start
+        if "error" in payload:
+            raise RuntimeError(payload["error"])
+
+        ttft, tokens = total, None
+        if "times_ms" in payload and payload["times_ms"]:
+            times = payload["times_ms"]
+            ttft = total - (times[-1] - times[0]) / 1000
+            tokens = len(times)
+        return {"ttfb": ttfb, "ttft": ttft, "tokens": tokens, "chars": len(payload["response"])}
+
+class GradioTarget:
+    """chat_ui 的Gradio接口（api_name="chat"），经过Gradio队列和界面处理函数
+
+    处理函数先返回排队占位，再返回完整回复：首字节为第一次更新，首token为第一次带生成内容的更新。
+    每个发送线程是一个虚拟用户，使用自己的 Client（各自的 session_hash，对应服务端各自的会话）
+    """
+
+    def __init__(self, url, adapter="无（基础模型）"):
+        try:
+            from gradio_client import Client
+        except ImportError:
+            raise RuntimeError("压测Gradio接口需要 gradio_client（随 gradio 一起安装）")
+        self._client_class = Client
+        self.url = url
+        self.adapter = adapter
+        self._local = threading.local()
+
+    @property
+    def client(self):
+        """当前线程（虚拟用户）的 Client，第一次使用时创建"""
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self._client_class(self.url, verbose=False)
+        return client
+
+    def send(self, index, prompt, max_tokens, temperature):
+        client = self.client
+        start = time.perf_counter()
+        job = client.submit(prompt, temperature, max_tokens, self.adapter, api_name="/chat")
+        ttfb = ttft = None
+        reply = ""
+        for output, _ in job:
+            now = time.perf_counter() - start
+            ttfb = ttfb if ttfb is not None else now
+            if not isinstance(output, str):
+                # 等待期间回复不更新
+                continue
+            reply = output
+            if ttft is None and reply and reply != QUEUED_PLACEHOLDER:
+                ttft = now
+        job.result()
+        total = time.perf_counter() - start
+        if not reply or reply == QUEUED_PLACEHOLDER or reply.startswith(GRADIO_ERRORS):
+            raise RuntimeError(reply or "没有返回回复")
+        return {"ttfb": ttfb or total, "ttft": ttft or total, "tokens": None, "chars": len(reply)}
+
+def run_one(target, index, prompt, max_tokens, temperature, scheduled, results, lock):
+    """latency 从计划发送时刻算起：开环模式下客户端来不及发送时的等待也计入（避免协调遗漏）"""
+    sent = time.perf_counter()
+    result = {"prompt_chars": len(prompt), "error": None}
+    try:
+        result.update(target.send(index, prompt, max_tokens, temperature))
+        delay = sent - scheduled
+        result["ttfb"] += delay
+        result["ttft"] += delay
+    except Exception as e:
+        result["error"] = str(e)
+    result["latency"] = time.perf_counter() - scheduled
+    with lock:
+        results.append(result)
+
+def run_load(target, args):
+    """开环（--rate>0，泊松到达）或闭环（--rate 0，固定并发）发送请求，返回 (结果, 总耗时)"""
+    rng = random.Random(args.seed)
+    prompt_length = parse_length(args.prompt_tokens)
+    results, lock = [], threading.Lock()
+    start = time.perf_counter()
+    deadline = start + args.duration if args.duration else None
+
+    def more(count):
+        if deadline is not None:
+            return time.perf_counter() < deadline
+        return count < args.requests
+
+    if args.rate > 0:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            count, scheduled = 0, start
+            while more(count):
+                scheduled += rng.expovariate(args.rate)
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                if deadline is not None and scheduled >= deadline:
+                    break
+                prompt = synthetic_prompt(prompt_length(rng))
+                pool.submit(run_one, target, count, prompt, args.max_tokens, args.temperature, scheduled, results, lock)
+                count += 1
+        return results, time.perf_counter() - start
+
+    counter = [0]
+    counter_lock = threading.Lock()
+
+    def client():
+        while True:
+            with counter_lock:
+                if not more(counter[0]):
+                    return
+                index = counter[0]
+                counter[0] += 1
+                prompt = synthetic_prompt(prompt_length(rng))
+            run_one(target, index, prompt, args.max_tokens, args.temperature, time.perf_counter(), results, lock)
+
+    threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+def summarize(results, elapsed):
+    ok = [result for result in results if result["error"] is None]
+    errors = [result["error"] for result in results if result["error"] is not None]
+    summary = {
+        "requests": len(results),
+        "errors": len(errors),
+        "error_rate": len(errors) / len(results) if results else 0.0,
+        "elapsed": elapsed,
+        "throughput": len(ok) / elapsed if elapsed else 0.0,
+        "chars_per_s": sum(result["chars"] for result in ok) / elapsed if elapsed else 0.0,
+        "error_samples": sorted(set(errors))[:5]
+    }
+    tokens = [result["tokens"] for result in ok if result.get("tokens")]
+    if tokens:
+        summary["tokens_per_s"] = sum(tokens) / elapsed
+    for key in ("latency", "ttfb", "ttft"):
+        values = [result[key] for result in ok]
+        for q in (50, 90, 95, 99):
+            summary[f"{key}_p{q}"] = percentile(values, q)
+    return summary
+
+def check_slo(summary, args):
+    """返回 [(指标, 实际值, 阈值, 是否通过)]；没有成功的请求时延迟指标没有样本，按未通过处理"""
+    checks = []
+    measured = summary["requests"] > summary["errors"]
+    if args.slo_p95 is not None:
+        checks.append(("端到端p95(秒)", summary["latency_p95"], args.slo_p95,
+                       measured and summary["latency_p95"] <= args.slo_p95))
+    if args.slo_ttft_p95 is not None:
+        checks.append(("首token p95(秒)", summary["ttft_p95"], args.slo_ttft_p95,
+                       measured and summary["ttft_p95"] <= args.slo_ttft_p95))
+    if args.slo_error_rate is not None:
+        checks.append(("错误率", summary["error_rate"], args.slo_error_rate, summary["error_rate"] <= args.slo_error_rate))
+    if args.slo_throughput is not None:
+        checks.append(("吞吐(req/s)", summary["throughput"], args.slo_throughput, summary["throughput"] >= args.slo_throughput))
+    return checks
+
+def print_report(summary, checks):
+    print("\n压测结果")
+    print("-" * 40)
+    print(f"请求数:   {summary['requests']} (失败 {summary['errors']}, 错误率 {summary['error_rate'] * 100:.1f}%)")
+    throughput = f"吞吐:     {summary['throughput']:.2f} req/s, {summary['chars_per_s']:.0f} 字符/s"
+    if "tokens_per_s" in summary:
+        throughput += f", {summary['tokens_per_s']:.1f} tokens/s"
+    print(throughput)
+    print(f"{'':8s} {'p50':>8s} {'p90':>8s} {'p95':>8s} {'p99':>8s}  (秒)")
+    for key, label in (("latency", "端到端"), ("ttfb", "首字节"), ("ttft", "首token")):
+        print(f"{label:8s} " + " ".join(f"{summary[f'{key}_p{q}']:8.2f}" for q in (50, 90, 95, 99)))
+    for error in summary["error_samples"]:
+        print(f"错误: {error}")
+    if checks:
+        print("\nSLO" + ("（没有成功的请求，延迟指标无样本）" if summary["requests"] == summary["errors"] else ""))
+        for name, value, threshold, ok in checks:
+            print(f"{'通过' if ok else '未通过'}  {name}: {value:.3f} (阈值 {threshold})")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="前端端到端压测")
+    target_group = parser.add_mutually_exclusive_group(required=True)
+    target_group.add_argument("--http", metavar="URL", help="api_server 地址，例如 http://127.0.0.1:8000")
+    target_group.add_argument("--gradio", metavar="URL", help="chat_ui 地址，例如 http://127.0.0.1:7860")
+    parser.add_argument("--concurrency", type=int, default=4, help="最大并发请求数（闭环模式为客户端数）")
+    parser.add_argument("--rate", type=float, default=0.0, help="平均到达率（req/s，泊松到达）；0 表示闭环")
+    parser.add_argument("--requests", type=int, default=50, help="请求总数")
+    parser.add_argument("--duration", type=float, default=None, help="压测时长（秒），指定时忽略 --requests")
+    parser.add_argument("--prompt-tokens", default="16-256", help="输入长度分布：64 / 16-512 / lognormal:128")
+    parser.add_argument("--max-tokens", type=int, default=64, help="每个请求的最大生成长度")
+    parser.add_argument("--temperature", type=float, default=0.7, help="采样温度")
+    parser.add_argument("--token-timings", action="store_true", help="HTTP：请求逐token时间以估计首token延迟")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子，保证到达过程和输入长度可重复")
+    parser.add_argument("--slo-p95", type=float, default=None, help="端到端延迟p95上限（秒）")
+    parser.add_argument("--slo-ttft-p95", type=float, default=None, help="首token延迟p95上限（秒）")
+    parser.add_argument("--slo-error-rate", type=float, default=0.01, help="错误率上限")
+    parser.add_argument("--slo-throughput", type=float, default=None, help="吞吐下限（req/s）")
+    parser.add_argument("--output", default=None, help="把汇总结果写入JSON文件")
+    args = parser.parse_args(argv)
+
+    target = HTTPTarget(args.http, args.token_timings) if args.http else GradioTarget(args.gradio)
+    mode = f"开环 {args.rate} req/s" if args.rate > 0 else f"闭环 {args.concurrency} 并发"
+    amount = f"{args.duration} 秒" if args.duration else f"{args.requests} 个请求"
+    print(f"开始压测 {args.http or args.gradio} ({mode}, {amount}, 输入长度 {args.prompt_tokens})...")
+
+    results, elapsed = run_load(target, args)
+    summary = summarize(results, elapsed)
+    checks = check_slo(summary, args)
+    print_report(summary, checks)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"summary": summary, "slo": checks}, f, ensure_ascii=False, indent=2)
+    return 0 if all(ok for *_, ok in checks) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,173 @@
 import os
+import gc
+import time
+import functools
+import threading
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+from torch.profiler import record_function
+from transformers import (
+    AutoTokenizer, AutoModelForCausalLM, LogitsProcessorList,
+    StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer, DynamicCache,
+    TopKLogitsWarper, TopPLogitsWarper
+)
 import logging
+from config import (
+    COMPILE_CONFIG, SEMANTIC_CACHE_CONFIG, IDLE_CONFIG, GENERATION_CONFIG, VERIFY_CONFIG, ENGINE_CONFIG, AUTOTUNE_CONFIG
+)
+from grammar import get_automaton, GrammarLogitsProcessor
+from lora_adapters import AdapterCache
+from semantic_cache import SemanticCache
+from backends import get_backend
+from idle_manager import IdleManager, trim_process_heap
+from token_trace import TokenTrace
+from stop_sequences import StopSequenceCriteria, StopTokenStreamer, truncate_text, held_suffix
+from streaming_context import ContextSession
+from model_manager import verify_model_files
+from autotune import load_profile, available_cpus
 
 # 设置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _tracks_activity(method):
+    """记录请求活动；模型因空闲被卸载时先透明地重新加载"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._begin_request()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._end_request()
+    return wrapper
+
+class _YieldCriteria(StoppingCriteria):
+    """每个解码步之后询问调度器是否需要让出（被更高优先级的请求抢占）"""
+    
+    def __init__(self, should_stop):
+        self.should_stop = should_stop
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), bool(self.should_stop()), dtype=torch.bool, device=input_ids.device)
+
+class _PrefillState:
+    """分块预填充的进度：输入token、已填充到的位置、KV缓存和使用的LoRA适配器"""
+    
+    def __init__(self, input_ids, adapter=None):
+        self.input_ids = input_ids
+        self.adapter = adapter
+        self.cache = DynamicCache()
+        self.position = 0
+    
+    @property
+    def remaining(self):
+        return self.input_ids.shape[1] - 1 - self.position
+    
+    @property
+    def done(self):
+        # 最后一个token留给 generate 计算第一步的logits
+        return self.position >= self.input_ids.shape[1] - 1
+
+def _pad_left(tensor, length, dim):
+    """在 dim 维左侧补 length 个0"""
+    if length <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = length
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+class DecodeBatch:
+    """连续批处理的解码批次：预填充完成的请求随时加入，LocalLLM.decode_step() 为每行解码一个token，结束的行随时移除
+    
+    各行KV缓存长度不同，合并时左侧补零并由注意力掩码屏蔽，位置编码按每行自己的实际长度计算
+    """
+    
+    def __init__(self):
+        self.cache = None
+        self.mask = None        # [行数, 缓存长度]，补齐部分为0
+        self.next_ids = None    # [行数, 1]，下一步的输入token
+        self.seen = []          # 每行的输入+已生成token（重复惩罚用）
+        self.temperatures = []
+        self.adapters = []
+    
+    def __len__(self):
+        return len(self.seen)
+    
+    def add(self, state, temperature, adapter=None):
+        """加入一个预填充完成的请求（其KV缓存覆盖除最后一个输入token之外的全部输入）"""
+        length = state.cache.get_seq_length()
+        mask = torch.ones((1, length), dtype=torch.long, device=state.input_ids.device)
+        if self.cache is None:
+            self.cache, self.mask, self.next_ids = state.cache, mask, state.input_ids[:, -1:]
+        else:
+            current = self.mask.shape[1]
+            target = max(current, length)
+            for layer, new_layer in zip(self.cache.layers, state.cache.layers):
+                layer.keys = torch.cat([_pad_left(layer.keys, target - current, -2),
+                                        _pad_left(new_layer.keys, target - length, -2)])
+                layer.values = torch.cat([_pad_left(layer.values, target - current, -2),
+                                          _pad_left(new_layer.values, target - length, -2)])
+            self.mask = torch.cat([_pad_left(self.mask, target - current, 1), _pad_left(mask, target - length, 1)])
+            self.next_ids = torch.cat([self.next_ids, state.input_ids[:, -1:]])
+        self.seen.append(state.input_ids[0])
+        self.temperatures.append(temperature)
+        self.adapters.append(adapter)
+    
+    def remove(self, rows):
+        """移除若干行；去掉所有行都是补齐的左侧列"""
+        rows = set(rows)
+        keep = [row for row in range(len(self)) if row not in rows]
+        if not keep:
+            self.__init__()
+            return
+        if len(keep) < len(self):
+            index = torch.tensor(keep, device=self.mask.device)
+            self.cache.batch_select_indices(index)
+            self.mask = self.mask[index]
+            self.next_ids = self.next_ids[index]
+            self.seen = [self.seen[row] for row in keep]
+            self.temperatures = [self.temperatures[row] for row in keep]
+            self.adapters = [self.adapters[row] for row in keep]
+        first = int(self.mask.any(dim=0).int().argmax())
+        if first:
+            for layer in self.cache.layers:
+                layer.keys = layer.keys[:, :, first:]
+                layer.values = layer.values[:, :, first:]
+            self.mask = self.mask[:, first:]
+
 class LocalLLM:
-    def __init__(self, model_path):
+    def __init__(self, model_path, compile_mode=None, backend=None, profile=None):
         self.model_path = model_path
         self.tokenizer = None
         self.model = None
         self.device = self._get_device()
+        self.placement = None
+        
+        # 推理后端（config.ENGINE_CONFIG）；compile_mode 显式指定时覆盖编译/eager的选择
+        if backend is None and compile_mode is not None:
+            backend = "compiled" if compile_mode else "eager"
+        self.backend = get_backend(backend)
+        self._backend_explicit = backend is not None or ENGINE_CONFIG["backend"] != "auto"
+        
+        # 自动调优配置（autotune.py）：None 表示加载时使用当前硬件上保存的调优结果，{} 表示不调优的默认配置
+        self.profile = profile
+        
+        # 编译解码模式状态
+        self.compiled = False
+        self.compile_stats = {}
+        self._eager_forward = None
+        
+        # LoRA适配器（按需加载）
+        self.adapters = AdapterCache(self)
+        
+        # 语义缓存（模型加载后按配置启用）
+        self.semantic_cache = None
+        
+        # 空闲管理：长时间无请求时释放缓存、卸载权重
+        self.idle_manager = None
+        self.unloaded = False
+        self.last_activity = None
+        self._active_requests = 0
+        self._state_lock = threading.RLock()
         
     def _get_device(self):
         """获取可用设备"""
@@ -45,6 +200,15 @@ class LocalLLM:
                     logger.error(f"缺少必要文件: {file_path}")
                     return False
             
+            # 快速完整性检查：分片文件头、缺失分片，以及校验后又发生变化的文件
+            if VERIFY_CONFIG["preflight"]:
+                report = verify_model_files(self.model_path, full=False)
+                if not report["ok"]:
+                    for problem in report["problems"]:
+                        logger.error(f"模型文件校验失败: {problem}")
+                    return False
+                logger.info(f"模型文件校验通过，耗时 {report['elapsed'] * 1000:.0f} ms")
+            
             # 加载分词器
             logger.info("正在加载分词器...")
             self.tokenizer = AutoTokenizer.from_pretrained(
@@ -53,54 +217,38 @@ class LocalLLM:
                 local_files_only=True
             )
             
-            # 设置模型加载参数
-            model_kwargs = {
-                "torch_dtype": torch.bfloat16 if self.device == "cuda" else torch.float32,
-                "device_map": "auto" if self.device == "cuda" else None,
+            # 由后端决定精度、量化方式和逐层放置
+            self._apply_profile()
+            self.placement, model_kwargs = self.backend.plan(self)
+            model_kwargs.update({
                 "trust_remote_code": True,
                 "local_files_only": True
-            }
+            })
+            if self.profile.get("attn_implementation") and not self.placement.get("streaming"):
+                model_kwargs["attn_implementation"] = self.profile["attn_implementation"]
             
-            # 如果GPU显存不足，启用量化模式
-            if self.device == "cuda":
-                total_memory = torch.cuda.get_device_properties(0).total_memory / 1024**3
-                if total_memory < 12:  # 如果显存小于12GB
-                    logger.info("GPU显存较小，启用4bit量化模式")
-                    
-                    # 配置4bit量化（推荐）
-                    quantization_config = BitsAndBytesConfig(
-                        load_in_4bit=True,
-                        bnb_4bit_compute_dtype=torch.float16,
-                        bnb_4bit_use_double_quant=True,
-                        bnb_4bit_quant_type="nf4",
-                        llm_int8_enable_fp32_cpu_offload=True  # 允许CPU卸载
-                    )
-                    
-                    model_kwargs.update({
-                        "quantization_config": quantization_config,
-                        "torch_dtype": torch.float16,
-                        "low_cpu_mem_usage": True
-                    })
+            # 输入放在第一层所在的设备上
+            devices = set(self.placement["device_map"].values())
+            self.device = "cuda" if 0 in devices else "cpu"
             
             # 加载模型
             logger.info("正在加载模型...")
-            self.model = AutoModelForCausalLM.from_pretrained(
-                self.model_path,
-                **model_kwargs
-            )
+            self.model = self.backend.load(self, model_kwargs)
             
-            # 如果使用CPU，移动模型到CPU
-            if self.device == "cpu":
-                self.model = self.model.to("cpu")
-            
-            logger.info("模型加载完成！")
+            self.backend.prepare(self)
+            logger.info(f"模型加载完成！（{self.backend.name} 后端）")
+            if SEMANTIC_CACHE_CONFIG["enabled"] and self.semantic_cache is None:
+                self.enable_semantic_cache()
+            self.last_activity = time.time()
+            if IDLE_CONFIG["enabled"] and self.idle_manager is None:
+                self.idle_manager = IdleManager(self)
             return True
             
         except Exception as e:
             logger.error(f"模型加载失败: {e}")
             
-            # 如果是显存相关错误，尝试CPU模式
-            if any(keyword in str(e).lower() for keyword in ["out of memory", "dispatch", "cpu", "disk"]):
+            # 放置计划已按可用内存规划，只有仍然显存不足时才回退到CPU模式
+            if isinstance(e, torch.cuda.OutOfMemoryError) or "out of memory" in str(e).lower():
                 logger.warning("GPU加载失败，尝试使用CPU模式（速度较慢）...")
                 try:
                     # CPU模式重新加载
@@ -131,59 +279,726 @@ class LocalLLM:
                 logger.error("3. 使用更小的模型")
             return False
     
-    def generate_response(self, user_input, max_length=512, temperature=0.7):
-        """生成回复"""
+    def _apply_profile(self):
+        """应用自动调优结果：线程数和推理后端（构造时显式指定后端则不替换）；加载方式和注意力实现在规划/加载时使用"""
+        if self.profile is None:
+            self.profile = (load_profile(self.model_path) if AUTOTUNE_CONFIG["apply"] else None) or {}
+            if self.profile:
+                logger.info(f"应用自动调优结果: {self.profile}")
+        if self.profile.get("threads"):
+            torch.set_num_threads(min(self.profile["threads"], available_cpus()))
+        backend = self.profile.get("backend")
+        if backend and not self._backend_explicit and backend != self.backend.name:
+            self.backend = get_backend(backend)
+    
+    def _build_prompt(self, user_input):
+        """构建对话格式并应用聊天模板"""
+        messages = [
+            {"role": "system", "content": "你是一个有用的AI助手。"},
+            {"role": "user", "content": user_input}
+        ]
+        return self.tokenizer.apply_chat_template(
+            messages,
+            tokenize=False,
+            add_generation_prompt=True
+        )
+    
+    def count_tokens(self, text):
+        """统计文本的token数"""
+        return len(self.tokenizer(text).input_ids)
+    
+    def _adapter_kwargs(self, adapters):
+        """加载请求用到的LoRA适配器，返回传给 generate 的参数"""
+        if not any(adapters) and not self.adapters.loaded:
+            return {}
+        return {"adapter_names": self.adapters.activate(adapters)}
+    
+    @_tracks_activity
+    def generate_response(self, user_input, max_length=None, temperature=None, regex=None, json_schema=None, adapter=None,
+                          details=False, top_logprobs=0, stop=None, stop_token_ids=None):
+        """生成回复；提供 regex 或 json_schema 时启用约束解码，adapter 指定使用的LoRA适配器
+        
+        max_length/temperature/stop 未指定时使用 config.GENERATION_CONFIG。
+        stop 为停止字符串（或列表），stop_token_ids 为停止token序列列表，匹配完成的那一步即结束生成，
+        停止字符串/序列本身不包含在回复中。
+        details=True 时返回 {"text", "token_ids", "logprobs", "times_ms"}（数组，见 token_trace.TokenTrace），
+        top_logprobs>0 时另附每步概率最高的k个候选
+        """
         if not self.model or not self.tokenizer:
-            return "错误：模型未加载"
+            return {"text": "错误：模型未加载", "error": "模型未加载"} if details else "错误：模型未加载"
         
+        trace = None
         try:
-            # 构建对话格式
-            messages = [
-                {"role": "system", "content": "你是一个有用的AI助手。"},
-                {"role": "user", "content": user_input}
-            ]
-            
-            # 应用聊天模板
-            text = self.tokenizer.apply_chat_template(
-                messages,
-                tokenize=False,
-                add_generation_prompt=True
-            )
+            # 语义缓存：近似重复且生成参数相同的问题直接返回缓存回答（约束解码和逐token记录的请求不走缓存）
+            stop = GENERATION_CONFIG["stop"] if stop is None else stop
+            stop = [stop] if isinstance(stop, str) else list(stop)
+            use_cache = (self.semantic_cache is not None and regex is None and json_schema is None and not details
+                         and not stop and not stop_token_ids)
+            if use_cache:
+                cached, cache_key = self.semantic_lookup(user_input, adapter, max_length, temperature)
+                if cached is not None:
+                    return cached
             
-            # 编码输入
-            model_inputs = self.tokenizer([text], return_tensors="pt")
+            # 构建对话格式并编码输入
+            text = self._build_prompt(user_input)
+            model_inputs = self._encode(text)
             
-            # 确保输入在正确的设备上
-            if self.device == "cuda" and torch.cuda.is_available():
-                model_inputs = model_inputs.to("cuda")
-            else:
-                model_inputs = model_inputs.to("cpu")
+            # 约束解码：每步按自动机状态屏蔽非法token
+            gen_kwargs = self._adapter_kwargs([adapter])
+            constraint = None
+            if regex is not None or json_schema is not None:
+                constraint = self.constraint_processor(regex=regex, json_schema=json_schema)
+                gen_kwargs["logits_processor"] = LogitsProcessorList([constraint])
+            
+            # 逐token记录：作为streamer接收每步采样出的token，从输出层钩子取本步logits
+            if details:
+                trace = TokenTrace(top_k=top_logprobs).attach(self.model)
+                gen_kwargs["streamer"] = trace
+            
+            # 停止序列：每步增量匹配新生成的token
+            stopper = None
+            if stop or stop_token_ids:
+                stopper = StopSequenceCriteria(self.tokenizer, stop=stop, stop_token_ids=stop_token_ids)
+                gen_kwargs["stopping_criteria"] = StoppingCriteriaList([stopper])
             
             # 生成回复
-            with torch.no_grad():
-                generated_ids = self.model.generate(
-                    model_inputs.input_ids,
-                    max_new_tokens=max_length,
-                    temperature=temperature,
-                    do_sample=True,
-                    pad_token_id=self.tokenizer.eos_token_id,
-                    attention_mask=model_inputs.attention_mask
-                )
+            generated_ids = self._generate(
+                model_inputs,
+                pad_token_id=self.tokenizer.eos_token_id,
+                **self._sampling_kwargs(max_length, temperature),
+                **gen_kwargs
+            )
             
-            # 解码回复
-            generated_ids = [
-                output_ids[len(input_ids):] for input_ids, output_ids in 
-                zip(model_inputs.input_ids, generated_ids)
-            ]
+            if constraint is not None:
+                logger.info(f"约束解码: {constraint.steps} 步, 掩码开销 {constraint.mask_ms_per_token:.3f} ms/token")
             
-            response = self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
-            return response.strip()
+            # 解码回复
+            with record_function("llm.decode_text"):
+                generated_ids = [
+                    output_ids[len(input_ids):] for input_ids, output_ids in 
+                    zip(model_inputs.input_ids, generated_ids)
+                ]
+                match = stopper.matches[0] if stopper is not None and stopper.rows else None
+                if match is not None and match["text_end"] is None:
+                    # token序列匹配：去掉停止序列本身
+                    generated_ids[0] = generated_ids[0][:match["kept_tokens"]]
+                response = self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
+                response = truncate_text(response, match).strip()
+            if use_cache:
+                self.semantic_insert(cache_key, user_input, response)
+            if details:
+                # 逐token数组截到与停止字符串/序列重叠的第一个token之前
+                return {"text": response, **trace.result(match["kept_tokens"] if match is not None else None)}
+            return response
             
         except Exception as e:
             logger.error(f"生成回复时出错: {e}")
             if "out of memory" in str(e).lower():
-                return "错误：GPU显存不足，请减少输入长度或重启程序"
-            return f"错误：{e}"
+                message = "错误：GPU显存不足，请减少输入长度或重启程序"
+            else:
+                message = f"错误：{e}"
+            return {"text": message, "error": str(e)} if details else message
+        finally:
+            if trace is not None:
+                trace.detach()
+    
+    @_tracks_activity
+    def generate_batch(self, prompts, adapters=None, max_length=None, temperature=None,
+                       prefixes=None, should_stop=None, details=False):
+        """把多个请求合并为一个批次解码，每个请求可以使用不同的LoRA适配器
+        
+        prefixes 为每个请求已生成的部分回复（被抢占后继续生成）；should_stop 在每个解码步之后调用，
+        返回True时提前结束本批次。details=True 时返回 {"text", "tokens", "finished"} 列表
+        """
+        if not self.model or not self.tokenizer:
+            raise RuntimeError("模型未加载")
+        
+        adapters = adapters or [None] * len(prompts)
+        prefixes = prefixes or [""] * len(prompts)
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.tokenizer.padding_side = "left"
+        
+        with record_function("llm.encode"):
+            texts = [self._build_prompt(prompt) + prefix for prompt, prefix in zip(prompts, prefixes)]
+            model_inputs = self.tokenizer(texts, return_tensors="pt", padding=True)
+            model_inputs = model_inputs.to("cuda" if self.device == "cuda" and torch.cuda.is_available() else "cpu")
+        
+        gen_kwargs = self._adapter_kwargs(adapters)
+        if should_stop is not None:
+            gen_kwargs["stopping_criteria"] = StoppingCriteriaList([_YieldCriteria(should_stop)])
+        generated_ids = self._generate(
+            model_inputs,
+            pad_token_id=self.tokenizer.pad_token_id,
+            **self._sampling_kwargs(max_length, temperature),
+            **gen_kwargs
+        )
+        
+        # 左填充后所有请求的输入长度相同
+        prompt_length = model_inputs.input_ids.shape[1]
+        new_ids = generated_ids[:, prompt_length:]
+        with record_function("llm.decode_text"):
+            responses = self.tokenizer.batch_decode(new_ids, skip_special_tokens=True)
+        if not details:
+            return [response.strip() for response in responses]
+        
+        eos_ids = self._eos_ids()
+        results = []
+        for row, response in zip(new_ids.tolist(), responses):
+            end = next((i for i, token in enumerate(row) if token in eos_ids), None)
+            results.append({
+                "text": response,
+                "tokens": len(row) if end is None else end,
+                "finished": end is not None
+            })
+        return results
+    
+    @_tracks_activity
+    def generate_candidates(self, user_input, n=1, best_of=None, max_length=None, temperature=None, adapter=None,
+                            stop=None, stop_token_ids=None):
+        """采样多个候选回复：输入只预填充一次，KV缓存复制给 best_of 个序列作为一个批次并行解码，
+        按每token平均对数概率排序后返回前 n 个 [{"text", "logprob", "tokens"}]；stop/stop_token_ids 对每个候选分别匹配
+        """
+        if not self.model or not self.tokenizer:
+            raise RuntimeError("模型未加载")
+        best_of = max(best_of or n, n)
+        
+        # 不做分桶填充：前缀缓存按实际长度计算
+        with record_function("llm.encode"):
+            model_inputs = self.tokenizer([self._build_prompt(user_input)], return_tensors="pt")
+            model_inputs = model_inputs.to("cuda" if self.device == "cuda" and torch.cuda.is_available() else "cpu")
+        input_ids = model_inputs.input_ids
+        adapter_kwargs = self._adapter_kwargs([adapter])
+        
+        # 除最后一个token外预填充一次，再把KV缓存按批次维度复制 best_of 份
+        with record_function("llm.prefill"), torch.no_grad():
+            cache = DynamicCache()
+            self.model(input_ids[:, :-1], past_key_values=cache, use_cache=True, **adapter_kwargs)
+            cache.batch_repeat_interleave(best_of)
+        if adapter_kwargs:
+            adapter_kwargs = {"adapter_names": adapter_kwargs["adapter_names"] * best_of}
+        stop = GENERATION_CONFIG["stop"] if stop is None else stop
+        stopper = None
+        if stop or stop_token_ids:
+            stopper = StopSequenceCriteria(self.tokenizer, stop=stop, stop_token_ids=stop_token_ids)
+            adapter_kwargs["stopping_criteria"] = StoppingCriteriaList([stopper])
+        
+        with record_function("llm.generate"), torch.no_grad():
+            output = self.model.generate(
+                input_ids.repeat(best_of, 1),
+                attention_mask=torch.ones_like(input_ids).repeat(best_of, 1),
+                past_key_values=cache,
+                pad_token_id=self.tokenizer.eos_token_id,
+                return_dict_in_generate=True,
+                output_logits=True,
+                **self._sampling_kwargs(max_length, temperature),
+                **adapter_kwargs
+            )
+        
+        new_ids = output.sequences[:, input_ids.shape[1]:]
+        token_logprobs, lengths = self._token_logprobs(output.logits, new_ids)
+        with record_function("llm.decode_text"):
+            texts = self.tokenizer.batch_decode(new_ids, skip_special_tokens=True)
+        if stopper is not None:
+            # 命中停止序列的候选：有效长度截到匹配完成的那一步，文本去掉停止字符串/序列
+            for i, match in enumerate(stopper.matches):
+                if match is None:
+                    continue
+                lengths[i] = match["tokens"]
+                if match["text_end"] is None:
+                    texts[i] = self.tokenizer.decode(new_ids[i, :match["kept_tokens"]], skip_special_tokens=True)
+                else:
+                    texts[i] = truncate_text(texts[i], match)
+        candidates = [
+            {
+                "text": text.strip(),
+                "logprob": float(token_logprobs[i, :lengths[i]].sum() / max(int(lengths[i]), 1)),
+                "tokens": int(lengths[i])
+            }
+            for i, text in enumerate(texts)
+        ]
+        candidates.sort(key=lambda candidate: candidate["logprob"], reverse=True)
+        return candidates[:n]
+    
+    @_tracks_activity
+    def begin_prefill(self, user_input, prefix="", adapter=None):
+        """开始分块预填充：之后反复调用 prefill_chunk() 直到完成，再加入 DecodeBatch 或用 generate_prefilled() 解码
+        
+        调度器把每块作为一个调度步的一部分，长输入不会一次占用模型数秒；不支持编译模式
+        """
+        if not self.model or not self.tokenizer:
+            raise RuntimeError("模型未加载")
+        with record_function("llm.encode"):
+            input_ids = self.tokenizer([self._build_prompt(user_input) + prefix], return_tensors="pt").input_ids
+            input_ids = input_ids.to("cuda" if self.device == "cuda" and torch.cuda.is_available() else "cpu")
+        if adapter:
+            # 先加载适配器：不存在时只让这个请求失败，而不是与它合并预填充的其他请求
+            self._adapter_kwargs([adapter])
+        return _PrefillState(input_ids, adapter)
+    
+    @_tracks_activity
+    def prefill_chunk(self, state, chunk_size=None):
+        """预填充下一块（最多 chunk_size 个token，None 表示剩余全部），返回是否已全部完成"""
+        end = state.input_ids.shape[1] - 1
+        if chunk_size:
+            end = min(state.position + chunk_size, end)
+        if end > state.position:
+            with record_function("llm.prefill_chunk"), torch.no_grad():
+                # 预填充只需要KV缓存，不计算各位置的输出logits
+                self.model(
+                    state.input_ids[:, state.position:end],
+                    past_key_values=state.cache,
+                    use_cache=True,
+                    logits_to_keep=1,
+                    **self._adapter_kwargs([state.adapter])
+                )
+            state.position = end
+        return state.done
+    
+    @_tracks_activity
+    def prefill_batch(self, states):
+        """一次前向完成多个尚未开始的预填充（左填充对齐），KV缓存按行写回各自的 state"""
+        if len(states) == 1:
+            return self.prefill_chunk(states[0])
+        pieces = [state.input_ids[0, :-1] for state in states]
+        length = max(len(piece) for piece in pieces)
+        pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+        input_ids = torch.stack([_pad_left(piece, length - len(piece), 0) for piece in pieces])
+        mask = torch.stack([_pad_left(torch.ones_like(piece), length - len(piece), 0) for piece in pieces])
+        input_ids[mask == 0] = pad_id
+        cache = DynamicCache()
+        with record_function("llm.prefill_chunk"), torch.no_grad():
+            self.model(
+                input_ids,
+                attention_mask=mask,
+                position_ids=(mask.cumsum(dim=1) - 1).clamp(min=0),
+                past_key_values=cache,
+                use_cache=True,
+                logits_to_keep=1,
+                **self._adapter_kwargs([state.adapter for state in states])
+            )
+        for row, (state, piece) in enumerate(zip(states, pieces)):
+            start = length - len(piece)
+            for index, layer in enumerate(cache.layers):
+                state.cache.update(layer.keys[row:row + 1, :, start:], layer.values[row:row + 1, :, start:], index)
+            state.position = len(piece)
+        return True
+    
+    def new_decode_batch(self):
+        return DecodeBatch()
+    
+    @_tracks_activity
+    def decode_step(self, batch):
+        """为批次中每行解码一个token，返回新token ID列表（采样参数同 config.GENERATION_CONFIG，温度按行）"""
+        mask = torch.cat([batch.mask, batch.mask.new_ones((len(batch), 1))], dim=1)
+        positions = batch.mask.sum(dim=1, keepdim=True)
+        with record_function("llm.decode_step"), torch.no_grad():
+            logits = self.model(
+                batch.next_ids,
+                attention_mask=mask,
+                position_ids=positions,
+                past_key_values=batch.cache,
+                use_cache=True,
+                **self._adapter_kwargs(batch.adapters)
+            ).logits[:, -1, :].float()
+            tokens = self._sample_next(logits, batch.seen, batch.temperatures)
+        batch.mask = mask
+        batch.next_ids = tokens.unsqueeze(1)
+        batch.seen = [torch.cat([seen, token.view(1)]) for seen, token in zip(batch.seen, tokens)]
+        return tokens.tolist()
+    
+    def _sample_next(self, logits, seen, temperatures):
+        """与 generate 相同的处理顺序：重复惩罚、温度、top-k/top-p，再采样（do_sample=False 时取最大值）"""
+        penalty = GENERATION_CONFIG["repetition_penalty"]
+        if penalty != 1.0:
+            for row, ids in enumerate(seen):
+                scores = logits[row, ids]
+                logits[row, ids] = torch.where(scores < 0, scores * penalty, scores / penalty)
+        if not GENERATION_CONFIG["do_sample"]:
+            return logits.argmax(dim=-1)
+        default = GENERATION_CONFIG["temperature"]
+        temperatures = torch.tensor([default if t is None else max(float(t), 1e-5) for t in temperatures],
+                                    device=logits.device)
+        logits = logits / temperatures.unsqueeze(1)
+        top_k = getattr(self.model.generation_config, "top_k", None)
+        if top_k:
+            logits = TopKLogitsWarper(top_k)(None, logits)
+        logits = TopPLogitsWarper(GENERATION_CONFIG["top_p"])(None, logits)
+        return torch.multinomial(torch.softmax(logits, dim=-1), num_samples=1).squeeze(1)
+    
+    @_tracks_activity
+    def generate_prefilled(self, state, max_length=None, temperature=None, should_stop=None):
+        """从预填充好的KV缓存继续生成，返回 {"text", "tokens", "finished"}（同 generate_batch 的 details）
+        
+        因 should_stop 让出而未完成时，state 更新为包含已生成token的输入，再次调用即从KV缓存继续解码
+        """
+        input_ids = state.input_ids
+        gen_kwargs = self._adapter_kwargs([None])
+        if should_stop is not None:
+            gen_kwargs["stopping_criteria"] = StoppingCriteriaList([_YieldCriteria(should_stop)])
+        with record_function("llm.generate"), torch.no_grad():
+            output = self.model.generate(
+                input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=state.cache,
+                pad_token_id=self.tokenizer.eos_token_id,
+                **self._sampling_kwargs(max_length, temperature),
+                **gen_kwargs
+            )
+        
+        row = output[0, input_ids.shape[1]:]
+        with record_function("llm.decode_text"):
+            text = self.tokenizer.decode(row, skip_special_tokens=True)
+        eos_ids = self._eos_ids()
+        end = next((i for i, token in enumerate(row.tolist()) if token in eos_ids), None)
+        if end is None:
+            # KV缓存已包含除最后一个token之外的全部序列，与预填充完成时的状态一致
+            state.input_ids = output
+            state.position = output.shape[1] - 1
+        return {"text": text, "tokens": len(row) if end is None else end, "finished": end is not None}
+    
+    def start_session(self, sink_tokens=None, window_tokens=None):
+        """开始一个流式上下文对话：KV缓存跨轮次保留，只保留sink token和最近的窗口（见 streaming_context）"""
+        if not self.model or not self.tokenizer:
+            raise RuntimeError("模型未加载")
+        if self.compiled:
+            raise RuntimeError("编译模式不支持流式上下文")
+        return ContextSession(self, sink_tokens=sink_tokens, window_tokens=window_tokens)
+    
+    def _eos_ids(self):
+        eos_ids = self.model.generation_config.eos_token_id
+        return set(eos_ids if isinstance(eos_ids, list) else [eos_ids, self.tokenizer.eos_token_id])
+    
+    def _token_logprobs(self, step_logits, new_ids):
+        """由生成时已有的原始logits计算每个生成token的对数概率（不需要额外的前向计算）
+        
+        返回 (对数概率 [批次, 步数], 每个序列的有效长度)；有效长度包含第一个结束符，之后的填充不计
+        """
+        logprobs = torch.stack(
+            [torch.log_softmax(logits.float(), dim=-1) for logits in step_logits],
+            dim=1
+        )
+        token_logprobs = logprobs.gather(-1, new_ids[:, :logprobs.shape[1]].unsqueeze(-1)).squeeze(-1)
+        is_eos = torch.zeros_like(new_ids, dtype=torch.bool)
+        for eos_id in self._eos_ids():
+            is_eos |= new_ids == eos_id
+        # 第一个结束符的位置 + 1；没有结束符时为全部步数
+        has_eos = is_eos.any(dim=1)
+        first_eos = is_eos.int().argmax(dim=1)
+        lengths = torch.where(has_eos, first_eos + 1, torch.full_like(first_eos, new_ids.shape[1]))
+        return token_logprobs.cpu(), lengths.cpu()
+    
+    def stream_response(self, user_input, max_length=None, temperature=None, adapter=None, stop=None, stop_token_ids=None):
+        """流式生成回复，逐段产出新生成的文本；停止字符串和停止token序列对应的文本不会被发出"""
+        self._begin_request()
+        try:
+            if not self.model or not self.tokenizer:
+                yield "错误：模型未加载"
+                return
+            
+            # 语义缓存：命中时整段发出缓存的回答；未命中时生成完整结束后写入（带停止条件的请求不走缓存）
+            stop = GENERATION_CONFIG["stop"] if stop is None else stop
+            stop = [stop] if isinstance(stop, str) else [text for text in stop if text]
+            cache_key = None
+            if not stop and not stop_token_ids:
+                cached, cache_key = self.semantic_lookup(user_input, adapter, max_length, temperature)
+                if cached is not None:
+                    yield cached
+                    return
+            
+            model_inputs = self._encode(self._build_prompt(user_input))
+            if stop_token_ids:
+                # 停止token序列在token层面暂扣，匹配时整段丢弃
+                streamer = StopTokenStreamer(self.tokenizer, stop_token_ids, skip_prompt=True, skip_special_tokens=True)
+            else:
+                streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+            gen_kwargs = self._adapter_kwargs([adapter])
+            if stop or stop_token_ids:
+                gen_kwargs["stopping_criteria"] = StoppingCriteriaList([
+                    StopSequenceCriteria(self.tokenizer, stop=stop, stop_token_ids=stop_token_ids)
+                ])
+            errors = []
+            
+            def run():
+                try:
+                    self._generate(
+                        model_inputs,
+                        streamer=streamer,
+                        pad_token_id=self.tokenizer.eos_token_id,
+                        **self._sampling_kwargs(max_length, temperature),
+                        **gen_kwargs
+                    )
+                except Exception as e:
+                    errors.append(e)
+                    streamer.end()
+            
+            thread = threading.Thread(target=run, name="llm-stream", daemon=True)
+            thread.start()
+            # streamer在停止判断之前收到本步token，所以停止字符串会先到达这里：
+            # 末尾可能是停止字符串开头的部分暂不发出，匹配到停止字符串时只发出它之前的文本
+            pending, stopped = "", False
+            chunks = []
+            for chunk in streamer:
+                if stopped:
+                    continue
+                if not stop:
+                    chunks.append(chunk)
+                    yield chunk
+                    continue
+                pending += chunk
+                index = min((i for i in (pending.find(text) for text in stop) if i >= 0), default=-1)
+                if index >= 0:
+                    pending, stopped = pending[:index], True
+                    held = 0
+                else:
+                    held = held_suffix(pending, stop)
+                if len(pending) > held:
+                    yield pending[:len(pending) - held]
+                    pending = pending[len(pending) - held:]
+            if pending and not stopped:
+                yield pending
+            thread.join()
+            if errors:
+                logger.error(f"生成回复时出错: {errors[0]}")
+                yield f"\n错误：{errors[0]}"
+            else:
+                self.semantic_insert(cache_key, user_input, "".join(chunks).strip())
+        finally:
+            self._end_request()
+    
+    def _sampling_kwargs(self, max_length=None, temperature=None):
+        """采样参数，未指定的项使用 config.GENERATION_CONFIG"""
+        return {
+            "max_new_tokens": int(max_length or GENERATION_CONFIG["max_new_tokens"]),
+            "temperature": GENERATION_CONFIG["temperature"] if temperature is None else float(temperature),
+            "top_p": GENERATION_CONFIG["top_p"],
+            "do_sample": GENERATION_CONFIG["do_sample"],
+            "repetition_penalty": GENERATION_CONFIG["repetition_penalty"]
+        }
+    
+    def _cache_namespace(self, adapter, max_length, temperature):
+        """语义缓存的命名空间：适配器和全部生成参数都相同的请求才能共用缓存的回答"""
+        sampling = self._sampling_kwargs(max_length, temperature)
+        return "|".join([adapter or ""] + [f"{key}={value}" for key, value in sorted(sampling.items())])
+    
+    def semantic_lookup(self, user_input, adapter=None, max_length=None, temperature=None):
+        """查语义缓存，返回 (缓存的回答或None, 写回缓存用的键)；未启用语义缓存时返回 (None, None)"""
+        if self.semantic_cache is None:
+            return None, None
+        self._begin_request()
+        try:
+            with record_function("llm.semantic_cache"):
+                vector = self.semantic_cache.embed(user_input)
+                namespace = self._cache_namespace(adapter, max_length, temperature)
+                return self.semantic_cache.lookup(vector, namespace=namespace), (vector, namespace)
+        finally:
+            self._end_request()
+    
+    def semantic_insert(self, key, user_input, response):
+        """把生成的回答写入语义缓存；key 为 semantic_lookup 返回的键（None 或空回答时不写入）"""
+        if key is not None and response:
+            vector, namespace = key
+            self.semantic_cache.insert(vector, user_input, response, namespace=namespace)
+    
+    def _begin_request(self, load=True):
+        """开始一个请求：在 _end_request 之前模型不会被空闲释放或卸载；
+        load=False 时只计数，不在调用线程中重新加载（由之后真正执行推理的调用加载）"""
+        with self._state_lock:
+            if load and self.unloaded:
+                self.ensure_loaded()
+            self._active_requests += 1
+            self.last_activity = time.time()
+        if self.idle_manager is not None:
+            self.idle_manager.on_activity()
+    
+    def _end_request(self):
+        with self._state_lock:
+            self._active_requests -= 1
+            self.last_activity = time.time()
+    
+    def idle_seconds(self):
+        """距上次请求的空闲秒数；有请求在执行或尚未加载时返回 None"""
+        if self.last_activity is None or self._active_requests:
+            return None
+        return time.time() - self.last_activity
+    
+    def ensure_loaded(self):
+        """模型因空闲被卸载时重新加载（权重以内存映射方式读取，放置计划已缓存）"""
+        with self._state_lock:
+            if not self.unloaded:
+                return True
+            start = time.perf_counter()
+            if not self.load_model():
+                return False
+            self.unloaded = False
+            if self.idle_manager is not None:
+                self.idle_manager.on_reload(time.perf_counter() - start)
+            return True
+    
+    def release_caches(self):
+        """释放KV缓存和分配器缓存，保留权重；有请求在执行时不做处理"""
+        with self._state_lock:
+            if self._active_requests or self.model is None:
+                return False
+            # 编译模式下 generate 保留的静态KV缓存，下次请求时重新分配
+            if getattr(self.model, "_cache", None) is not None:
+                self.model._cache = None
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            trim_process_heap()
+            return True
+    
+    def unload_model(self):
+        """卸载模型权重，保留分词器；下次请求时自动重新加载"""
+        with self._state_lock:
+            if self._active_requests or self.model is None:
+                return False
+            if self.compiled:
+                self.disable_compile()
+            streamer = getattr(self.model, "_layer_streamer", None)
+            if streamer is not None:
+                streamer.close()
+            self.model = None
+            self.adapters.clear()
+            self.unloaded = True
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            return True
+    
+    def enable_semantic_cache(self, **overrides):
+        """启用语义缓存；缓存按模型（或编码模型）分目录持久化"""
+        encoder = overrides.get("encoder_path", SEMANTIC_CACHE_CONFIG["encoder_path"]) or self.model_path
+        path = os.path.join(
+            overrides.get("path", SEMANTIC_CACHE_CONFIG["path"]),
+            os.path.basename(os.path.normpath(encoder))
+        )
+        self.semantic_cache = SemanticCache(self, {**overrides, "path": path})
+        return self.semantic_cache
+    
+    def constraint_processor(self, regex=None, json_schema=None):
+        """创建约束解码的logits处理器（自动机按模式缓存，只编译一次）"""
+        automaton = get_automaton(self.tokenizer, regex=regex, json_schema=json_schema)
+        return GrammarLogitsProcessor(automaton)
+    
+    def _encode(self, text):
+        """编码输入（带profiler阶段标记）"""
+        with record_function("llm.encode"):
+            return self._encode_inputs(text)
+    
+    def _encode_inputs(self, text):
+        """编码输入；编译模式下左填充到分桶长度，使同一桶的请求复用编译图"""
+        if not self.compiled:
+            model_inputs = self.tokenizer([text], return_tensors="pt")
+        else:
+            length = len(self.tokenizer(text).input_ids)
+            bucket = self._bucket_for(length)
+            if bucket is None:
+                logger.warning(f"输入长度 {length} 超出最大分桶，将触发重新编译")
+                model_inputs = self.tokenizer([text], return_tensors="pt")
+            else:
+                model_inputs = self.tokenizer(
+                    [text],
+                    return_tensors="pt",
+                    padding="max_length",
+                    max_length=bucket
+                )
+        
+        # 确保输入在正确的设备上
+        if self.device == "cuda" and torch.cuda.is_available():
+            return model_inputs.to("cuda")
+        return model_inputs.to("cpu")
+    
+    def _bucket_for(self, length):
+        """返回不小于输入长度的最小分桶"""
+        for bucket in COMPILE_CONFIG["prompt_buckets"]:
+            if length <= bucket:
+                return bucket
+        return None
+    
+    def _generate(self, model_inputs, **gen_kwargs):
+        """生成（带profiler阶段标记）"""
+        with record_function("llm.generate"):
+            return self._run_generate(model_inputs, **gen_kwargs)
+    
+    def _run_generate(self, model_inputs, **gen_kwargs):
+        """调用model.generate；编译模式出错时自动回退到eager模式"""
+        if self.compiled:
+            shape_key = (model_inputs.input_ids.shape[1], gen_kwargs.get("max_new_tokens"))
+            first_call = shape_key not in self.compile_stats
+            start = time.perf_counter()
+            try:
+                with torch.no_grad():
+                    output = self.model.generate(
+                        model_inputs.input_ids,
+                        attention_mask=model_inputs.attention_mask,
+                        cache_implementation="static",
+                        **gen_kwargs
+                    )
+                if first_call:
+                    # 首次调用的耗时包含编译时间
+                    self.compile_stats[shape_key] = time.perf_counter() - start
+                    logger.info(f"编译完成: 输入长度 {shape_key[0]}, 首次调用耗时 {self.compile_stats[shape_key]:.1f} 秒")
+                return output
+            except Exception as e:
+                logger.warning(f"编译模式生成失败，回退到eager模式: {e}")
+                self.disable_compile()
+        
+        with torch.no_grad():
+            return self.model.generate(
+                model_inputs.input_ids,
+                attention_mask=model_inputs.attention_mask,
+                **gen_kwargs
+            )
+    
+    def enable_compile(self):
+        """启用编译解码模式（静态KV缓存 + torch.compile）"""
+        if not self.model or not self.tokenizer:
+            return False
+        if self.compiled:
+            return True
+        if not hasattr(torch, "compile"):
+            logger.warning("当前PyTorch不支持torch.compile，继续使用eager模式")
+            return False
+        
+        # 编译产物写入磁盘缓存，重启后无需重新编译
+        cache_dir = os.path.abspath(COMPILE_CONFIG["cache_dir"])
+        os.makedirs(cache_dir, exist_ok=True)
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", cache_dir)
+        os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+        os.environ.setdefault("TORCHINDUCTOR_AUTOGRAD_CACHE", "1")
+        
+        try:
+            from torch import _dynamo
+            # 遇到不支持的算子时该子图退回eager执行，而不是直接报错
+            _dynamo.config.suppress_errors = True
+            
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+            self.tokenizer.padding_side = "left"
+            
+            self._eager_forward = self.model.forward
+            self.model.forward = torch.compile(
+                self.model.forward,
+                mode=COMPILE_CONFIG["mode"],
+                fullgraph=False,
+                dynamic=False
+            )
+            self.compiled = True
+            logger.info(f"已启用编译解码模式，编译缓存目录: {cache_dir}")
+            return True
+        except Exception as e:
+            logger.warning(f"启用编译模式失败，继续使用eager模式: {e}")
+            self.disable_compile()
+            return False
+    
+    def disable_compile(self):
+        """关闭编译模式，恢复eager前向"""
+        if self._eager_forward is not None:
+            self.model.forward = self._eager_forward
+            self._eager_forward = None
+        self.compiled = False
     
     def test_model(self):
         """测试模型是否正常工作"""
@@ -197,3 +1012,34 @@ class LocalLLM:
         except Exception as e:
             logger.error(f"模型测试失败: {e}")
             return False
+    
+    def warmup(self, lengths=(16, 128, 512), max_new_tokens=8):
+        """用几组代表性长度预热模型，提前完成CUDA内核和显存分配器的初始化"""
+        if not self.model or not self.tokenizer:
+            return False
+        
+        device = next(self.model.parameters()).device
+        filler_id = self.tokenizer.eos_token_id
+        if filler_id is None:
+            filler_id = 0
+        
+        try:
+            for length in lengths:
+                start = time.perf_counter()
+                input_ids = torch.full((1, length), filler_id, dtype=torch.long, device=device)
+                attention_mask = torch.ones_like(input_ids)
+                with torch.no_grad():
+                    self.model.generate(
+                        input_ids,
+                        attention_mask=attention_mask,
+                        max_new_tokens=max_new_tokens,
+                        do_sample=False,
+                        pad_token_id=filler_id
+                    )
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                logger.info(f"预热完成: 输入长度 {length}, 耗时 {time.perf_counter() - start:.2f} 秒")
+            return True
+        except Exception as e:
+            logger.error(f"模型预热失败: {e}")
+            return False
@@ -0,0 +1,79 @@
+"""
+LoRA适配器按需加载与LRU缓存
+适配器存放在 ./models/<基础模型>/adapters/<适配器名>/ 下，共享同一份基础模型权重
+"""
+import os
+import threading
+import logging
+from collections import OrderedDict
+from config import LORA_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# peft 混合批次推理中表示"不使用适配器"的名称
+BASE_ADAPTER = "__base__"
+
+class AdapterCache:
+    """管理挂载在基础模型上的LoRA适配器"""
+    
+    def __init__(self, llm, max_loaded=None):
+        self.llm = llm
+        self.adapters_dir = os.path.join(llm.model_path, LORA_CONFIG["adapters_dir"])
+        self.max_loaded = max_loaded or LORA_CONFIG["max_loaded_adapters"]
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def available(self):
+        """列出磁盘上可用的适配器"""
+        if not os.path.isdir(self.adapters_dir):
+            return []
+        return sorted(
+            name for name in os.listdir(self.adapters_dir)
+            if os.path.exists(os.path.join(self.adapters_dir, name, "adapter_config.json"))
+        )
+    
+    @property
+    def loaded(self):
+        return list(self._loaded)
+    
+    def clear(self):
+        """模型被卸载后清空记录（适配器随模型一起释放）"""
+        with self._lock:
+            self._loaded.clear()
+    
+    def activate(self, names):
+        """确保请求用到的适配器都已加载，返回供 generate 使用的 adapter_names 列表"""
+        wanted = [name or BASE_ADAPTER for name in names]
+        with self._lock:
+            for name in dict.fromkeys(wanted):
+                if name != BASE_ADAPTER:
+                    self._load(name, keep=set(wanted))
+        return wanted
+    
+    def _load(self, name, keep):
+        if name in self._loaded:
+            self._loaded.move_to_end(name)
+            return
+        
+        path = os.path.join(self.adapters_dir, name)
+        if not os.path.exists(os.path.join(path, "adapter_config.json")):
+            raise ValueError(f"适配器不存在: {name}")
+        
+        from peft import PeftModel
+        logger.info(f"正在加载LoRA适配器: {name}")
+        if isinstance(self.llm.model, PeftModel):
+            self.llm.model.load_adapter(path, adapter_name=name)
+        else:
+            self.llm.model = PeftModel.from_pretrained(self.llm.model, path, adapter_name=name)
+            self.llm.model.eval()
+        self._loaded[name] = path
+        
+        # 超出容量时淘汰最久未使用、且不在当前批次中的适配器
+        for old in list(self._loaded):
+            if len(self._loaded) <= self.max_loaded:
+                break
+            if old in keep:
+                continue
+            self.llm.model.delete_adapter(old)
+            del self._loaded[old]
+            logger.info(f"已卸载LoRA适配器: {old}")
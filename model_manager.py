@@ -1,7 +1,141 @@
 import os
+import glob
+import json
+import mmap
+import time
+import struct
 import shutil
+import hashlib
 from pathlib import Path
-import json
+from concurrent.futures import ThreadPoolExecutor
+from config import VERIFY_CONFIG
+
+# 校验结果清单（文件大小/修改时间未变化时直接复用哈希）
+INTEGRITY_FILE = ".integrity.json"
+
+def hash_file(path, chunk_size=64 * 1024 * 1024):
+    """以内存映射方式读取并计算sha256（hashlib在大块数据上会释放GIL，可多线程并行）"""
+    sha = hashlib.sha256()
+    if os.path.getsize(path) == 0:
+        return sha.hexdigest()
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        try:
+            for offset in range(0, len(view), chunk_size):
+                sha.update(view[offset:offset + chunk_size])
+        finally:
+            view.release()
+    return sha.hexdigest()
+
+def check_safetensors(path):
+    """只读文件头检查分片是否完整：文件大小必须等于文件头记录的数据末尾位置"""
+    size = os.path.getsize(path)
+    try:
+        with open(path, 'rb') as f:
+            raw = f.read(8)
+            if len(raw) < 8:
+                return "文件头不完整"
+            header_size = struct.unpack("<Q", raw)[0]
+            if 8 + header_size > size:
+                return "文件头不完整"
+            header = json.loads(f.read(header_size))
+    except ValueError:
+        return "文件头无法解析"
+    end = max((info["data_offsets"][1] for name, info in header.items() if name != "__metadata__"), default=0)
+    expected = 8 + header_size + end
+    if size != expected:
+        return f"文件大小 {size} 与文件头记录的 {expected} 不一致（可能下载不完整）"
+    return None
+
+def _expected_sha256(model_path, file_name):
+    """snapshot_download 在 .cache/huggingface/download/ 中记录的LFS文件etag即为sha256"""
+    metadata = Path(model_path) / ".cache" / "huggingface" / "download" / f"{file_name}.metadata"
+    if not metadata.exists():
+        return None
+    lines = metadata.read_text(encoding='utf-8').splitlines()
+    etag = lines[1].strip().strip('"') if len(lines) > 1 else ""
+    return etag if len(etag) == 64 else None
+
+def _weight_files(model_path):
+    """返回 (权重文件列表, 缺失的分片)；有索引文件时以索引为准"""
+    index_file = os.path.join(model_path, "model.safetensors.index.json")
+    if os.path.exists(index_file):
+        with open(index_file, 'r', encoding='utf-8') as f:
+            names = sorted(set(json.load(f)["weight_map"].values()))
+        missing = [name for name in names if not os.path.exists(os.path.join(model_path, name))]
+        return [name for name in names if name not in missing], missing
+    patterns = ("*.safetensors", "*.bin")
+    names = sorted({os.path.basename(p) for pattern in patterns for p in glob.glob(os.path.join(model_path, pattern))})
+    return names, []
+
+def verify_model_files(model_path, full=True, workers=None):
+    """校验模型文件
+    
+    始终检查必要文件、缺失的分片和每个safetensors分片的文件头（只读文件头，很快）；
+    大小/修改时间与清单一致的文件复用清单中的哈希，其余文件：full=True 时全部重新计算，
+    full=False（加载前的快速检查）时只重新计算清单中已有但发生变化的文件。
+    下载时记录了sha256的文件会与之比对。返回 {"ok", "problems", "hashed", "cached", "elapsed", "files"}
+    """
+    start = time.perf_counter()
+    problems = []
+    for name in ("config.json", "tokenizer_config.json"):
+        if not os.path.exists(os.path.join(model_path, name)):
+            problems.append(f"缺少必要文件: {name}")
+    
+    names, missing = _weight_files(model_path)
+    problems += [f"缺少权重分片: {name}" for name in missing]
+    if not names and not missing:
+        problems.append("未找到权重文件")
+    for name in names:
+        if name.endswith(".safetensors"):
+            error = check_safetensors(os.path.join(model_path, name))
+            if error:
+                problems.append(f"{name}: {error}")
+    
+    manifest_file = os.path.join(model_path, INTEGRITY_FILE)
+    try:
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    
+    files, to_hash, cached = {}, [], 0
+    for name in names:
+        stat = os.stat(os.path.join(model_path, name))
+        entry = manifest.get(name)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            files[name] = entry
+            cached += 1
+        elif full or entry:
+            to_hash.append((name, stat))
+    
+    with ThreadPoolExecutor(max_workers=workers or VERIFY_CONFIG["hash_workers"]) as pool:
+        hashes = pool.map(lambda item: hash_file(os.path.join(model_path, item[0])), to_hash)
+        for (name, stat), sha256 in zip(to_hash, hashes):
+            files[name] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256}
+    
+    # 损坏的文件也记入清单（标记 corrupt），文件未变化时下次检查仍会报告
+    for name, entry in files.items():
+        expected = _expected_sha256(model_path, name)
+        entry["corrupt"] = bool(expected) and entry["sha256"] != expected
+        if entry["corrupt"]:
+            problems.append(f"{name}: 哈希与下载记录不一致（文件已损坏）")
+    
+    manifest = {name: entry for name, entry in {**manifest, **files}.items() if name in names}
+    try:
+        with open(manifest_file, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+    except OSError:
+        pass
+    
+    return {
+        "ok": not problems,
+        "problems": problems,
+        "hashed": len(to_hash),
+        "cached": cached,
+        "elapsed": time.perf_counter() - start,
+        "files": files
+    }
 
 class ModelManager:
     def __init__(self):
@@ -25,7 +159,7 @@ class ModelManager:
         """列出所有已下载的模型"""
         models = []
         for item in self.models_dir.iterdir():
-            if item.is_dir() and item.name != "__pycache__":
+            if item.is_dir() and item.name != "__pycache__" and not item.name.startswith("."):
                 size = self.get_folder_size(item)
                 models.append({
                     "name": item.name,
@@ -80,6 +214,39 @@ class ModelManager:
             print(f"模型 {model_name} 不存在")
             return False
     
+    def verify_model(self, model_name):
+        """完整校验模型文件（首次计算全部哈希，之后只重新计算发生变化的文件）"""
+        report = verify_model_files(str(self.models_dir / model_name), full=True)
+        if report["ok"]:
+            print(f"模型 {model_name} 校验通过（计算 {report['hashed']} 个文件，"
+                  f"复用 {report['cached']} 个，耗时 {report['elapsed']:.1f} 秒）")
+        else:
+            print(f"模型 {model_name} 校验失败:")
+            for problem in report["problems"]:
+                print(f"  - {problem}")
+        return report
+    
+    def quantize_model(self, model_name, mode=None):
+        """离线生成预量化产物，之后加载模型时直接使用（mode 默认按放置计划选择）"""
+        from artifacts import build_artifact
+        from placement import plan_placement
+        
+        model_path = str(self.models_dir / model_name)
+        if mode is None:
+            mode = plan_placement(model_path)["mode"]
+        try:
+            path = build_artifact(model_path, mode)
+            print(f"模型 {model_name} 的 {mode} 产物已生成: {path}")
+            return path
+        except Exception as e:
+            print(f"生成预量化产物失败: {e}")
+            return None
+    
+    def list_artifacts(self, model_name):
+        """列出模型的预量化产物"""
+        from artifacts import list_artifacts
+        return list_artifacts(str(self.models_dir / model_name))
+    
     def get_disk_usage(self):
         """获取磁盘使用情况"""
         total_size = 0
@@ -118,9 +285,11 @@ def main():
         print("1. 刷新列表")
         print("2. 删除模型")
         print("3. 查看详细信息")
-        print("4. 返回主程序")
+        print("4. 生成预量化产物（加快加载）")
+        print("5. 校验模型完整性")
+        print("6. 返回主程序")
         
-        choice = input("\n请选择操作 (1-4): ").strip()
+        choice = input("\n请选择操作 (1-6): ").strip()
         
         if choice == "1":
             continue
@@ -169,8 +338,38 @@ def main():
                         print(f"架构: {config.get('architectures', ['Unknown'])[0]}")
                     except:
                         print("无法读取配置文件")
+                
+                for artifact in manager.list_artifacts(model['name']):
+                    state = "可用" if artifact['valid'] else "已过期"
+                    print(f"预量化产物: {artifact['mode']} ({state})")
         
         elif choice == "4":
+            if not models:
+                print("没有可量化的模型")
+                continue
+            
+            print("\n选择要量化的模型:")
+            for i, model in enumerate(models, 1):
+                print(f"{i}. {model['name']}")
+            
+            try:
+                model_idx = int(input("请输入模型编号: ")) - 1
+                if 0 <= model_idx < len(models):
+                    mode = input("加载方式 nf4/int8/bf16/fp32（直接回车按放置计划选择）: ").strip() or None
+                    manager.quantize_model(models[model_idx]['name'], mode)
+                else:
+                    print("无效的模型编号")
+            except ValueError:
+                print("请输入有效的数字")
+        
+        elif choice == "5":
+            if not models:
+                print("没有可校验的模型")
+                continue
+            for model in models:
+                manager.verify_model(model['name'])
+        
+        elif choice == "6":
             break
         else:
             print("无效选择，请重新输入")
@@ -0,0 +1,92 @@
+import os
+import time
+import threading
+import logging
+from config import MODEL_CONFIG, PRELOAD_CONFIG
+
+logger = logging.getLogger(__name__)
+
+class ModelPreloader:
+    """在后台线程中加载并预热默认模型"""
+    
+    IDLE = "idle"
+    LOADING = "loading"
+    WARMING = "warming"
+    READY = "ready"
+    FAILED = "failed"
+    
+    def __init__(self, model_key=None, models_dir="./models"):
+        self.model_key = model_key or PRELOAD_CONFIG["default_model"]
+        if self.model_key not in MODEL_CONFIG:
+            raise ValueError(f"未知的模型: {self.model_key}，可选: {list(MODEL_CONFIG)}")
+        
+        self.model_name = MODEL_CONFIG[self.model_key]["model_name"]
+        self.model_path = os.path.join(models_dir, self.model_name)
+        self.llm = None
+        self.state = self.IDLE
+        self.error = None
+        self.elapsed = 0.0
+        self._thread = None
+        self._ready = threading.Event()
+    
+    def start(self):
+        """启动后台预加载线程"""
+        if self._thread is not None:
+            return self
+        
+        self._thread = threading.Thread(target=self._run, name="model-preload", daemon=True)
+        self._thread.start()
+        return self
+    
+    def _run(self):
+        # 延迟导入，避免在主线程中加载torch
+        from local_llm_v2 import LocalLLM
+        
+        start = time.perf_counter()
+        try:
+            if not os.path.exists(self.model_path):
+                raise FileNotFoundError(f"模型路径不存在: {self.model_path}")
+            
+            self.state = self.LOADING
+            logger.info(f"开始预加载模型: {self.model_name}")
+            llm = LocalLLM(self.model_path)
+            if not llm.load_model():
+                raise RuntimeError("模型加载失败")
+            
+            self.state = self.WARMING
+            llm.warmup(
+                lengths=PRELOAD_CONFIG["warmup_lengths"],
+                max_new_tokens=PRELOAD_CONFIG["warmup_new_tokens"]
+            )
+            
+            self.llm = llm
+            self.state = self.READY
+            logger.info(f"模型 {self.model_name} 预加载完成，耗时 {time.perf_counter() - start:.1f} 秒")
+        except Exception as e:
+            self.error = str(e)
+            self.state = self.FAILED
+            logger.error(f"模型预加载失败: {e}")
+        finally:
+            self.elapsed = time.perf_counter() - start
+            self._ready.set()
+    
+    def wait(self, timeout=None):
+        """等待预加载结束，返回是否成功"""
+        self._ready.wait(timeout)
+        return self.state == self.READY
+    
+    @property
+    def done(self):
+        return self._ready.is_set()
+    
+    def status(self):
+        """获取可读的预加载状态"""
+        if self.state == self.IDLE:
+            return "未启动预加载"
+        if self.state == self.LOADING:
+            return f"正在预加载模型 {self.model_name}..."
+        if self.state == self.WARMING:
+            return f"模型 {self.model_name} 已加载，正在预热..."
+        if self.state == self.READY:
+            return f"模型 {self.model_name} 已就绪（预加载耗时 {self.elapsed:.1f} 秒）"
+        return f"模型 {self.model_name} 预加载失败: {self.error}"
@@ -0,0 +1,127 @@
+"""
+性能监控：后台线程按固定间隔采样进程内存、显存和队列深度，写入固定长度的环形缓冲区；
+各入口在请求完成时记录输入/输出token数、首token延迟和解码速度
+界面只在被查看时读取缓冲区并生成报告
+"""
+import os
+import sys
+import time
+import threading
+from collections import deque
+from config import MONITOR_CONFIG
+
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+def process_rss():
+    """当前进程的常驻内存（字节），无法获取时返回None"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def gpu_memory():
+    """已分配的显存（字节）；只在torch已被导入且有GPU时读取，不会为了监控导入torch"""
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return None
+    return torch.cuda.memory_allocated()
+
+def sparkline(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return ""
+    low, high = min(values), max(values)
+    span = (high - low) or 1
+    return "".join(SPARK_CHARS[int((value - low) / span * (len(SPARK_CHARS) - 1))] for value in values)
+
+class PerfMonitor:
+    """采样 (时间, RSS, 显存, 推理中, 排队中) 到环形缓冲区；请求指标保留最近 history 个"""
+
+    def __init__(self, interval=None, history=None):
+        self.interval = interval or MONITOR_CONFIG["interval"]
+        self.samples = deque(maxlen=history or MONITOR_CONFIG["history"])
+        self.requests = deque(maxlen=history or MONITOR_CONFIG["history"])
+        self._queue_source = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="perf-monitor", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def set_queue_source(self, source):
+        """source() 返回 (推理中, 排队中)，例如 MicroBatcher.stats"""
+        self._queue_source = source
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def sample(self):
+        source = self._queue_source
+        running, pending = source() if source is not None else (0, 0)
+        self.samples.append((time.time(), process_rss(), gpu_memory(), running, pending))
+
+    def record_request(self, source, prompt_tokens, output_tokens, ttft, decode_seconds):
+        """记录一个完成的请求；ttft 为提交到第一个token的秒数，decode_seconds 为第一个token之后的解码耗时"""
+        tokens_per_s = (output_tokens - 1) / decode_seconds if output_tokens > 1 and decode_seconds > 0 else 0.0
+        self.requests.append({
+            "t": time.time(),
+            "source": source,
+            "prompt_tokens": prompt_tokens,
+            "output_tokens": output_tokens,
+            "ttft": ttft,
+            "tokens_per_s": tokens_per_s
+        })
+
+    def report(self):
+        """多行文本报告：最近请求、最近一段时间的平均值、队列深度，以及内存/显存随时间的变化"""
+        samples = list(self.samples)
+        requests = list(self.requests)
+        lines = []
+        if requests:
+            last = requests[-1]
+            lines.append(f"最近请求({last['source']}): 输入 {last['prompt_tokens']} tokens, 输出 {last['output_tokens']} tokens, "
+                         f"首token {last['ttft'] * 1000:.0f} ms, 解码 {last['tokens_per_s']:.1f} tokens/s")
+            ttfts = sorted(request["ttft"] for request in requests)
+            speeds = [request["tokens_per_s"] for request in requests if request["tokens_per_s"]]
+            lines.append(f"最近 {len(requests)} 个请求: 首token p50 {ttfts[len(ttfts) // 2] * 1000:.0f} ms, "
+                         f"p95 {ttfts[int(0.95 * (len(ttfts) - 1))] * 1000:.0f} ms, "
+                         f"平均解码 {sum(speeds) / len(speeds) if speeds else 0.0:.1f} tokens/s")
+        else:
+            lines.append("最近请求: 暂无")
+        if samples:
+            _, rss, gpu, running, pending = samples[-1]
+            minutes = (samples[-1][0] - samples[0][0]) / 60
+            lines.append(f"队列: 推理中 {running}, 排队中 {pending}  {sparkline([s[3] + s[4] for s in samples])}")
+            if rss is not None:
+                lines.append(f"内存: {rss / 1024 ** 3:.2f} GB  {sparkline([s[1] for s in samples])}")
+            if gpu is not None:
+                lines.append(f"显存: {gpu / 1024 ** 3:.2f} GB  {sparkline([s[2] for s in samples])}")
+            lines.append(f"（最近 {minutes:.1f} 分钟，每 {self.interval:g} 秒采样一次）")
+        return "\n".join(lines)
+
+_monitor = None
+_monitor_lock = threading.Lock()
+
+def get_monitor():
+    """按配置返回全局监控器（首次调用时启动采样线程）；未启用时返回None"""
+    global _monitor
+    if not MONITOR_CONFIG["enabled"]:
+        return None
+    with _monitor_lock:
+        if _monitor is None:
+            _monitor = PerfMonitor().start()
+    return _monitor
@@ -0,0 +1,322 @@
+"""
+模型放置规划：加载前根据 config.json 和 safetensors 头信息计算每层参数大小，
+结合可用显存/内存选择精度、量化方式和逐层 device_map
+"""
+import os
+import json
+import glob
+import struct
+import hashlib
+import logging
+import platform
+from config import QUANTIZATION_CONFIG, PLACEMENT_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# 各加载方式下每个参数占用的字节数（nf4含分块缩放系数的开销）
+MODE_BYTES = {
+    "fp32": 4.0,
+    "bf16": 2.0,
+    "fp16": 2.0,
+    "int8": 1.0,
+    "nf4": 0.5625
+}
+
+# 量化加载时卸载到CPU/磁盘的层以fp32保存（llm_int8_enable_fp32_cpu_offload）
+OFFLOAD_BYTES = 4.0
+
+PLAN_FILE = ".placement_plan.json"
+
+def read_safetensors_header(path):
+    """只读取safetensors文件头（不读权重数据）"""
+    with open(path, 'rb') as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    return header
+
+def _group_of(name):
+    """把参数名归到 device_map 的分组：embed / layers.N / norm / lm_head"""
+    parts = name.split(".")
+    if "layers" in parts:
+        index = parts.index("layers")
+        if index + 1 < len(parts) and parts[index + 1].isdigit():
+            return ".".join(parts[:index + 2])
+    # 顶层模块，例如 model.embed_tokens、model.norm、lm_head
+    if parts[0] == "model" and len(parts) > 2:
+        return ".".join(parts[:2])
+    return parts[0]
+
+def layer_parameter_counts(model_path):
+    """按分组统计参数个数（保持模型中的先后顺序）"""
+    with open(os.path.join(model_path, "config.json"), 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    shards = sorted(glob.glob(os.path.join(model_path, "*.safetensors")))
+    if not shards:
+        raise FileNotFoundError(f"未找到safetensors权重文件: {model_path}")
+
+    counts = {}
+    for shard in shards:
+        for name, info in read_safetensors_header(shard).items():
+            elements = 1
+            for dim in info["shape"]:
+                elements *= dim
+            group = _group_of(name)
+            counts[group] = counts.get(group, 0) + elements
+
+    def order(group):
+        if ".layers." in f".{group}." and group.split(".")[-1].isdigit():
+            return (1, int(group.split(".")[-1]))
+        if "embed" in group:
+            return (0, 0)
+        return (2, group)
+
+    return config, dict(sorted(counts.items(), key=lambda item: order(item[0])))
+
+def kv_cache_bytes(config, tokens, bytes_per_value=2):
+    """估算指定上下文长度下的KV缓存大小"""
+    layers = config.get("num_hidden_layers", 0)
+    heads = config.get("num_attention_heads", 1)
+    kv_heads = config.get("num_key_value_heads", heads)
+    head_dim = config.get("head_dim") or config.get("hidden_size", 0) // heads
+    return 2 * layers * kv_heads * head_dim * tokens * bytes_per_value
+
+def available_memory():
+    """返回 (GPU可用字节数或None, GPU名称, 内存可用字节数)"""
+    import psutil
+    import torch
+
+    gpu_free, gpu_name = None, None
+    if torch.cuda.is_available():
+        gpu_free, _ = torch.cuda.mem_get_info(0)
+        gpu_name = torch.cuda.get_device_name(0)
+    return gpu_free, gpu_name, psutil.virtual_memory().available
+
+def total_memory():
+    """返回 (GPU总字节数或None, GPU名称, 内存总字节数)"""
+    import psutil
+    import torch
+
+    gpu_total, gpu_name = None, None
+    if torch.cuda.is_available():
+        gpu_total = torch.cuda.get_device_properties(0).total_memory
+        gpu_name = torch.cuda.get_device_name(0)
+    return gpu_total, gpu_name, psutil.virtual_memory().total
+
+def hardware_fingerprint(gpu_total, gpu_name, ram_total):
+    """计划的缓存键：设备名称和总显存/内存（按GB取整，与随时变化的可用内存无关），
+    以及影响规划结果的配置（余量、KV缓存预留、量化配置）
+    """
+    key = json.dumps({
+        "gpu": gpu_name,
+        "gpu_gb": None if gpu_total is None else round(gpu_total / 1024**3),
+        "ram_gb": round(ram_total / 1024**3),
+        "machine": platform.machine(),
+        "headroom_ratio": PLACEMENT_CONFIG["headroom_ratio"],
+        "kv_cache_tokens": PLACEMENT_CONFIG["kv_cache_tokens"],
+        "quantization": QUANTIZATION_CONFIG
+    }, sort_keys=True)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+def _group_bytes(counts, mode, device_map):
+    """各分组按所在设备计算的字节数：量化方式下放在GPU之外的层按fp32计"""
+    quantized = mode in ("int8", "nf4")
+
+    def device_of(group):
+        return device_map.get(group, device_map.get("", 0))
+
+    return {
+        group: int(n * (OFFLOAD_BYTES if quantized and device_of(group) != 0 else MODE_BYTES[mode]))
+        for group, n in counts.items()
+    }
+
+def plan_stale(plan, gpu_free, ram_available):
+    """当前可用显存/内存比规划时宽裕（超过余量比例）：缓存的计划可能是在内存紧张时做出的保守计划"""
+    ratio = 1 - PLACEMENT_CONFIG["headroom_ratio"]
+    if gpu_free is not None and plan.get("gpu_free_gb") is not None:
+        if gpu_free * ratio > plan["gpu_free_gb"] * 1024**3:
+            return True
+    return ram_available * ratio > plan.get("ram_available_gb", 0) * 1024**3
+
+def plan_fits(plan, gpu_free, ram_available):
+    """缓存的计划在当前可用显存/内存下是否还放得下（权重 + KV缓存预留，扣除余量）"""
+    headroom = PLACEMENT_CONFIG["headroom_ratio"]
+    device_bytes = dict(plan.get("device_bytes", {}))
+    kv_device = "0" if "0" in device_bytes else "cpu"
+    device_bytes[kv_device] = device_bytes.get(kv_device, 0) + plan["kv_bytes"]
+    for device, size in device_bytes.items():
+        if device == "disk":
+            continue
+        if device == "cpu":
+            free = ram_available
+        elif gpu_free is None:
+            return False
+        else:
+            free = gpu_free
+        if size > free * (1 - headroom):
+            return False
+    return True
+
+def _fill_device_map(sizes, budgets, offload_sizes=None):
+    """按顺序把各分组放到第一个还有预算的设备上；offload_sizes 为放在GPU之外时的大小"""
+    device_map = {}
+    remaining = list(budgets)
+    for group, size in sizes.items():
+        for i, (device, budget) in enumerate(remaining):
+            if device != 0 and offload_sizes is not None:
+                size = offload_sizes[group]
+            if size <= budget or device == "disk":
+                device_map[group] = device
+                remaining[i] = (device, budget - size)
+                break
+    return device_map
+
+def _finalize(config, counts, device_map):
+    """整模型在同一设备时合并为 {"": 设备}；共享词嵌入时 lm_head 跟随嵌入层"""
+    devices = set(device_map.values())
+    if len(devices) == 1:
+        return {"": devices.pop()}
+    if "lm_head" not in device_map and config.get("tie_word_embeddings"):
+        embed = next((g for g in device_map if "embed" in g), None)
+        if embed is not None:
+            device_map["lm_head"] = device_map[embed]
+    return device_map
+
+def make_plan(model_path, gpu_free, ram_available):
+    """在给定可用内存下选择加载方式和逐层放置"""
+    config, counts = layer_parameter_counts(model_path)
+    total_params = sum(counts.values())
+    headroom = PLACEMENT_CONFIG["headroom_ratio"]
+    kv_bytes = kv_cache_bytes(config, PLACEMENT_CONFIG["kv_cache_tokens"])
+
+    def sizes_for(mode):
+        return {group: int(n * MODE_BYTES[mode]) for group, n in counts.items()}
+
+    if gpu_free is not None:
+        # 显存预算扣除KV缓存和余量
+        gpu_budget = gpu_free * (1 - headroom) - kv_bytes
+        ram_budget = ram_available * (1 - headroom)
+
+        # 优先整模型放进GPU，精度从高到低
+        for mode in ("bf16", "int8", "nf4"):
+            if total_params * MODE_BYTES[mode] <= gpu_budget:
+                return config, counts, {"mode": mode, "device_map": {"": 0}, "kv_bytes": kv_bytes}
+
+        # 4bit量化仍放不下：前面的层放GPU，其余放CPU（以fp32保存），最后放磁盘
+        offload_sizes = {group: int(n * OFFLOAD_BYTES) for group, n in counts.items()}
+        device_map = _fill_device_map(sizes_for("nf4"), [(0, gpu_budget), ("cpu", ram_budget), ("disk", float("inf"))],
+                                      offload_sizes)
+        if 0 in device_map.values():
+            return config, counts, {"mode": "nf4", "device_map": _finalize(config, counts, device_map), "kv_bytes": kv_bytes}
+        # 显存连一层都放不下时按纯CPU规划
+
+    # 仅CPU：内存足够时用fp32（CPU上速度最好），否则bf16，再不够则部分放磁盘
+    ram_budget = ram_available * (1 - headroom) - kv_bytes * 2
+    for mode in ("fp32", "bf16"):
+        if total_params * MODE_BYTES[mode] <= ram_budget:
+            return config, counts, {"mode": mode, "device_map": {"": "cpu"}, "kv_bytes": kv_bytes * 2}
+    device_map = _fill_device_map(sizes_for("bf16"), [("cpu", ram_budget), ("disk", float("inf"))])
+    return config, counts, {"mode": "bf16", "device_map": _finalize(config, counts, device_map), "kv_bytes": kv_bytes * 2}
+
+def plan_placement(model_path, use_cache=True):
+    """返回当前模型在当前硬件上的放置计划（按模型+硬件指纹缓存到模型目录）
+
+    缓存的计划在加载时按当前可用显存/内存检查：放不下时按当前可用内存重新规划（不覆盖缓存）；
+    可用内存比规划时明显宽裕时也重新规划，并替换缓存中的计划
+    """
+    gpu_free, gpu_name, ram_available = available_memory()
+    gpu_total, _, ram_total = total_memory()
+    fingerprint = hardware_fingerprint(gpu_total, gpu_name, ram_total)
+    plan_file = os.path.join(model_path, PLAN_FILE)
+
+    cached = {}
+    if use_cache and os.path.exists(plan_file):
+        try:
+            with open(plan_file, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = {}
+        plan = cached.get(fingerprint)
+        if plan is not None and not plan_fits(plan, gpu_free, ram_available):
+            logger.warning(f"当前可用显存/内存放不下缓存的放置计划 ({plan['mode']})，按当前可用内存重新规划")
+        elif plan is not None and plan_stale(plan, gpu_free, ram_available):
+            logger.info("可用显存/内存比缓存的放置计划规划时宽裕，重新规划")
+            del cached[fingerprint]
+        elif plan is not None:
+            logger.info(f"使用缓存的放置计划 ({fingerprint})")
+            print_plan(plan)
+            return plan
+
+    config, counts, plan = make_plan(model_path, gpu_free, ram_available)
+    sizes = _group_bytes(counts, plan["mode"], plan["device_map"])
+    plan.update({
+        "fingerprint": fingerprint,
+        "gpu": gpu_name,
+        "gpu_free_gb": None if gpu_free is None else round(gpu_free / 1024**3, 1),
+        "ram_available_gb": round(ram_available / 1024**3, 1),
+        "weights_gb": round(sum(sizes.values()) / 1024**3, 2),
+        "device_bytes": _bytes_per_device(plan["device_map"], sizes)
+    })
+    print_plan(plan)
+    if fingerprint in cached:
+        # 只是暂时放不下：保留为硬件整体规划的计划
+        return plan
+
+    cached[fingerprint] = plan
+    try:
+        with open(plan_file, 'w', encoding='utf-8') as f:
+            json.dump(cached, f, ensure_ascii=False, indent=2)
+    except OSError as e:
+        logger.warning(f"无法保存放置计划: {e}")
+    return plan
+
+def _bytes_per_device(device_map, sizes):
+    if "" in device_map:
+        return {str(device_map[""]): sum(sizes.values())}
+    totals = {}
+    for group, device in device_map.items():
+        totals[str(device)] = totals.get(str(device), 0) + sizes.get(group, 0)
+    return totals
+
+def print_plan(plan):
+    """打印放置计划摘要"""
+    logger.info(f"放置计划: 加载方式 {plan['mode']}, 权重约 {plan.get('weights_gb', '?')} GB, "
+                f"KV缓存预留 {plan['kv_bytes'] / 1024**3:.2f} GB")
+    for device, size in plan.get("device_bytes", {}).items():
+        name = f"GPU {device}" if device.isdigit() else device.upper()
+        logger.info(f"  {name}: {size / 1024**3:.2f} GB")
+
+def model_kwargs_from_plan(plan):
+    """把放置计划转换为 from_pretrained 参数"""
+    import torch
+    from transformers import BitsAndBytesConfig
+
+    mode = plan["mode"]
+    device_map = plan["device_map"]
+    devices = set(device_map.values())
+    kwargs = {
+        "device_map": device_map,
+        "low_cpu_mem_usage": True
+    }
+
+    if mode in ("fp32", "bf16", "fp16"):
+        kwargs["torch_dtype"] = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}[mode]
+    else:
+        compute_dtype = getattr(torch, QUANTIZATION_CONFIG["bnb_4bit_compute_dtype"])
+        if mode == "int8":
+            quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+        else:
+            quantization_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=compute_dtype,
+                bnb_4bit_use_double_quant=QUANTIZATION_CONFIG["bnb_4bit_use_double_quant"],
+                bnb_4bit_quant_type=QUANTIZATION_CONFIG["bnb_4bit_quant_type"],
+                # 部分层放在CPU/磁盘时需要允许fp32卸载
+                llm_int8_enable_fp32_cpu_offload=bool(devices - {0})
+            )
+        kwargs["quantization_config"] = quantization_config
+        kwargs["torch_dtype"] = compute_dtype
+
+    if "disk" in devices:
+        kwargs["offload_folder"] = PLACEMENT_CONFIG["offload_folder"]
+    return kwargs
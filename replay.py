@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+请求回放与性能剖析工具
+按记录文件中的到达过程回放请求（开环），或以固定并发持续发送（闭环），
+可同时输出 torch.profiler / cProfile 热点报告
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from request_recorder import load_records
+
+SYNTHETIC_UNIT = "请介绍一下人工智能的发展历史。"
+
+class LocalTarget:
+    """进程内回放：与Web界面相同，经过微批处理线程调用 LocalLLM"""
+
+    def __init__(self, model_path):
+        from local_llm_v2 import LocalLLM
+        from batching import MicroBatcher
+
+        self.llm = LocalLLM(model_path)
+        if not self.llm.load_model():
+            raise RuntimeError("模型加载失败")
+        self.batcher = MicroBatcher(self.llm)
+        # 剖析器只记录当前线程，此时绕过批处理线程直接调用
+        self.inline = False
+
+    def build_prompt(self, record):
+        """优先使用记录的原文；脱敏记录按token长度合成等长输入"""
+        if "prompt" in record:
+            return record["prompt"]
+        text = SYNTHETIC_UNIT
+        while self.llm.count_tokens(text) < record["pt"]:
+            text += SYNTHETIC_UNIT
+        return text
+
+    def send(self, prompt, params):
+        if self.inline:
+            return self.llm.generate_batch(
+                [prompt],
+                adapters=[params.get("adapter")],
+                max_length=params.get("max_length", 512),
+                temperature=params.get("temperature", 0.7)
+            )[0]
+        return self.batcher.submit(
+            prompt,
+            adapter=params.get("adapter"),
+            max_length=params.get("max_length", 512),
+            temperature=params.get("temperature", 0.7),
+            priority=params.get("priority")
+        ).result()
+
+class HTTPTarget:
+    """通过 api_server 的 HTTP 接口回放"""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/") + "/generate"
+
+    def build_prompt(self, record):
+        if "prompt" in record:
+            return record["prompt"]
+        # 无法在客户端分词，按平均每个汉字约一个token近似
+        repeat = max(1, record["pt"] // len(SYNTHETIC_UNIT) + 1)
+        return SYNTHETIC_UNIT * repeat
+
+    def send(self, prompt, params):
+        body = json.dumps({"prompt": prompt, **params}).encode("utf-8")
+        request = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request) as response:
+            payload = json.loads(response.read())
+        if "error" in payload:
+            raise RuntimeError(payload["error"])
+        return payload["response"]
+
+def run_one(target, prompt, params, results, lock):
+    start = time.perf_counter()
+    error = None
+    try:
+        target.send(prompt, params)
+    except Exception as e:
+        error = str(e)
+    with lock:
+        results.append((time.perf_counter() - start, error))
+
+def replay_open_loop(target, records, prompts, speed, max_workers):
+    """开环回放：按记录的到达间隔（除以speed）发出请求，不等待前一个完成"""
+    results, lock = [], threading.Lock()
+    origin = records[0]["t"]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for record, prompt in zip(records, prompts):
+            delay = (record["t"] - origin) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(run_one, target, prompt, record["p"], results, lock)
+    return results, time.perf_counter() - start
+
+def replay_closed_loop(target, records, prompts, concurrency):
+    """闭环回放：固定并发，每个客户端完成一个请求后立即发送下一个"""
+    results, lock = [], threading.Lock()
+    items = list(zip(records, prompts))
+    cursor = iter(items)
+    cursor_lock = threading.Lock()
+
+    def client():
+        while True:
+            with cursor_lock:
+                item = next(cursor, None)
+            if item is None:
+                return
+            run_one(target, item[1], item[0]["p"], results, lock)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+def replay_sequential(target, records, prompts):
+    """在当前线程中逐个执行（供cProfile使用）"""
+    results, lock = [], threading.Lock()
+    start = time.perf_counter()
+    for record, prompt in zip(records, prompts):
+        run_one(target, prompt, record["p"], results, lock)
+    return results, time.perf_counter() - start
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+def print_report(results, elapsed):
+    latencies = [lat for lat, err in results if err is None]
+    errors = [err for _, err in results if err is not None]
+    print("\n回放结果")
+    print("-" * 40)
+    print(f"请求数:   {len(results)} (失败 {len(errors)})")
+    print(f"总耗时:   {elapsed:.1f} 秒, 吞吐 {len(results) / elapsed:.2f} req/s")
+    for q in (50, 95, 99):
+        print(f"p{q} 延迟: {percentile(latencies, q):.2f} 秒")
+    if errors:
+        print(f"首个错误: {errors[0]}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="回放记录的请求并剖析热点")
+    parser.add_argument("records", help="请求记录文件（RECORDER_CONFIG['path']）")
+    target_group = parser.add_mutually_exclusive_group(required=True)
+    target_group.add_argument("--model", help="进程内回放使用的模型目录")
+    target_group.add_argument("--url", help="HTTP接口地址，例如 http://127.0.0.1:8000")
+    parser.add_argument("--mode", choices=["open", "closed"], default="open", help="开环（按到达时间）或闭环（固定并发）")
+    parser.add_argument("--speed", type=float, default=1.0, help="开环模式的时间加速倍数")
+    parser.add_argument("--concurrency", type=int, default=4, help="闭环并发数 / 开环最大并发数")
+    parser.add_argument("--limit", type=int, default=None, help="只回放前N条记录")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子，保证回放可重复")
+    parser.add_argument("--profile", choices=["none", "torch", "cprofile"], default="none", help="剖析方式")
+    parser.add_argument("--profile-out", default="replay_profile", help="剖析结果输出文件前缀")
+    args = parser.parse_args(argv)
+
+    records = load_records(args.records)[:args.limit]
+    if not records:
+        print("记录文件为空")
+        return 1
+
+    random.seed(args.seed)
+    if args.model:
+        import torch
+        torch.manual_seed(args.seed)
+        target = LocalTarget(args.model)
+    else:
+        target = HTTPTarget(args.url)
+    prompts = [target.build_prompt(record) for record in records]
+
+    def run():
+        if args.profile != "none":
+            # 两种剖析器都只记录当前线程，剖析时在主线程中串行回放
+            if isinstance(target, LocalTarget):
+                target.inline = True
+            print("剖析模式：在当前线程中串行回放")
+            return replay_sequential(target, records, prompts)
+        if args.mode == "open":
+            return replay_open_loop(target, records, prompts, args.speed, args.concurrency)
+        return replay_closed_loop(target, records, prompts, args.concurrency)
+
+    print(f"开始回放 {len(records)} 个请求 ({args.mode}模式)...")
+    if args.profile == "torch":
+        from torch.profiler import profile, ProfilerActivity
+        import torch
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        with profile(activities=activities, record_shapes=True) as prof:
+            results, elapsed = run()
+        prof.export_chrome_trace(f"{args.profile_out}.json")
+        print("\n热点（按自身CPU时间排序）")
+        print(prof.key_averages().table(sort_by="self_cpu_time_total", row_limit=25))
+        print(f"阶段标记 llm.* 见上表；完整时间线: {args.profile_out}.json")
+    elif args.profile == "cprofile":
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        results, elapsed = run()
+        profiler.disable()
+        profiler.dump_stats(f"{args.profile_out}.prof")
+        print("\n热点（按累计时间排序）")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    else:
+        results, elapsed = run()
+
+    print_report(results, elapsed)
+    if isinstance(target, LocalTarget) and not target.inline:
+        print("\n各类请求排队延迟")
+        for cls, latency in target.batcher.latency_report().items():
+            print(f"{cls:12s} {latency['count']:5d} 个, p50 {latency['p50']:.0f} ms, p95 {latency['p95']:.0f} ms")
+        print(f"抢占次数: {target.batcher.preemptions}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+"""
+请求记录器：以追加方式记录请求的到达时间、输入token长度、生成参数和结果
+配合 replay.py 按相同的到达过程回放
+"""
+import os
+import json
+import hashlib
+import threading
+from config import RECORDER_CONFIG
+
+class RequestRecorder:
+    """每个请求一行紧凑JSON"""
+    
+    def __init__(self, path=None, redact=None):
+        self.path = path or RECORDER_CONFIG["path"]
+        self.redact = RECORDER_CONFIG["redact"] if redact is None else redact
+        self._lock = threading.Lock()
+        
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, 'a', encoding='utf-8')
+    
+    def record(self, source, arrival, prompt, prompt_tokens, params, latency, output_tokens=0, error=None):
+        """记录一个已完成的请求；arrival 为 time.time() 时间戳"""
+        entry = {
+            "t": round(arrival, 4),
+            "src": source,
+            "pt": prompt_tokens,
+            "ot": output_tokens,
+            "lat": round(latency, 4),
+            "p": params
+        }
+        if self.redact:
+            entry["h"] = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+        else:
+            entry["prompt"] = prompt
+        if error is not None:
+            entry["err"] = str(error)[:200]
+        
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+    
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+def get_recorder():
+    """按配置返回全局记录器；未启用时返回None"""
+    global _recorder
+    if not RECORDER_CONFIG["enabled"]:
+        return None
+    with _recorder_lock:
+        if _recorder is None:
+            _recorder = RequestRecorder()
+    return _recorder
+
+def load_records(path):
+    """读取记录文件，按到达时间排序"""
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    records.sort(key=lambda r: r["t"])
+    return records
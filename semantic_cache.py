@@ -0,0 +1,197 @@
+"""
+语义缓存：对输入做廉价的句向量编码，命中相似度阈值时直接返回缓存的回答
+"""
+import os
+import json
+import atexit
+import time
+import threading
+import logging
+import numpy as np
+import torch
+from config import SEMANTIC_CACHE_CONFIG
+
+logger = logging.getLogger(__name__)
+
+class SemanticCache:
+    """基于NumPy矩阵的向量索引，余弦相似度top-k检索"""
+    
+    def __init__(self, llm, config=None):
+        self.llm = llm
+        self.config = {**SEMANTIC_CACHE_CONFIG, **(config or {})}
+        self.capacity = self.config["capacity"]
+        self.threshold = self.config["threshold"]
+        self.path = self.config["path"]
+        
+        self._encoder = None
+        self._encoder_tokenizer = None
+        self._vectors = None
+        self._namespaces = np.zeros(self.capacity, dtype=np.int64)
+        self._last_used = np.zeros(self.capacity, dtype=np.float64)
+        self._entries = [None] * self.capacity
+        self._namespace_ids = {}
+        self._size = 0
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.lookup_time = 0.0
+        
+        self.load()
+        # 退出时写回未保存的条目
+        atexit.register(self.save)
+    
+    def _load_encoder(self):
+        from transformers import AutoModel, AutoTokenizer
+        path = self.config["encoder_path"]
+        logger.info(f"正在加载语义缓存编码模型: {path}")
+        self._encoder_tokenizer = AutoTokenizer.from_pretrained(path, local_files_only=True)
+        self._encoder = AutoModel.from_pretrained(path, local_files_only=True).eval()
+    
+    def embed(self, text):
+        """计算输入的句向量：最后一层隐藏状态按注意力掩码做平均池化并归一化"""
+        if self.config["encoder_path"]:
+            if self._encoder is None:
+                self._load_encoder()
+            tokenizer, model = self._encoder_tokenizer, self._encoder
+        else:
+            tokenizer, model = self.llm.tokenizer, self.llm.model
+        
+        device = next(model.parameters()).device
+        inputs = tokenizer([text], return_tensors="pt", truncation=True, max_length=512).to(device)
+        with torch.no_grad():
+            hidden = self._last_hidden_state(model, inputs)
+        mask = inputs.attention_mask.unsqueeze(-1).to(hidden.dtype)
+        pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1)
+        vector = pooled[0].float().cpu().numpy()
+        return vector / (np.linalg.norm(vector) + 1e-8)
+    
+    @staticmethod
+    def _last_hidden_state(model, inputs):
+        """最后一层隐藏状态：CausalLM只跑主干（不计算输出层logits），编码模型直接调用"""
+        if hasattr(model, "get_base_model"):
+            # PEFT包装：取原模型，主干上注入的LoRA层按当前激活的适配器参与计算
+            model = model.get_base_model()
+        if model.get_output_embeddings() is None:
+            return model(**inputs).last_hidden_state
+        base = getattr(model, model.base_model_prefix, None)
+        if isinstance(base, torch.nn.Module) and base is not model:
+            return base(**inputs).last_hidden_state
+        # 取不到主干时只计算最后一个位置的logits
+        return model(**inputs, output_hidden_states=True, logits_to_keep=1).hidden_states[-1]
+    
+    def _namespace_id(self, namespace):
+        if namespace not in self._namespace_ids:
+            self._namespace_ids[namespace] = len(self._namespace_ids)
+        return self._namespace_ids[namespace]
+    
+    def lookup(self, vector, namespace=""):
+        """查找最相似的缓存条目，超过阈值返回回答，否则返回None"""
+        start = time.perf_counter()
+        try:
+            with self._lock:
+                if self._size == 0:
+                    self.misses += 1
+                    return None
+                
+                scores = self._vectors[:self._size] @ vector
+                scores[self._namespaces[:self._size] != self._namespace_id(namespace)] = -1.0
+                k = min(self.config["top_k"], self._size)
+                top = np.argpartition(-scores, k - 1)[:k]
+                best = top[np.argmax(scores[top])]
+                
+                if scores[best] < self.threshold:
+                    self.misses += 1
+                    return None
+                
+                self.hits += 1
+                self._last_used[best] = time.time()
+                return self._entries[best]["response"]
+        finally:
+            self.lookup_time += time.perf_counter() - start
+    
+    def insert(self, vector, prompt, response, namespace=""):
+        """加入缓存；满了则淘汰最久未使用的条目"""
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.capacity, vector.shape[0]), dtype=np.float32)
+            
+            if self._size < self.capacity:
+                index = self._size
+                self._size += 1
+            else:
+                index = int(np.argmin(self._last_used))
+            
+            self._vectors[index] = vector
+            self._namespaces[index] = self._namespace_id(namespace)
+            self._last_used[index] = time.time()
+            self._entries[index] = {"prompt": prompt, "response": response}
+            self._unsaved += 1
+            should_save = self._unsaved >= self.config["save_every"]
+        
+        if should_save:
+            self.save()
+    
+    def stats(self):
+        """命中率与检索延迟统计"""
+        total = self.hits + self.misses
+        return {
+            "size": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "avg_lookup_ms": self.lookup_time / total * 1000 if total else 0.0
+        }
+    
+    def report(self):
+        """一行文本统计，用于性能面板和终端"""
+        stats = self.stats()
+        return (f"语义缓存: {stats['size']} 条, 命中 {stats['hits']}/{stats['hits'] + stats['misses']} "
+                f"({stats['hit_rate'] * 100:.0f}%), 平均检索 {stats['avg_lookup_ms']:.2f} ms")
+    
+    def save(self):
+        """持久化到磁盘"""
+        with self._lock:
+            if self._size == 0 or self._unsaved == 0:
+                return
+            os.makedirs(self.path, exist_ok=True)
+            np.savez(
+                os.path.join(self.path, "index.npz"),
+                vectors=self._vectors[:self._size],
+                namespaces=self._namespaces[:self._size],
+                last_used=self._last_used[:self._size]
+            )
+            with open(os.path.join(self.path, "entries.json"), 'w', encoding='utf-8') as f:
+                json.dump({
+                    "namespaces": self._namespace_ids,
+                    "entries": self._entries[:self._size]
+                }, f, ensure_ascii=False)
+            self._unsaved = 0
+        logger.info(f"语义缓存已保存: {self._size} 条")
+    
+    def load(self):
+        """从磁盘恢复缓存"""
+        index_file = os.path.join(self.path, "index.npz")
+        entries_file = os.path.join(self.path, "entries.json")
+        if not (os.path.exists(index_file) and os.path.exists(entries_file)):
+            return
+        
+        try:
+            data = np.load(index_file)
+            with open(entries_file, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"语义缓存读取失败，将重新建立: {e}")
+            return
+        
+        size = min(len(meta["entries"]), self.capacity)
+        self._vectors = np.zeros((self.capacity, data["vectors"].shape[1]), dtype=np.float32)
+        self._vectors[:size] = data["vectors"][:size]
+        self._namespaces[:size] = data["namespaces"][:size]
+        self._last_used[:size] = data["last_used"][:size]
+        self._entries[:size] = meta["entries"][:size]
+        self._namespace_ids = meta["namespaces"]
+        self._size = size
+        logger.info(f"已加载语义缓存: {size} 条")
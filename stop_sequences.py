@@ -0,0 +1,201 @@
+"""
+停止序列：生成过程中每步增量检查停止字符串（对增量解码出的文本）和停止token序列（对token ID），
+匹配完成的那一步即结束生成。两者都用 Aho-Corasick 自动机，每个新符号只需沿失败链走均摊O(1)步
+"""
+import time
+from collections import deque
+import torch
+from transformers import StoppingCriteria, TextIteratorStreamer
+
+class Automaton:
+    """Aho-Corasick 多模式匹配自动机，符号可以是字符或token ID"""
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]
+        for pattern in patterns:
+            node = 0
+            for symbol in pattern:
+                if symbol not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                    self.goto[node][symbol] = len(self.goto) - 1
+                node = self.goto[node][symbol]
+            if self.output[node] is None:
+                self.output[node] = pattern
+
+        # 按层构建失败链；节点的输出为自身或失败链上最先遇到的模式
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for symbol, child in self.goto[node].items():
+                queue.append(child)
+                if node == 0:
+                    continue
+                fail = self.fail[node]
+                while fail and symbol not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(symbol, 0)
+                if self.output[child] is None:
+                    self.output[child] = self.output[self.fail[child]]
+
+    def step(self, node, symbol):
+        """返回 (新状态, 在此结束的模式或None)"""
+        while node and symbol not in self.goto[node]:
+            node = self.fail[node]
+        node = self.goto[node].get(symbol, 0)
+        return node, self.output[node]
+
+class _RowState:
+    """一个序列的匹配状态：已生成的token、增量解码的偏移、两个自动机的当前状态，
+    以及每次输出文本后的 (token数, 字符数) 边界（用于把停止字符串的位置换算回token）
+    """
+
+    def __init__(self):
+        self.tokens = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.text_length = 0
+        self.text_node = 0
+        self.token_node = 0
+        self.boundaries = [(0, 0)]
+        self.match = None
+
+class StopSequenceCriteria(StoppingCriteria):
+    """作为 generate 的 stopping_criteria 使用，每行独立匹配
+
+    stop 为停止字符串列表，stop_token_ids 为停止token序列列表；每步只看新生成的最后一个token，输入部分不参与匹配。
+    匹配后 matches[行] 为 {"stop", "tokens", "text_end", "kept_tokens"}：匹配到的模式、此时已生成的token数、
+    匹配结束处在生成文本中的字符位置（token序列匹配时为None）、与停止序列不重叠的前缀token数
+    """
+
+    def __init__(self, tokenizer, stop=None, stop_token_ids=None):
+        self.tokenizer = tokenizer
+        stop = [stop] if isinstance(stop, str) else [text for text in stop or [] if text]
+        stop_token_ids = [tuple(ids) for ids in stop_token_ids or [] if ids]
+        self.text_automaton = Automaton(stop) if stop else None
+        self.token_automaton = Automaton(stop_token_ids) if stop_token_ids else None
+        self.rows = []
+        self.checked_tokens = 0
+        self.match_time = 0.0
+
+    @property
+    def matches(self):
+        return [row.match for row in self.rows]
+
+    @property
+    def match_ms_per_token(self):
+        return self.match_time / self.checked_tokens * 1000 if self.checked_tokens else 0.0
+
+    def __call__(self, input_ids, scores, **kwargs):
+        start = time.perf_counter()
+        while len(self.rows) < input_ids.shape[0]:
+            self.rows.append(_RowState())
+        done = []
+        for row, state in enumerate(self.rows):
+            if state.match is None:
+                self._step(state, int(input_ids[row, -1]))
+            done.append(state.match is not None)
+        self.match_time += time.perf_counter() - start
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+    def _step(self, state, token):
+        self.checked_tokens += 1
+        state.tokens.append(token)
+        if self.token_automaton is not None:
+            state.token_node, pattern = self.token_automaton.step(state.token_node, token)
+            if pattern is not None:
+                state.match = {"stop": list(pattern), "tokens": len(state.tokens), "text_end": None,
+                               "kept_tokens": len(state.tokens) - len(pattern)}
+                return
+        if self.text_automaton is not None:
+            new_text = self._new_text(state)
+            for char in new_text:
+                state.text_length += 1
+                state.text_node, pattern = self.text_automaton.step(state.text_node, char)
+                if pattern is not None:
+                    # 输出停止字符串第一个字符的那一步之前的token都不与它重叠
+                    start = state.text_length - len(pattern)
+                    kept = max(tokens for tokens, length in state.boundaries if length <= start)
+                    state.match = {"stop": pattern, "tokens": len(state.tokens), "text_end": state.text_length,
+                                   "kept_tokens": kept}
+                    return
+            if new_text:
+                state.boundaries.append((len(state.tokens), state.text_length))
+
+    def _new_text(self, state):
+        """增量解码：只解码最近几个token，得到本步新增的文本；多字节字符不完整时先不输出"""
+        decode = self.tokenizer.decode
+        prefix_text = decode(state.tokens[state.prefix_offset:state.read_offset], skip_special_tokens=True)
+        new_text = decode(state.tokens[state.prefix_offset:], skip_special_tokens=True)
+        if len(new_text) <= len(prefix_text) or new_text.endswith("�"):
+            return ""
+        state.prefix_offset = state.read_offset
+        state.read_offset = len(state.tokens)
+        return new_text[len(prefix_text):]
+
+class StopTokenStreamer(TextIteratorStreamer):
+    """流式输出时处理停止token序列：末尾可能是某个停止序列开头的token先不交给解码，
+    匹配完成时丢弃整个序列（停止序列对应的文本不会被发出）；只支持单个序列
+    """
+
+    def __init__(self, tokenizer, stop_token_ids, **kwargs):
+        super().__init__(tokenizer, **kwargs)
+        self.stop_token_ids = [list(ids) for ids in stop_token_ids or [] if ids]
+        self.held = []
+        self.stopped = False
+
+    def put(self, value):
+        if self.skip_prompt and self.next_tokens_are_prompt:
+            super().put(value)
+            return
+        if self.stopped:
+            return
+        tokens = self.held + value.reshape(-1).tolist()
+        for pattern in self.stop_token_ids:
+            for start in range(len(tokens) - len(pattern) + 1):
+                if tokens[start:start + len(pattern)] == pattern:
+                    self.held, self.stopped = [], True
+                    self._emit(tokens[:start])
+                    return
+        hold = 0
+        for pattern in self.stop_token_ids:
+            for length in range(min(len(pattern) - 1, len(tokens)), hold, -1):
+                if tokens[len(tokens) - length:] == pattern[:length]:
+                    hold = length
+                    break
+        self.held = tokens[len(tokens) - hold:] if hold else []
+        self._emit(tokens[:len(tokens) - hold])
+
+    def end(self):
+        if self.held and not self.stopped:
+            self._emit(self.held)
+        self.held = []
+        super().end()
+
+    def _emit(self, tokens):
+        if tokens:
+            super().put(torch.tensor(tokens))
+
+def truncate_text(text, match):
+    """去掉停止字符串及其之后的文本（停止字符串不包含在回复中）"""
+    if match is None or match["text_end"] is None:
+        return text
+    stop = match["stop"]
+    start = match["text_end"] - len(stop)
+    if text[start:match["text_end"]] == stop:
+        return text[:start]
+    index = text.find(stop)
+    return text[:index] if index >= 0 else text
+
+def held_suffix(text, stop):
+    """text 末尾可能是某个停止字符串开头的最长长度：流式输出时这部分先不发出，避免把停止字符串的前半段发给用户"""
+    longest = 0
+    for pattern in stop:
+        for length in range(min(len(pattern) - 1, len(text)), longest, -1):
+            if text.endswith(pattern[:length]):
+                longest = length
+                break
+    return longest
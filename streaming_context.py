@@ -0,0 +1,217 @@
+"""
+流式上下文：attention sinks + 滑动窗口KV缓存，用于长时间不关闭的对话
+只保留开头几个"sink" token和最近的窗口，超出窗口的KV被丢弃，保留下来的key按新位置重新旋转（RoPE），
+内存和每token耗时不随对话长度增长
+"""
+import torch
+from transformers import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopPLogitsWarper
+)
+from transformers.cache_utils import Cache, DynamicLayer
+from config import STREAMING_CONTEXT_CONFIG, GENERATION_CONFIG
+
+SYSTEM_PROMPT = "你是一个有用的AI助手。"
+
+def _rotate_half(x):
+    half = x.shape[-1] // 2
+    return torch.cat((-x[..., half:], x[..., :half]), dim=-1)
+
+def _rotary_inv_freq(model):
+    """取模型旋转位置编码的频率"""
+    for module in model.modules():
+        inv_freq = getattr(module, "inv_freq", None)
+        if isinstance(inv_freq, torch.Tensor):
+            return inv_freq.detach().float().cpu()
+    raise ValueError("模型没有旋转位置编码（RoPE），不支持流式上下文")
+
+class SinkLayer(DynamicLayer):
+    """一层的KV缓存：超过 sink + window 个token时，一次丢弃窗口中最旧的一批（窗口的1/8），
+    减少重新旋转的次数；本次前向仍使用丢弃前的完整KV
+    """
+
+    def __init__(self, sink_tokens, window_tokens, inv_freq):
+        super().__init__()
+        self.sink_tokens = sink_tokens
+        self.window_tokens = window_tokens
+        self.evict_tokens = max(1, window_tokens // 8)
+        self.inv_freq = inv_freq
+        self.evicted = 0
+
+    def update(self, key_states, value_states, *args, **kwargs):
+        keys, values = super().update(key_states, value_states)
+        length = keys.shape[-2]
+        excess = length - (self.sink_tokens + self.window_tokens)
+        if excess > 0:
+            self._evict(min(excess + self.evict_tokens, length - self.sink_tokens))
+        return keys, values
+
+    def _evict(self, count):
+        sink = self.sink_tokens
+        window_keys = self._shift(self.keys[..., sink + count:, :], -count)
+        self.keys = torch.cat([self.keys[..., :sink, :], window_keys], dim=-2)
+        self.values = torch.cat([self.values[..., :sink, :], self.values[..., sink + count:, :]], dim=-2)
+        self.evicted += count
+
+    def _shift(self, keys, offset):
+        """把已按RoPE旋转的key整体平移 offset 个位置（旋转可以叠加，用float32计算）"""
+        inv_freq = self.inv_freq.to(keys.device)
+        rotary_dim = inv_freq.shape[0] * 2
+        angle = offset * inv_freq
+        emb = torch.cat((angle, angle))
+        rotated = keys[..., :rotary_dim].float()
+        rotated = rotated * emb.cos() + _rotate_half(rotated) * emb.sin()
+        return torch.cat((rotated.to(keys.dtype), keys[..., rotary_dim:]), dim=-1)
+
+class SinkCache(Cache):
+    """每层一个 SinkLayer；get_seq_length() 返回当前保留的token数，新token的位置从这里接着编号"""
+
+    def __init__(self, model, sink_tokens, window_tokens):
+        inv_freq = _rotary_inv_freq(model)
+        num_layers = model.config.get_text_config().num_hidden_layers
+        super().__init__(layers=[SinkLayer(sink_tokens, window_tokens, inv_freq) for _ in range(num_layers)])
+
+    @property
+    def evicted(self):
+        return self.layers[0].evicted
+
+    def nbytes(self):
+        return sum(
+            layer.keys.numel() * layer.keys.element_size() + layer.values.numel() * layer.values.element_size()
+            for layer in self.layers if layer.is_initialized
+        )
+
+class ContextSession:
+    """不限长度的对话：KV缓存跨轮次保留，每轮只编码新增的消息
+
+    单线程使用；只支持没有LoRA适配器的eager类后端
+    """
+
+    def __init__(self, llm, sink_tokens=None, window_tokens=None):
+        self.llm = llm
+        self.sink_tokens = STREAMING_CONTEXT_CONFIG["sink_tokens"] if sink_tokens is None else sink_tokens
+        self.window_tokens = window_tokens or STREAMING_CONTEXT_CONFIG["window_tokens"]
+        # 长输入按块送入，块之间按窗口丢弃，峰值缓存不超过 sink + window + 一块
+        self.chunk_tokens = max(1, self.window_tokens // 4)
+        self.reset()
+
+    def reset(self):
+        """开始新对话，丢弃全部上下文"""
+        self.cache = SinkCache(self.llm.model, self.sink_tokens, self.window_tokens)
+        self.messages = []
+        self.tokens_seen = 0
+        self.turns = 0
+
+    def stats(self):
+        return {
+            "turns": self.turns,
+            "tokens_seen": self.tokens_seen,
+            "cached_tokens": self.cache.get_seq_length(),
+            "evicted_tokens": self.cache.evicted,
+            "cache_mb": self.cache.nbytes() / 1024 ** 2
+        }
+
+    def feed(self, input_ids):
+        """把token写入KV缓存（位置从当前缓存长度接着编号），返回 [批次, 步数, 词表] 的logits"""
+        model = self.llm.model
+        logits = []
+        with torch.no_grad():
+            for start in range(0, input_ids.shape[1], self.chunk_tokens):
+                piece = input_ids[:, start:start + self.chunk_tokens]
+                position = self.cache.get_seq_length()
+                positions = torch.arange(position, position + piece.shape[1], device=piece.device)
+                output = model(
+                    piece,
+                    past_key_values=self.cache,
+                    position_ids=positions.unsqueeze(0),
+                    cache_position=positions,
+                    use_cache=True
+                )
+                logits.append(output.logits)
+        self.tokens_seen += input_ids.shape[1]
+        return torch.cat(logits, dim=1)
+
+    def _turn_text(self, user_input):
+        """本轮需要送入模型的文本：上一条回复在模板中的结尾 + 新的用户消息 + 助手回复的开头"""
+        tokenizer = self.llm.tokenizer
+        message = {"role": "user", "content": user_input}
+        if not self.messages:
+            self.messages = [{"role": "system", "content": SYSTEM_PROMPT}, message]
+            return tokenizer.apply_chat_template(self.messages, tokenize=False, add_generation_prompt=True)
+        history = tokenizer.apply_chat_template(self.messages, tokenize=False)
+        self.messages = self.messages + [message]
+        full = tokenizer.apply_chat_template(self.messages, tokenize=False, add_generation_prompt=True)
+        # 缓存中已有上一条回复的内容，只补上模板在回复之后追加的部分（如结束标记）
+        reply = self.messages[-2]["content"]
+        end = history.rfind(reply)
+        tail = history[end + len(reply):] if reply and end >= 0 else ""
+        return tail + full[len(history):]
+
+    def _processors(self, temperature):
+        processors = LogitsProcessorList([RepetitionPenaltyLogitsProcessor(GENERATION_CONFIG["repetition_penalty"])])
+        if GENERATION_CONFIG["do_sample"] and temperature > 0:
+            processors.append(TemperatureLogitsWarper(temperature))
+            processors.append(TopPLogitsWarper(GENERATION_CONFIG["top_p"]))
+        return processors
+
+    def stream(self, user_input, max_length=None, temperature=None):
+        """生成一轮回复，逐段产出新生成的文本"""
+        llm = self.llm
+        llm._begin_request()
+        try:
+            device = llm.model.device
+            max_length = int(max_length or GENERATION_CONFIG["max_new_tokens"])
+            temperature = GENERATION_CONFIG["temperature"] if temperature is None else float(temperature)
+            sample = GENERATION_CONFIG["do_sample"] and temperature > 0
+            processors = self._processors(temperature)
+            eos_ids = llm._eos_ids()
+
+            # 语义缓存只用于第一轮：之后的回复依赖对话历史
+            cache_key = None
+            if self.turns == 0:
+                cached, cache_key = llm.semantic_lookup(user_input, max_length=max_length, temperature=temperature)
+                if cached is not None:
+                    yield from self._replay(user_input, cached)
+                    return
+
+            input_ids = llm.tokenizer([self._turn_text(user_input)], return_tensors="pt").input_ids.to(device)
+            logits = self.feed(input_ids)[:, -1]
+            context = input_ids
+            generated = []
+            text = ""
+            for _ in range(max_length):
+                scores = processors(context, logits.float())
+                if sample:
+                    token = torch.multinomial(torch.softmax(scores, dim=-1), 1)
+                else:
+                    token = scores.argmax(dim=-1, keepdim=True)
+                if int(token) in eos_ids:
+                    break
+                generated.append(int(token))
+                context = torch.cat([context, token], dim=-1)
+                decoded = llm.tokenizer.decode(generated, skip_special_tokens=True)
+                # 多字节字符还没解码完整时先不输出
+                if not decoded.endswith("�") and len(decoded) > len(text):
+                    yield decoded[len(text):]
+                    text = decoded
+                logits = self.feed(token)[:, -1]
+
+            # 模板渲染只需要最近一轮消息
+            reply = llm.tokenizer.decode(generated, skip_special_tokens=True)
+            self.messages = [self.messages[-1], {"role": "assistant", "content": reply}]
+            self.turns += 1
+            llm.semantic_insert(cache_key, user_input, reply.strip())
+        finally:
+            llm._end_request()
+
+    def _replay(self, user_input, reply):
+        """语义缓存命中：发出缓存的回答，并把本轮输入和回答一次写入KV缓存，后续轮次照常接着对话"""
+        yield reply
+        llm = self.llm
+        tokenizer = llm.tokenizer
+        text = self._turn_text(user_input) + reply
+        self.feed(tokenizer([text], return_tensors="pt").input_ids.to(llm.model.device))
+        self.messages = [self.messages[-1], {"role": "assistant", "content": reply}]
+        self.turns += 1
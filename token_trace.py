@@ -0,0 +1,83 @@
+"""
+逐token记录生成过程：token ID、对数概率（可选top-k候选）和发出时间
+对数概率取自生成时 lm_head 已经算出的logits，不需要额外的前向计算；结果用紧凑的数组保存
+"""
+import time
+import threading
+from array import array
+import numpy as np
+import torch
+from transformers.generation.streamers import BaseStreamer
+
+class TokenTrace(BaseStreamer):
+    """作为 generate 的 streamer 使用（单个序列），同时在 lm_head 上挂前向钩子
+
+    lm_head 每步前向输出当前位置的logits，随后 generate 采样出token并调用 put()，
+    此时取该token在本步分布中的对数概率。对数概率来自模型原始分布（未经温度、top_p、重复惩罚处理）
+    """
+
+    def __init__(self, top_k=0):
+        self.top_k = top_k
+        self.token_ids = array("q")
+        self.logprobs = array("f")
+        self.times = array("d")
+        self.top_ids = array("q")
+        self.top_logprobs = array("f")
+        self.start = time.perf_counter()
+        self._step_logprobs = None
+        self._prompt_seen = False
+        self._handle = None
+        self._thread = None
+
+    def attach(self, model):
+        """在模型的输出层挂前向钩子；生成结束后调用 detach()"""
+        self._thread = threading.get_ident()
+        self._handle = model.get_output_embeddings().register_forward_hook(self._hook)
+        return self
+
+    def detach(self):
+        if self._handle is not None:
+            self._handle.remove()
+            self._handle = None
+
+    def _hook(self, module, inputs, output):
+        # 其他线程中同时进行的生成也会经过同一个输出层，只记录本次生成所在的线程
+        if threading.get_ident() != self._thread:
+            return
+        self._step_logprobs = torch.log_softmax(output[0, -1].float(), dim=-1)
+
+    def put(self, value):
+        # 第一次调用传入的是输入prompt
+        if not self._prompt_seen:
+            self._prompt_seen = True
+            return
+        self.times.append(time.perf_counter() - self.start)
+        token = int(value.reshape(-1)[0])
+        self.token_ids.append(token)
+        step = self._step_logprobs
+        if step is None:
+            self.logprobs.append(float("nan"))
+            return
+        self.logprobs.append(float(step[token]))
+        if self.top_k:
+            values, indices = torch.topk(step, self.top_k)
+            self.top_ids.extend(indices.tolist())
+            self.top_logprobs.extend(values.tolist())
+
+    def end(self):
+        pass
+
+    def result(self, length=None):
+        """返回紧凑数组：token_ids(int32)、logprobs(float32)、times_ms(float32，相对生成开始)，
+        top_k>0 时另有 top_ids/top_logprobs（[步数, k]）；length 用于截掉结束符之后的步
+        """
+        steps = len(self.token_ids) if length is None else min(length, len(self.token_ids))
+        result = {
+            "token_ids": np.frombuffer(self.token_ids, dtype=np.int64)[:steps].astype(np.int32),
+            "logprobs": np.frombuffer(self.logprobs, dtype=np.float32)[:steps].copy(),
+            "times_ms": (np.frombuffer(self.times, dtype=np.float64)[:steps] * 1000).astype(np.float32)
+        }
+        if self.top_k:
+            result["top_ids"] = np.frombuffer(self.top_ids, dtype=np.int64).reshape(-1, self.top_k)[:steps].astype(np.int32)
+            result["top_logprobs"] = np.frombuffer(self.top_logprobs, dtype=np.float32).reshape(-1, self.top_k)[:steps].copy()
+        return result
@@ -0,0 +1,310 @@
+"""
+多进程数据并行推理服务
+每个工作进程绑定到一个NUMA节点（或一组CPU核心），由前端调度器按会话亲和性或负载分发请求
+"""
+import os
+import time
+import uuid
+import queue
+import threading
+import logging
+import multiprocessing as mp
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import Future
+from config import WORKER_POOL_CONFIG
+
+logger = logging.getLogger(__name__)
+
+def parse_cpulist(cpulist):
+    """解析形如 "0-3,8-11" 的CPU列表"""
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def _split(items, n):
+    """把列表尽量平均地切成n份"""
+    size, extra = divmod(len(items), n)
+    chunks, start = [], 0
+    for i in range(n):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+def detect_cpu_sets(num_workers):
+    """按NUMA节点为每个工作进程分配CPU核心；无法检测NUMA时平均切分"""
+    if hasattr(os, "sched_getaffinity"):
+        available = sorted(os.sched_getaffinity(0))
+    else:
+        available = list(range(os.cpu_count() or 1))
+    
+    nodes = []
+    node_root = Path("/sys/devices/system/node")
+    if node_root.exists():
+        for node in sorted(node_root.glob("node[0-9]*"), key=lambda p: int(p.name[4:])):
+            try:
+                cpus = [c for c in parse_cpulist((node / "cpulist").read_text()) if c in available]
+            except OSError:
+                continue
+            if cpus:
+                nodes.append(cpus)
+    if not nodes:
+        nodes = [available]
+    
+    # 进程数不多于节点数：每个进程独占一个或多个节点
+    if num_workers <= len(nodes):
+        return [
+            sorted(c for j in range(i, len(nodes), num_workers) for c in nodes[j])
+            for i in range(num_workers)
+        ]
+    
+    # 进程数多于节点数：同一节点上的进程平分该节点的核心
+    cpu_sets = []
+    for i in range(num_workers):
+        node_index = i % len(nodes)
+        sharers = len(range(node_index, num_workers, len(nodes)))
+        chunk = _split(nodes[node_index], sharers)[i // len(nodes)]
+        cpu_sets.append(chunk or nodes[node_index])
+    return cpu_sets
+
+def _worker_main(worker_id, model_path, cpus, request_q, result_q, heartbeat_interval):
+    """工作进程入口：绑定CPU、加载模型并循环处理请求"""
+    # 在导入torch之前设置，保证线程池大小与绑定的核心数一致
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    os.environ["OMP_NUM_THREADS"] = str(len(cpus))
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    
+    import torch
+    from local_llm_v2 import LocalLLM
+    torch.set_num_threads(len(cpus))
+    
+    # safetensors分片以内存映射方式读取，多个进程共享同一份页缓存
+    llm = LocalLLM(model_path)
+    if not llm.load_model():
+        result_q.put(("failed", worker_id, None, "模型加载失败"))
+        return
+    result_q.put(("ready", worker_id, None, None))
+    
+    def heartbeat():
+        # 心跳同时带上语义缓存统计（缓存在工作进程内），供 /health 展示
+        while True:
+            cache = llm.semantic_cache.stats() if llm.semantic_cache is not None else None
+            result_q.put(("heartbeat", worker_id, None, (time.time(), cache)))
+            time.sleep(heartbeat_interval)
+    threading.Thread(target=heartbeat, daemon=True).start()
+    
+    while True:
+        item = request_q.get()
+        if item is None:
+            break
+        request_id, kwargs = item
+        try:
+            n, best_of = kwargs.pop("n", 1), kwargs.pop("best_of", None)
+            if n > 1 or best_of:
+                # 多候选：共享前缀KV缓存并行采样，结果为按对数概率排序的候选列表
+                response = llm.generate_candidates(n=n, best_of=best_of, **kwargs)
+            else:
+                response = llm.generate_response(**kwargs)
+            result_q.put(("result", worker_id, request_id, response))
+        except Exception as e:
+            result_q.put(("error", worker_id, request_id, str(e)))
+
+class _WorkerHandle:
+    """调度器侧记录的工作进程状态"""
+    
+    def __init__(self, worker_id, cpus):
+        self.worker_id = worker_id
+        self.cpus = cpus
+        self.process = None
+        self.request_q = None
+        self.state = "stopped"
+        self.last_heartbeat = 0.0
+        self.restarts = 0
+        self.in_flight = {}
+        self.completed = 0
+        self.cache_stats = None
+
+class WorkerPool:
+    """多进程推理池：负责启动、调度、健康检查和崩溃重启"""
+    
+    def __init__(self, model_path, num_workers=None, cpu_sets=None):
+        self.model_path = model_path
+        num_workers = num_workers or WORKER_POOL_CONFIG["num_workers"]
+        cpu_sets = cpu_sets or detect_cpu_sets(num_workers)
+        
+        self._ctx = mp.get_context("spawn")
+        self._result_q = self._ctx.Queue()
+        self._workers = [_WorkerHandle(i, cpus) for i, cpus in enumerate(cpu_sets)]
+        # 会话 -> 工作进程，按最近使用排列，超过上限时淘汰最久未使用的会话
+        self._affinity = OrderedDict()
+        self._max_affinity = WORKER_POOL_CONFIG["max_affinity_sessions"]
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads = []
+    
+    def start(self):
+        """启动所有工作进程以及结果分发、健康检查线程"""
+        for worker in self._workers:
+            self._spawn(worker)
+        
+        for target, name in ((self._collect_results, "pool-results"), (self._monitor, "pool-monitor")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+    
+    def _spawn(self, worker):
+        worker.request_q = self._ctx.Queue()
+        worker.process = self._ctx.Process(
+            target=_worker_main,
+            args=(
+                worker.worker_id,
+                self.model_path,
+                worker.cpus,
+                worker.request_q,
+                self._result_q,
+                WORKER_POOL_CONFIG["heartbeat_interval"]
+            ),
+            name=f"llm-worker-{worker.worker_id}",
+            daemon=True
+        )
+        worker.state = "starting"
+        worker.last_heartbeat = time.time()
+        worker.process.start()
+        logger.info(f"工作进程 {worker.worker_id} 已启动 (pid={worker.process.pid}, CPU={worker.cpus})")
+    
+    def _restart(self, worker, reason):
+        """重启失联或崩溃的工作进程，并让其未完成请求失败返回"""
+        logger.warning(f"工作进程 {worker.worker_id} {reason}，正在重启")
+        with self._lock:
+            failed = list(worker.in_flight.values())
+            worker.in_flight.clear()
+            self._affinity = OrderedDict((s, w) for s, w in self._affinity.items() if w != worker.worker_id)
+        for future in failed:
+            if not future.done():
+                future.set_exception(RuntimeError(f"工作进程 {worker.worker_id} {reason}"))
+        
+        if worker.process is not None and worker.process.is_alive():
+            worker.process.terminate()
+            worker.process.join(timeout=10)
+        worker.restarts += 1
+        self._spawn(worker)
+    
+    def _collect_results(self):
+        while not self._stopping.is_set():
+            try:
+                kind, worker_id, request_id, payload = self._result_q.get(timeout=1)
+            except queue.Empty:
+                continue
+            
+            worker = self._workers[worker_id]
+            if kind == "heartbeat":
+                worker.last_heartbeat, worker.cache_stats = payload
+            elif kind == "ready":
+                worker.state = "ready"
+                worker.last_heartbeat = time.time()
+                logger.info(f"工作进程 {worker_id} 模型加载完成")
+            elif kind == "failed":
+                worker.state = "failed"
+                logger.error(f"工作进程 {worker_id} 启动失败: {payload}")
+            else:
+                with self._lock:
+                    future = worker.in_flight.pop(request_id, None)
+                    if future is not None:
+                        worker.completed += 1
+                if future is None or future.done():
+                    continue
+                if kind == "result":
+                    future.set_result(payload)
+                else:
+                    future.set_exception(RuntimeError(payload))
+    
+    def _monitor(self):
+        interval = WORKER_POOL_CONFIG["health_check_interval"]
+        timeout = WORKER_POOL_CONFIG["heartbeat_timeout"]
+        while not self._stopping.wait(interval):
+            for worker in self._workers:
+                if worker.state == "failed":
+                    continue
+                if not worker.process.is_alive():
+                    self._restart(worker, f"异常退出 (exitcode={worker.process.exitcode})")
+                elif worker.state == "ready" and time.time() - worker.last_heartbeat > timeout:
+                    self._restart(worker, "心跳超时")
+    
+    def _route(self, session_id):
+        """选择工作进程：优先会话亲和，其次选择负载最低的就绪进程
+        
+        工作进程按请求无状态地调用 generate_response，亲和并不保留会话的KV缓存；
+        它只让同一会话的请求固定落在一个进程上，重复或相近的问题能命中该进程内的语义缓存
+        """
+        if session_id is not None:
+            worker_id = self._affinity.get(session_id)
+            if worker_id is not None and self._workers[worker_id].state in ("ready", "starting"):
+                self._affinity.move_to_end(session_id)
+                return self._workers[worker_id]
+        
+        candidates = [w for w in self._workers if w.state == "ready"]
+        if not candidates:
+            candidates = [w for w in self._workers if w.state == "starting"]
+        if not candidates:
+            raise RuntimeError("没有可用的工作进程")
+        
+        worker = min(candidates, key=lambda w: len(w.in_flight))
+        if session_id is not None:
+            self._affinity[session_id] = worker.worker_id
+            self._affinity.move_to_end(session_id)
+            while len(self._affinity) > self._max_affinity:
+                self._affinity.popitem(last=False)
+        return worker
+    
+    def submit(self, prompt, session_id=None, **gen_kwargs):
+        """提交生成请求，返回Future；gen_kwargs 原样传给 LocalLLM.generate_response
+        （指定 n>1 或 best_of 时传给 generate_candidates，结果为候选列表）"""
+        future = Future()
+        request_id = uuid.uuid4().hex
+        with self._lock:
+            worker = self._route(session_id)
+            worker.in_flight[request_id] = future
+        worker.request_q.put((request_id, {"user_input": prompt, **gen_kwargs}))
+        return future
+    
+    def generate(self, prompt, session_id=None, **kwargs):
+        """同步生成回复"""
+        future = self.submit(prompt, session_id=session_id, **kwargs)
+        return future.result(timeout=WORKER_POOL_CONFIG["request_timeout"])
+    
+    def health(self):
+        """返回各工作进程的健康状态"""
+        now = time.time()
+        return [{
+            "worker_id": w.worker_id,
+            "pid": w.process.pid if w.process else None,
+            "state": w.state,
+            "cpus": w.cpus,
+            "in_flight": len(w.in_flight),
+            "completed": w.completed,
+            "restarts": w.restarts,
+            "heartbeat_age": round(now - w.last_heartbeat, 1),
+            "semantic_cache": w.cache_stats
+        } for w in self._workers]
+    
+    def shutdown(self):
+        """停止所有工作进程"""
+        self._stopping.set()
+        for worker in self._workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.request_q.put(None)
+        for worker in self._workers:
+            if worker.process is not None:
+                worker.process.join(timeout=10)
+                if worker.process.is_alive():
+                    worker.process.terminate()